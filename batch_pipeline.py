@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Offline batch pipeline: screen and answer a JSONL file of conversations.
+
+Each input line is one item, in any of these shapes:
+
+    {"id": ..., "messages": [{"role": "user", "content": ...}, ...]}
+    {"id": ..., "message": ..., "history": [...]}
+    {"request_id": ..., "title": ..., "body": ...}
+
+The last message (or "message", or "body") is screened and answered, with the
+messages before it as history. Items without an id are numbered by line.
+
+Every item goes through the same steps as /api/chat, minus HTTP: the crisis
+lexicon, the model's risk check and, unless the message is high risk, the
+therapeutic reply. --concurrency items are in flight at once, so the
+inference engine decodes their replies together in batches. With
+--processes N the weights are loaded once and N forked processes each take
+every Nth item, with their share of the CPU cores.
+
+Results are appended to the output JSONL as items finish, one line per item
+(in completion order, not input order). Running again with the same output
+file skips every item that already has a result, so an interrupted run
+carries on where it stopped. Items that failed are written with an "error"
+and tried again on the next run.
+
+Usage:
+    python batch_pipeline.py conversations.jsonl results.jsonl [--concurrency 16] [--processes 2]
+    python batch_pipeline.py conversations.jsonl results.jsonl --risk-only   # screening only
+    python batch_pipeline.py conversations.jsonl results.jsonl --portable    # app_portable.py's model cache
+"""
+
+import argparse
+import contextlib
+import gc
+import importlib
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cpu_tuning import apply_cpu_config, load_cpu_config
+from prefork_server import available_cores
+
+
+def conversation_messages(record):
+    """The chat messages of one JSONL record, oldest first
+
+    The last is the one to answer. Records are {"messages": [...]},
+    {"message", "history"} or {"request_id", "title", "body"}.
+    benchmarks/replay_load.py reads its input with this too.
+    """
+    if record.get("messages"):
+        return list(record["messages"])
+    message = record.get("message", record.get("body"))
+    if message is None:
+        return []
+    return list(record.get("history", [])) + [{"role": "user", "content": message}]
+
+
+def read_items(path):
+    """(line index, id, message, history) of every usable input line"""
+    with open(path, encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print(f"Line {index + 1}: not JSON, skipped", file=sys.stderr)
+                continue
+
+            item_id = record.get("id", record.get("request_id", index + 1))
+            messages = conversation_messages(record)
+            message = messages[-1].get("content") if messages else None
+            history = messages[:-1]
+            if not isinstance(message, str) or not message.strip():
+                print(f"Line {index + 1}: no message, skipped", file=sys.stderr)
+                continue
+            yield index, item_id, message, history
+
+
+def finished_ids(path):
+    """Ids with a result in an earlier run's output, as strings
+
+    Drops a last line cut short by an interruption, so appending resumes on
+    a clean line.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+            data = data[:data.rfind(b"\n") + 1]
+    for line in data.decode("utf-8").splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if "error" not in record:
+            done.add(str(record["id"]))
+    return done
+
+
+def process_item(app, item_id, message, history, risk_only):
+    """Risk verdict and reply for one item, as its output record"""
+    from inference_engine import EngineOverloaded
+
+    start = time.perf_counter()
+    record = {"id": item_id, "message": message}
+    while True:
+        try:
+            risk = app.check_crisis_phrases(message)
+            if risk:
+                record.update(high_risk=True, flagged_by="lexicon", risk_probability=None,
+                              lexicon_matches=[match["phrase"] for match in risk["matches"]])
+            else:
+                risk = app.assess_model_risk(message, strict=True)
+                record.update(high_risk=risk["is_high_risk"], flagged_by="model" if risk["is_high_risk"] else None,
+                              risk_probability=risk.get("risk_probability"))
+
+            if record["high_risk"]:
+                record["response"] = app.CRISIS_RESPONSE
+            elif not risk_only:
+                record["response"] = app.collect_response(app.start_therapeutic_response(message, history))
+            break
+        except EngineOverloaded:
+            # More items in flight than the queues take; wait for room
+            time.sleep(0.1)
+
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_items(app, args, rank, processes, done):
+    """Process this process's share of the input, appending results to the output"""
+    out = os.open(args.output, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    write_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(args.concurrency)
+    finished = [0]
+    start = time.perf_counter()
+
+    def handle(item_id, message, history):
+        try:
+            record = process_item(app, item_id, message, history, args.risk_only)
+        except Exception as e:
+            record = {"id": item_id, "message": message, "error": str(e)}
+        try:
+            # One write per line: O_APPEND keeps lines from concurrent
+            # threads and processes whole
+            line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            with write_lock:
+                os.write(out, line)
+                finished[0] += 1
+                if finished[0] % args.progress_every == 0:
+                    rate = finished[0] / (time.perf_counter() - start)
+                    print(f"[{rank + 1}/{processes}] {finished[0]} items, {rate:.1f} items/s", file=sys.stderr)
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for index, item_id, message, history in read_items(args.input):
+            if index % processes != rank or str(item_id) in done:
+                continue
+            slots.acquire()
+            pool.submit(handle, item_id, message, history)
+    os.close(out)
+
+
+def run_forked(app, args, done):
+    """Load the weights once, then fork --processes workers over the input"""
+    threads = max(1, available_cores() // args.processes)
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    import torch
+
+    # No intra-op thread pool may exist at fork time (see prefork_server.py)
+    torch.set_num_threads(1)
+    if app.MODEL_BACKEND != "onnx":
+        app.load_weights()
+        if app.SPECULATIVE_DECODING:
+            app.load_draft_weights()
+    gc.collect()
+    gc.freeze()
+
+    children = []
+    for rank in range(args.processes):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            code = 0
+            try:
+                torch.set_num_threads(threads)
+                if not app.initialize_model():
+                    raise RuntimeError("model failed to load")
+                run_items(app, args, rank, args.processes, done)
+            except KeyboardInterrupt:
+                code = 130
+            except Exception as e:
+                print(f"Process {rank + 1} failed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        children.append(pid)
+    print(f"{args.processes} processes x {threads} threads, {args.concurrency} items in flight each", file=sys.stderr)
+
+    failed = 0
+    for pid in children:
+        _, status = os.waitpid(pid, 0)
+        failed += status != 0
+    return failed == 0
+
+
+def summarize(path, done_before, seconds):
+    """Print what this run added to the output"""
+    results = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if str(record["id"]) not in done_before:
+                results[str(record["id"])] = record
+    errors = sum("error" in record for record in results.values())
+    high_risk = sum(bool(record.get("high_risk")) for record in results.values())
+    print(
+        f"\n{len(results)} items in {seconds:.0f}s ({len(results) / max(seconds, 1e-9):.1f} items/s): "
+        f"{high_risk} high risk, {errors} errors, {len(done_before)} done in earlier runs",
+        file=sys.stderr,
+    )
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file of conversations")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, help="items in flight per process (default: 2 x MAX_BATCH_SIZE)")
+    parser.add_argument("--processes", type=int, default=1, help="forked processes sharing the weights (Linux/macOS)")
+    parser.add_argument("--risk-only", action="store_true", help="screen only, without therapeutic replies")
+    parser.add_argument("--portable", action="store_true", help="use app_portable.py instead of app.py")
+    parser.add_argument("--progress-every", type=int, default=100, help="items between progress lines")
+    parser.add_argument("--quiet", action="store_true", help="hide the app's per-request log lines")
+    args = parser.parse_args()
+
+    if args.processes > 1 and not hasattr(os, "fork"):
+        sys.exit("--processes needs os.fork (Linux or macOS)")
+
+    app = importlib.import_module("app_portable" if args.portable else "app")
+    args.concurrency = args.concurrency or 2 * app.MAX_BATCH_SIZE
+    done = finished_ids(args.output)
+    if done:
+        print(f"Resuming: {len(done)} items already in {args.output}", file=sys.stderr)
+
+    start = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if args.quiet:
+            # The app logs every prompt and generation to stdout; progress goes to stderr
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        if args.processes > 1:
+            completed = run_forked(app, args, done)
+        else:
+            settings = load_cpu_config(app.CPU_TUNING_PATH, "single_process", app.MODEL_BACKEND, app.MODEL_PRECISION)
+            if settings:
+                apply_cpu_config(settings)
+            completed = app.initialize_model()
+            if completed:
+                run_items(app, args, 0, 1, done)
+
+    errors = summarize(args.output, done, time.perf_counter() - start) if os.path.exists(args.output) else 0
+    if not completed or errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Benchmark: tokens/s and memory of the PyTorch and ONNX Runtime backends.
+
+Each backend is loaded in a fresh subprocess so its memory is measured in
+isolation, and greedily decodes the same fixed prompts through the forward
+call the inference engine uses (prefill, then one token at a time with the
+KV cache). Reports load time, resident and peak memory, prefill time and
+decode tokens/s, and how closely each backend's output matches PyTorch's.
+
+The ONNX export is the one portable_setup.py writes with MODEL_BACKEND=onnx
+(models/onnx/). Its precision is fixed at export time; --precision only
+applies to the PyTorch backend.
+
+Usage:
+    python benchmarks/bench_backends.py                 # PyTorch model from the HF cache
+    python benchmarks/bench_backends.py --portable      # PyTorch model from models/
+    python benchmarks/bench_backends.py --precision int8 --onnx-dir models/onnx
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+PROMPTS = [
+    "I feel like everything I do is wrong.",
+    "I can't sleep because I keep worrying about my exams.",
+    "My friends have stopped talking to me and I don't know why.",
+    "I get really anxious before meetings at work.",
+    "I keep thinking I'm going to fail no matter how hard I try.",
+    "Every small mistake makes me feel like a failure.",
+]
+
+BACKENDS = ("pytorch", "onnx")
+
+
+def greedy_decode(model, input_ids, new_tokens, eos_token_id):
+    """(new token ids, prefill seconds, decode seconds) through the engine's forward call"""
+    import torch
+
+    from kv_cache import from_legacy_cache, to_legacy_cache
+
+    with torch.inference_mode():
+        start = time.perf_counter()
+        outputs = model(input_ids=torch.tensor([input_ids]), use_cache=True)
+        token_id = int(outputs.logits[0, -1].argmax())
+        prefill_seconds = time.perf_counter() - start
+
+        generated = [token_id]
+        start = time.perf_counter()
+        while len(generated) < new_tokens and token_id != eos_token_id:
+            length = len(input_ids) + len(generated)
+            outputs = model(
+                input_ids=torch.tensor([[token_id]]),
+                attention_mask=torch.ones(1, length, dtype=torch.long),
+                position_ids=torch.tensor([[length - 1]]),
+                past_key_values=from_legacy_cache(to_legacy_cache(outputs.past_key_values)),
+                use_cache=True,
+            )
+            token_id = int(outputs.logits[0, -1].argmax())
+            generated.append(token_id)
+        decode_seconds = time.perf_counter() - start
+    return generated, prefill_seconds, decode_seconds
+
+
+def run_worker(backend, args):
+    """Load one backend, decode the prompts and print a JSON report"""
+    load_kwargs = {}
+    if args.portable:
+        cache_dir = ROOT / "models" / "transformers_cache"
+        os.environ["HF_HOME"] = str(cache_dir)
+        load_kwargs = {"cache_dir": cache_dir, "local_files_only": True}
+
+    import torch  # noqa: F401
+    from transformers import AutoTokenizer
+
+    from model_loader import MODEL_NAME, load_model, peak_memory_mb, resident_memory_mb
+
+    start = time.perf_counter()
+    if backend == "onnx":
+        from onnx_backend import OnnxCausalLM
+
+        tokenizer = AutoTokenizer.from_pretrained(args.onnx_dir, local_files_only=True)
+        model = OnnxCausalLM(args.onnx_dir)
+        precision = model.precision
+    else:
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, **load_kwargs)
+        model = load_model(MODEL_NAME, precision=args.precision, **load_kwargs)
+        precision = args.precision
+    load_seconds = time.perf_counter() - start
+    memory_mb = resident_memory_mb()
+
+    outputs = []
+    generated = 0
+    prefill_seconds = 0.0
+    decode_seconds = 0.0
+    for text in PROMPTS:
+        prompt = tokenizer.apply_chat_template(
+            [{"role": "user", "content": text}], tokenize=False, add_generation_prompt=True
+        )
+        input_ids = tokenizer(prompt)["input_ids"]
+        new_ids, prefill, decode = greedy_decode(model, input_ids, args.new_tokens, tokenizer.eos_token_id)
+        prefill_seconds += prefill
+        decode_seconds += decode
+        # The first token comes from the prefill
+        generated += len(new_ids) - 1
+        outputs.append(new_ids)
+
+    print(json.dumps({
+        "backend": backend,
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "memory_mb": memory_mb,
+        "peak_memory_mb": peak_memory_mb(),
+        "prefill_ms": prefill_seconds / len(PROMPTS) * 1000,
+        "tokens_per_second": generated / decode_seconds if decode_seconds else float("nan"),
+        "outputs": outputs,
+    }))
+
+
+def agreement(outputs, reference):
+    """Exact-match rate and mean share of tokens before the first divergence"""
+    exact = 0
+    prefix_share = 0.0
+    for ids, ref in zip(outputs, reference):
+        common = 0
+        for a, b in zip(ids, ref):
+            if a != b:
+                break
+            common += 1
+        exact += ids == ref
+        prefix_share += common / max(len(ids), len(ref), 1)
+    return exact / len(reference), prefix_share / len(reference)
+
+
+def main():
+    from model_loader import PRECISIONS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=BACKENDS)
+    parser.add_argument("--precision", default="float32", choices=PRECISIONS, help="PyTorch backend precision")
+    parser.add_argument("--onnx-dir", default=str(ROOT / "models" / "onnx"))
+    parser.add_argument("--portable", action="store_true", help="load PyTorch weights from models/ like app_portable.py")
+    parser.add_argument("--threads", type=int, help="intra-op threads for both backends")
+    parser.add_argument("--new-tokens", type=int, default=48)
+    parser.add_argument("--worker", choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        if args.threads:
+            import torch
+            torch.set_num_threads(args.threads)
+        run_worker(args.worker, args)
+        return
+
+    backends = ["pytorch"] + [b for b in args.backends if b != "pytorch"]
+    reports = {}
+    for backend in backends:
+        print(f"Measuring {backend}...")
+        command = [
+            sys.executable, __file__, "--worker", backend,
+            "--precision", args.precision, "--onnx-dir", args.onnx_dir, "--new-tokens", str(args.new_tokens),
+        ]
+        if args.portable:
+            command.append("--portable")
+        if args.threads:
+            command += ["--threads", str(args.threads)]
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(f"{backend} run failed")
+        reports[backend] = json.loads(result.stdout.strip().splitlines()[-1])
+
+    reference = reports["pytorch"]["outputs"]
+    print(
+        f"\n{'backend':<8} {'precision':<9} {'RSS MB':>7} {'peak MB':>8} {'load s':>7} "
+        f"{'prefill ms':>10} {'tok/s':>7} {'exact':>6} {'prefix':>7}"
+    )
+    for backend, report in reports.items():
+        exact, prefix = agreement(report["outputs"], reference)
+        memory = f"{report['memory_mb']:.0f}" if report["memory_mb"] is not None else "n/a"
+        peak = f"{report['peak_memory_mb']:.0f}" if report["peak_memory_mb"] is not None else "n/a"
+        print(
+            f"{backend:<8} {report['precision']:<9} {memory:>7} {peak:>8} {report['load_seconds']:>7.1f} "
+            f"{report['prefill_ms']:>10.0f} {report['tokens_per_second']:>7.1f} {exact:>6.0%} {prefix:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark: continuous batching engine vs. the one-at-a-time pipeline path.
+
+Simulates N users chatting at once and reports generated tokens per second
+for both paths. Every request is forced to produce the same number of new
+tokens so the two paths do identical work. The pipeline is the transformers
+text-generation pipeline the app used before the engine, built here on the
+app's model; it needs MODEL_BACKEND=pytorch.
+
+Usage: python benchmarks/bench_batching.py [--users 1 2 4 8] [--new-tokens 64]
+"""
+
+import argparse
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+PROMPTS = [
+    "I feel like everything I do is wrong.",
+    "I can't sleep because I keep worrying about my exams.",
+    "My friends have stopped talking to me and I don't know why.",
+    "I get really anxious before meetings at work.",
+    "I keep thinking I'm going to fail no matter how hard I try.",
+    "I feel lonely even when I'm around my family.",
+    "Every small mistake makes me feel like a failure.",
+    "I've been feeling tired and unmotivated for weeks.",
+]
+
+
+def format_prompt(text):
+    return (
+        "<|system|>\nYou are a helpful mental health support assistant trained in "
+        "Cognitive Behavioral Therapy (CBT). Provide empathetic, supportive responses.\n"
+        f"<|user|>\n{text}\n<|assistant|>\n"
+    )
+
+
+def build_pipeline():
+    """The app's former text-generation pipeline, on the loaded model"""
+    import torch
+    from transformers import pipeline
+
+    return pipeline(
+        "text-generation",
+        model=app.model,
+        tokenizer=app.tokenizer,
+        torch_dtype=app.model.dtype,
+        device=0 if torch.cuda.is_available() else -1,
+        do_sample=True,
+        temperature=0.7,
+        top_p=0.9,
+        repetition_penalty=1.1,
+    )
+
+
+def run_sequential(text_generator, prompts, new_tokens):
+    """Old path: each prompt goes through the pipeline on its own"""
+    start = time.perf_counter()
+    for prompt in prompts:
+        text_generator(
+            prompt,
+            max_new_tokens=new_tokens,
+            min_new_tokens=new_tokens,
+            pad_token_id=app.tokenizer.eos_token_id,
+        )
+    return time.perf_counter() - start
+
+
+def run_engine(prompts, new_tokens):
+    """Engine path: all users submit at once from their own threads"""
+    encoded = [app.tokenizer(prompt)["input_ids"] for prompt in prompts]
+    threads = [
+        threading.Thread(target=app.inference_engine.generate, args=(ids, new_tokens))
+        for ids in encoded
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--new-tokens", type=int, default=64)
+    args = parser.parse_args()
+
+    if app.MODEL_BACKEND != "pytorch":
+        sys.exit("The pipeline baseline needs MODEL_BACKEND=pytorch")
+    app.MAX_BATCH_SIZE = max(args.users)
+    if not app.initialize_model():
+        sys.exit(1)
+    text_generator = build_pipeline()
+
+    # Warm up both paths once so lazy initialisation is not measured
+    run_sequential(text_generator, [format_prompt(PROMPTS[0])], 4)
+    run_engine([format_prompt(PROMPTS[0])], 4)
+
+    print(f"\n{'users':>5} {'sequential tok/s':>17} {'engine tok/s':>13} {'speed-up':>9}")
+    for users in args.users:
+        prompts = [format_prompt(PROMPTS[i % len(PROMPTS)]) for i in range(users)]
+        total_tokens = users * args.new_tokens
+
+        sequential = total_tokens / run_sequential(text_generator, prompts, args.new_tokens)
+        engine = total_tokens / run_engine(prompts, args.new_tokens)
+        print(f"{users:>5} {sequential:>17.1f} {engine:>13.1f} {engine / sequential:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
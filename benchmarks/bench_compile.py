@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark: eager against TORCH_COMPILE=1, from start-up to steady state.
+
+Each run is a fresh process that loads the model and reports the time of
+the warmup and compile load stages, the latency of the first requests after
+the model reported ready and the median latency once warm. A request is a
+risk check plus a fixed-length greedy reply, so runs are comparable.
+
+Compiled runs go twice over an empty compile cache in a temporary
+directory: the first compiles, the second loads the cached kernels.
+
+Usage: python benchmarks/bench_compile.py [--requests 20] [--new-tokens 32] [--portable]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+MESSAGES = [
+    "I feel like everything I do is wrong",
+    "I can't sleep because I keep worrying about my exams",
+    "My friends have stopped talking to me and I don't know why",
+    "I get really anxious before meetings at work",
+]
+
+
+def measure(args):
+    """Run in the child: load, then time requests from the first one on"""
+    import importlib
+
+    from cpu_tuning import run_request
+
+    app = importlib.import_module("app_portable" if args.portable else "app")
+    if not app.initialize_model():
+        sys.exit(1)
+    stages = {stage["name"]: stage["seconds"] for stage in app.load_progress.snapshot()["stages"]}
+
+    # Numbered so the risk verdict cache never answers
+    latencies = [
+        run_request(app, f"{MESSAGES[i % len(MESSAGES)]} (request {i})", args.new_tokens)[0] * 1000
+        for i in range(args.requests)
+    ]
+    return {
+        "compiled": app.model_compiled,
+        "warmup_s": stages.get("warmup"),
+        "compile_s": stages.get("compile"),
+        "first_ms": latencies[0],
+        "second_ms": latencies[1],
+        "steady_ms": statistics.median(latencies[len(latencies) // 2:]),
+    }
+
+
+def run(args, env):
+    command = [sys.executable, __file__, "--measure", "--requests", str(args.requests), "--new-tokens", str(args.new_tokens)]
+    if args.portable:
+        command.append("--portable")
+    completed = subprocess.run(command, cwd=ROOT, env={**os.environ, **env}, stdout=subprocess.PIPE, text=True)
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    sys.exit("Run failed:\n" + "\n".join(completed.stdout.splitlines()[-10:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--new-tokens", type=int, default=32)
+    parser.add_argument("--mode", default="default", help="TORCH_COMPILE_MODE")
+    parser.add_argument("--portable", action="store_true")
+    parser.add_argument("--measure", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.requests = max(args.requests, 4)
+
+    if args.measure:
+        print("RESULT " + json.dumps(measure(args)), flush=True)
+        return
+
+    rows = [("eager", run(args, {"TORCH_COMPILE": "0"}))]
+    with tempfile.TemporaryDirectory() as cache_dir:
+        env = {"TORCH_COMPILE": "1", "TORCH_COMPILE_MODE": args.mode, "TORCH_COMPILE_CACHE_DIR": cache_dir}
+        rows.append(("compile, cold cache", run(args, env)))
+        rows.append(("compile, cached", run(args, env)))
+
+    print(f"\n{'run':<20} {'warmup s':>9} {'compile s':>10} {'1st ms':>8} {'2nd ms':>8} {'steady ms':>10}")
+    for name, row in rows:
+        if name != "eager" and not row["compiled"]:
+            name += " (failed)"
+        compile_s = f"{row['compile_s']:.1f}" if row["compile_s"] is not None else "-"
+        print(
+            f"{name:<20} {row['warmup_s']:>9.1f} {compile_s:>10} {row['first_ms']:>8.0f} "
+            f"{row['second_ms']:>8.0f} {row['steady_ms']:>10.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
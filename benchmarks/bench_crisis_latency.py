@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Load test: crisis-path latency while the inference queue is saturated.
+
+Background clients keep the decode batch and the waiting queue full of
+ordinary therapeutic generations (more clients than batch + queue slots, so
+some are being turned away). Meanwhile it measures:
+
+- crisis-phrase replies from /api/chat, which must never touch the model
+- LLM risk checks at high priority, and the same check at normal priority
+  for comparison (retried until the full queue accepts it)
+
+Exits non-zero if any crisis reply or high-priority risk check exceeds its
+bound.
+
+Usage: python benchmarks/bench_crisis_latency.py [--crisis-bound-ms 50] [--risk-bound-ms 3000]
+"""
+
+import argparse
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app  # noqa: E402
+
+LOAD_MESSAGES = [
+    "I feel like everything I do is wrong",
+    "I can't sleep because I keep worrying about my exams",
+    "My friends have stopped talking to me and I don't know why",
+    "I get really anxious before meetings at work",
+]
+
+CRISIS_MESSAGES = [
+    "I want to kill myself",
+    "I have nothing to live for",
+    "Everyone would be better off dead without me, and I think about it a lot",
+]
+
+RISK_MESSAGES = [
+    "Nothing matters and I keep thinking about the bridge near my house",
+    "I gave away my things this week",
+    "I'm so tired of everything, I just want it all to stop",
+]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return float("nan"), float("nan"), float("nan")
+    return samples[len(samples) // 2], samples[int(len(samples) * 0.95)], samples[-1]
+
+
+def saturate(index, stop, counts):
+    from inference_engine import EngineOverloaded
+
+    n = 0
+    while not stop.is_set():
+        message = f"{LOAD_MESSAGES[index % len(LOAD_MESSAGES)]} (client {index}, message {n})"
+        n += 1
+        try:
+            app.start_therapeutic_response(message, []).result()
+            counts["completed"] += 1
+        except EngineOverloaded:
+            counts["rejected"] += 1
+            time.sleep(0.05)
+
+
+def time_risk_check(text, priority):
+    """Seconds until one risk score is back, retrying while the engine turns it away"""
+    from inference_engine import EngineOverloaded
+
+    input_ids = app.build_risk_prompt(text)
+    prefix = app.prefix_cache.get("risk")
+    start = time.perf_counter()
+    while True:
+        try:
+            app.inference_engine.score(input_ids, app.risk_label_ids, prefix=prefix, priority=priority)
+            return time.perf_counter() - start
+        except EngineOverloaded:
+            time.sleep(0.05)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--crisis-samples", type=int, default=200)
+    parser.add_argument("--risk-samples", type=int, default=20)
+    parser.add_argument("--normal-risk-samples", type=int, default=3)
+    parser.add_argument("--load-clients", type=int, help="default: batch + queue slots + 8")
+    parser.add_argument("--crisis-bound-ms", type=float, default=50)
+    parser.add_argument("--risk-bound-ms", type=float, default=3000)
+    args = parser.parse_args()
+
+    if not app.initialize_model():
+        sys.exit("Model failed to load")
+    client = app.app.test_client()
+
+    clients = args.load_clients or app.MAX_BATCH_SIZE + app.MAX_QUEUE_SIZE + 8
+    stop = threading.Event()
+    counts = {"completed": 0, "rejected": 0}
+    threads = [threading.Thread(target=saturate, args=(i, stop, counts), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+
+    print(f"Saturating with {clients} clients...")
+    deadline = time.monotonic() + 60
+    while app.inference_engine.queue_depth < app.MAX_QUEUE_SIZE and time.monotonic() < deadline:
+        time.sleep(0.1)
+    print(f"Queue depth {app.inference_engine.queue_depth}/{app.MAX_QUEUE_SIZE}, batch {app.inference_engine.batch_size}")
+
+    crisis = []
+    for i in range(args.crisis_samples):
+        start = time.perf_counter()
+        response = client.post("/api/chat", json={
+            "messages": [{"role": "user", "content": CRISIS_MESSAGES[i % len(CRISIS_MESSAGES)]}],
+        })
+        crisis.append(time.perf_counter() - start)
+        if not response.get_json().get("crisis"):
+            sys.exit("Crisis message did not get the crisis response")
+
+    # Distinct texts so the verdict cache never answers
+    high = [
+        time_risk_check(f"{RISK_MESSAGES[i % len(RISK_MESSAGES)]} ({i})", "high")
+        for i in range(args.risk_samples)
+    ]
+    normal = [
+        time_risk_check(f"{RISK_MESSAGES[i % len(RISK_MESSAGES)]} (normal {i})", "normal")
+        for i in range(args.normal_risk_samples)
+    ]
+
+    print(f"Queue depth at end {app.inference_engine.queue_depth}, load requests completed "
+          f"{counts['completed']}, rejected {counts['rejected']}")
+    stop.set()
+
+    print(f"\n{'path':<28} {'n':>4} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    rows = [
+        ("crisis phrase (/api/chat)", crisis),
+        ("LLM risk, high priority", high),
+        ("LLM risk, normal priority", normal),
+    ]
+    for name, samples in rows:
+        p50, p95, worst = percentiles(samples)
+        print(f"{name:<28} {len(samples):>4} {p50 * 1000:>9.1f} {p95 * 1000:>9.1f} {worst * 1000:>9.1f}")
+
+    failures = []
+    if max(crisis) * 1000 > args.crisis_bound_ms:
+        failures.append(f"crisis reply took {max(crisis) * 1000:.1f} ms > {args.crisis_bound_ms} ms")
+    if high and max(high) * 1000 > args.risk_bound_ms:
+        failures.append(f"high-priority risk check took {max(high) * 1000:.1f} ms > {args.risk_bound_ms} ms")
+    if failures:
+        print("\nFAIL: " + "; ".join(failures))
+        sys.exit(1)
+    print("\nPASS: crisis latency stayed within bounds under saturation")
+
+
+if __name__ == "__main__":
+    main()
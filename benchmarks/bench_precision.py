@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Report: resident memory, speed and output agreement of each CPU precision.
+
+Each precision mode (see model_loader.PRECISIONS) is loaded in a fresh
+subprocess so its memory is measured in isolation. Every mode greedily
+decodes the same fixed prompts. Outputs are compared with float32 by exact
+match and by the share of tokens generated before the first divergence.
+
+Usage:
+    python benchmarks/bench_precision.py                # model from the HF cache (app.py)
+    python benchmarks/bench_precision.py --portable     # model from models/ (app_portable.py)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+PROMPTS = [
+    "I feel like everything I do is wrong.",
+    "I can't sleep because I keep worrying about my exams.",
+    "My friends have stopped talking to me and I don't know why.",
+    "I get really anxious before meetings at work.",
+    "I keep thinking I'm going to fail no matter how hard I try.",
+    "Every small mistake makes me feel like a failure.",
+]
+
+
+def run_worker(precision, portable, new_tokens):
+    """Load one precision mode, decode the prompts and print a JSON report"""
+    load_kwargs = {}
+    if portable:
+        cache_dir = ROOT / "models" / "transformers_cache"
+        os.environ["HF_HOME"] = str(cache_dir)
+        load_kwargs = {"cache_dir": cache_dir, "local_files_only": True}
+
+    import torch
+    from transformers import AutoTokenizer
+
+    from model_loader import MODEL_NAME, load_model, resident_memory_mb
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, **load_kwargs)
+    start = time.perf_counter()
+    model = load_model(MODEL_NAME, precision=precision, **load_kwargs)
+    load_seconds = time.perf_counter() - start
+    memory_mb = resident_memory_mb()
+
+    outputs = []
+    generated = 0
+    decode_seconds = 0.0
+    for text in PROMPTS:
+        prompt = tokenizer.apply_chat_template(
+            [{"role": "user", "content": text}], tokenize=False, add_generation_prompt=True
+        )
+        input_ids = tokenizer(prompt, return_tensors="pt")["input_ids"]
+        start = time.perf_counter()
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids,
+                do_sample=False,
+                max_new_tokens=new_tokens,
+                pad_token_id=tokenizer.eos_token_id,
+            )
+        decode_seconds += time.perf_counter() - start
+        new_ids = output[0, input_ids.shape[1]:].tolist()
+        generated += len(new_ids)
+        outputs.append(new_ids)
+
+    print(json.dumps({
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "memory_mb": memory_mb,
+        "tokens_per_second": generated / decode_seconds,
+        "outputs": outputs,
+    }))
+
+
+def agreement(outputs, reference):
+    """Exact-match rate and mean share of tokens before the first divergence"""
+    exact = 0
+    prefix_share = 0.0
+    for ids, ref in zip(outputs, reference):
+        common = 0
+        for a, b in zip(ids, ref):
+            if a != b:
+                break
+            common += 1
+        exact += ids == ref
+        prefix_share += common / max(len(ids), len(ref), 1)
+    return exact / len(reference), prefix_share / len(reference)
+
+
+def main():
+    from model_loader import PRECISIONS
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--precisions", nargs="+", default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument("--portable", action="store_true", help="load from models/ like app_portable.py")
+    parser.add_argument("--new-tokens", type=int, default=48)
+    parser.add_argument("--worker", choices=PRECISIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.portable, args.new_tokens)
+        return
+
+    precisions = ["float32"] + [p for p in args.precisions if p != "float32"]
+    reports = {}
+    for precision in precisions:
+        print(f"Measuring {precision}...")
+        command = [sys.executable, __file__, "--worker", precision, "--new-tokens", str(args.new_tokens)]
+        if args.portable:
+            command.append("--portable")
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(result.stderr)
+            sys.exit(f"{precision} run failed")
+        reports[precision] = json.loads(result.stdout.strip().splitlines()[-1])
+
+    reference = reports["float32"]["outputs"]
+    print(f"\n{'precision':<10} {'RSS MB':>8} {'load s':>7} {'tok/s':>7} {'exact':>6} {'prefix':>7}")
+    for precision, report in reports.items():
+        exact, prefix = agreement(report["outputs"], reference)
+        memory = f"{report['memory_mb']:.0f}" if report["memory_mb"] is not None else "n/a"
+        print(
+            f"{precision:<10} {memory:>8} {report['load_seconds']:>7.1f} "
+            f"{report['tokens_per_second']:>7.1f} {exact:>6.0%} {prefix:>7.0%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
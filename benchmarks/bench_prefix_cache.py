@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Benchmark: prefill time saved by the precomputed prompt-prefix KV cache.
+
+For each prompt template, times a full prefill of a representative prompt
+against a prefill of only what follows the template's cached leading tokens.
+
+Usage: python benchmarks/bench_prefix_cache.py [--repeats 10]
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import torch  # noqa: E402
+
+import app  # noqa: E402
+from kv_cache import from_legacy_cache  # noqa: E402
+
+HISTORY = [
+    {"role": "user", "content": "I've been really stressed about work lately."},
+    {"role": "assistant", "content": "That sounds exhausting. What part of work feels heaviest right now?"},
+]
+MESSAGE = "I keep thinking I'm going to get fired even though nobody has said anything."
+
+
+@torch.inference_mode()
+def time_prefill(input_ids, prefix=None):
+    """Milliseconds spent prefilling input_ids, optionally after a cached prefix"""
+    device = app.inference_engine.device
+    if prefix is None:
+        start = time.perf_counter()
+        app.model(input_ids=torch.tensor([input_ids], device=device), use_cache=True)
+        return (time.perf_counter() - start) * 1000
+
+    suffix = input_ids[prefix.length:]
+    start = time.perf_counter()
+    app.model(
+        input_ids=torch.tensor([suffix], device=device),
+        attention_mask=torch.ones(1, len(input_ids), dtype=torch.long, device=device),
+        position_ids=torch.arange(prefix.length, len(input_ids), device=device).unsqueeze(0),
+        past_key_values=from_legacy_cache(prefix.past_key_values),
+        use_cache=True,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    if not app.initialize_model():
+        sys.exit(1)
+
+    prompts = {
+        "therapeutic": app.build_therapeutic_prompt(MESSAGE, HISTORY),
+        "risk": app.build_risk_prompt(MESSAGE),
+    }
+
+    print(f"\n{'template':<12} {'prefix tok':>10} {'prompt tok':>10} {'full ms':>9} {'cached ms':>10} {'saved ms':>9}")
+    for name, input_ids in prompts.items():
+        prefix = app.prefix_cache.get(name)
+
+        # Warm-up run, then take the median of the rest
+        time_prefill(input_ids)
+        time_prefill(input_ids, prefix)
+        full = statistics.median(time_prefill(input_ids) for _ in range(args.repeats))
+        cached = statistics.median(time_prefill(input_ids, prefix) for _ in range(args.repeats))
+        print(f"{name:<12} {prefix.length:>10} {len(input_ids):>10} {full:>9.1f} {cached:>10.1f} {full - cached:>9.1f}")
+
+    print(f"\nPrefix cache memory: {app.prefix_cache.nbytes / 2**20:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Benchmark: memory and throughput of prefork_server.py against worker count.
+
+For each worker count the server is started, warmed up, and then driven by
+concurrent clients posting distinct messages to /api/chat for a fixed time.
+Reports aggregate requests/s, p50/p95 latency, and the memory of the whole
+process tree. Both the summed RSS and the summed PSS are shown: RSS counts
+copy-on-write pages shared by the workers once per process, PSS splits them
+between the processes that share them.
+
+Linux only (reads /proc).
+
+Usage: python benchmarks/bench_prefork.py [--workers 1 2 4] [--clients-per-worker 4] [--seconds 60]
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MESSAGES = [
+    "I feel like everything I do is wrong",
+    "I can't sleep because I keep worrying about my exams",
+    "My friends have stopped talking to me and I don't know why",
+    "I get really anxious before meetings at work",
+    "I keep thinking I'm going to fail no matter how hard I try",
+    "Every small mistake makes me feel like a failure",
+]
+
+
+def request_json(url, payload=None, timeout=300):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    req = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None, None
+
+
+def process_tree(root_pid):
+    """root_pid and all of its descendants"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids = [root_pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+
+def memory_mb(pid):
+    """(RSS, PSS) of one process in MB"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            key, _, rest = line.partition(":")
+            if key in ("Rss", "Pss"):
+                values[key] = int(rest.split()[0]) / 1024
+    return values.get("Rss", 0.0), values.get("Pss", 0.0)
+
+
+def wait_ready(base_url, workers, timeout):
+    """Poll /api/health until every worker has reported ready"""
+    ready = set()
+    deadline = time.monotonic() + timeout
+    while len(ready) < workers:
+        if time.monotonic() > deadline:
+            sys.exit(f"Only {len(ready)} of {workers} workers ready after {timeout:.0f}s")
+        status, health = request_json(base_url + "/api/health", timeout=5)
+        if status == 200:
+            ready.add(health["worker"])
+        else:
+            time.sleep(0.5)
+
+
+def drive(base_url, clients, seconds):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client(index):
+        n = 0
+        while time.monotonic() < deadline:
+            # Distinct text per request so the reply cache never answers
+            message = f"{MESSAGES[(index + n) % len(MESSAGES)]} (client {index}, message {n})"
+            n += 1
+            start = time.perf_counter()
+            status, _ = request_json(base_url + "/api/chat", {
+                "messages": [{"role": "user", "content": message}],
+            })
+            elapsed = time.perf_counter() - start
+            with lock:
+                if status == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients-per-worker", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--portable", action="store_true")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--timeout", type=float, default=900)
+    args = parser.parse_args()
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        sys.exit("This benchmark needs Linux /proc/<pid>/smaps_rollup")
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    rows = []
+    for workers in args.workers:
+        print(f"Starting {workers} worker(s)...")
+        command = [sys.executable, "prefork_server.py", "--workers", str(workers), "--port", str(args.port)]
+        if args.portable:
+            command.append("--portable")
+        server = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(base_url, workers, args.timeout)
+            idle = [memory_mb(pid) for pid in process_tree(server.pid)]
+            latencies, errors, elapsed = drive(base_url, workers * args.clients_per_worker, args.seconds)
+            loaded = [memory_mb(pid) for pid in process_tree(server.pid)]
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+
+        latencies.sort()
+        rows.append((
+            workers,
+            sum(rss for rss, _ in idle),
+            sum(pss for _, pss in idle),
+            sum(pss for _, pss in loaded),
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2] if latencies else float("nan"),
+            latencies[int(len(latencies) * 0.95)] if latencies else float("nan"),
+            errors,
+        ))
+
+    print(f"\n{'workers':>7} {'RSS MB':>8} {'PSS MB':>8} {'PSS load':>9} {'req/s':>7} {'p50 s':>6} {'p95 s':>6} {'errors':>6}")
+    for workers, rss, pss, pss_loaded, throughput, p50, p95, errors in rows:
+        print(
+            f"{workers:>7} {rss:>8.0f} {pss:>8.0f} {pss_loaded:>9.0f} "
+            f"{throughput:>7.2f} {p50:>6.1f} {p95:>6.1f} {errors:>6}"
+        )
+
+
+if __name__ == "__main__":
+    main()
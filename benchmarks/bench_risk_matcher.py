@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark: crisis-phrase matching time as the lexicon grows.
+
+Compares the compiled Aho-Corasick matcher (risk_matcher.PhraseMatcher)
+against the old approach of looping re.search over one pattern per phrase,
+on lexicons padded with synthetic phrases up to each requested size.
+Needs no model and runs in a few seconds.
+
+Usage: python benchmarks/bench_risk_matcher.py [--sizes 10 100 1000 10000]
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from risk_matcher import LexiconEntry, PhraseMatcher, load_lexicon  # noqa: E402
+
+MESSAGES = [
+    "I've been feeling really down lately and I don't know who to talk to.",
+    "Work has been stressful but I'm managing, mostly by going for walks.",
+    "Sometimes I feel like nothing I do matters and everyone would be fine without me.",
+    "I no fit sleep at all, my mind dey run up and down every night.",
+    "My exams are next week and I keep panicking whenever I open my notes.",
+    "I had an argument with my mother and now I feel guilty and angry at the same time.",
+    "Ina jin tsoro sosai game da aikina, ban san abin da zan yi ba.",
+    "I think I'm going to end it tonight, I can't do this anymore.",
+]
+WORDS = (
+    "feel want go make life end die hurt tire no fit wan dey am myself my self "
+    "never again tonight alone gone forever rest sleep stop pain ina so mo fe m ga"
+).split()
+
+
+def synthetic_lexicon(base, size, seed=0):
+    """Pad the real lexicon with random 2-5 word phrases up to size entries"""
+    rng = random.Random(seed)
+    entries = list(base[:size])
+    phrases = {entry.phrase for entry in entries}
+    while len(entries) < size:
+        phrase = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        if phrase not in phrases:
+            phrases.add(phrase)
+            entries.append(LexiconEntry(phrase, "und", "synthetic"))
+    return entries
+
+
+def time_per_message(check, repeats):
+    """Microseconds per message for check(message)"""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for message in MESSAGES:
+            check(message)
+    return (time.perf_counter() - start) * 1e6 / (repeats * len(MESSAGES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--lexicon", default=str(ROOT / "data" / "crisis_lexicon.tsv"))
+    args = parser.parse_args()
+
+    base = load_lexicon(args.lexicon)
+
+    print(f"{'phrases':>8} {'compile ms':>11} {'matcher us/msg':>15} {'regex loop us/msg':>18}")
+    for size in args.sizes:
+        entries = synthetic_lexicon(base, size)
+
+        start = time.perf_counter()
+        matcher = PhraseMatcher(entries)
+        compile_ms = (time.perf_counter() - start) * 1000
+
+        patterns = [re.compile(r"\b" + re.escape(entry.phrase) + r"\b") for entry in entries]
+
+        def regex_loop(message):
+            lowered = message.lower()
+            return [pattern for pattern in patterns if pattern.search(lowered)]
+
+        matcher_us = time_per_message(matcher.find_all, args.repeats)
+        regex_us = time_per_message(regex_loop, max(1, args.repeats // 10))
+        print(f"{len(matcher):>8} {compile_ms:>11.1f} {matcher_us:>15.1f} {regex_us:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Benchmark: single-conversation decode speed with and without speculative decoding.
+
+Generates replies to the same prompts one at a time, first with a plain
+inference engine and then with one that has the draft model, and reports
+tokens/s for both, the measured speed-up, the draft acceptance rate and the
+tokens produced per TinyLLaMA forward pass. The automatic switch-off is
+disabled so the raw effect of the draft model is measured.
+
+Usage:
+    python benchmarks/bench_speculative.py [--draft-tokens 4] [--new-tokens 64] [--greedy]
+    python benchmarks/bench_speculative.py --portable    # models from models/
+"""
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+PROMPTS = [
+    "I feel like everything I do is wrong.",
+    "I can't sleep because I keep worrying about my exams.",
+    "My friends have stopped talking to me and I don't know why.",
+    "I get really anxious before meetings at work.",
+    "I keep thinking I'm going to fail no matter how hard I try.",
+    "Every small mistake makes me feel like a failure.",
+]
+
+
+def run(engine, prompts, new_tokens, greedy, eos_token_id):
+    """Generate every reply in turn; returns (tokens, seconds)"""
+    tokens = 0
+    seconds = 0.0
+    for input_ids in prompts:
+        start = time.perf_counter()
+        output = engine.generate(input_ids, new_tokens, eos_token_ids=[eos_token_id], do_sample=not greedy)
+        seconds += time.perf_counter() - start
+        tokens += len(output)
+    return tokens, seconds
+
+
+def main():
+    from model_loader import DRAFT_MODEL_NAME
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--draft-model", default=DRAFT_MODEL_NAME)
+    parser.add_argument("--draft-tokens", type=int, default=4)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--precision", default="float32")
+    parser.add_argument("--greedy", action="store_true", help="greedy decoding instead of the app's sampling")
+    parser.add_argument("--portable", action="store_true", help="load from models/ like app_portable.py")
+    args = parser.parse_args()
+
+    load_kwargs = {}
+    if args.portable:
+        cache_dir = ROOT / "models" / "transformers_cache"
+        os.environ["HF_HOME"] = str(cache_dir)
+        load_kwargs = {"cache_dir": cache_dir, "local_files_only": True}
+
+    from transformers import AutoTokenizer
+
+    from inference_engine import InferenceEngine
+    from model_loader import MODEL_NAME, load_model
+    from speculative import SpeculativeDecoder
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, **load_kwargs)
+    model = load_model(MODEL_NAME, precision=args.precision, **load_kwargs)
+    draft_model = load_model(args.draft_model, precision="float32", **load_kwargs)
+
+    prompts = [
+        tokenizer(tokenizer.apply_chat_template(
+            [{"role": "user", "content": text}], tokenize=False, add_generation_prompt=True
+        ))["input_ids"]
+        for text in PROMPTS
+    ]
+
+    plain = InferenceEngine(model, tokenizer).start()
+    run(plain, prompts[:1], 4, args.greedy, tokenizer.eos_token_id)  # warm-up
+    plain_tokens, plain_seconds = run(plain, prompts, args.new_tokens, args.greedy, tokenizer.eos_token_id)
+    plain.stop()
+
+    draft = SpeculativeDecoder(draft_model, num_tokens=args.draft_tokens, min_acceptance=0.0, retry_seconds=0)
+    speculative = InferenceEngine(model, tokenizer, draft=draft).start()
+    run(speculative, prompts[:1], 4, args.greedy, tokenizer.eos_token_id)
+    spec_tokens, spec_seconds = run(speculative, prompts, args.new_tokens, args.greedy, tokenizer.eos_token_id)
+    speculative.stop()
+    stats = draft.stats()
+
+    plain_rate = plain_tokens / plain_seconds
+    spec_rate = spec_tokens / spec_seconds
+    print(f"\nDraft model {args.draft_model}, {args.draft_tokens} tokens per step, "
+          f"{'greedy' if args.greedy else 'sampling'}")
+    print(f"{'mode':<12} {'tokens':>7} {'tok/s':>7}")
+    print(f"{'plain':<12} {plain_tokens:>7} {plain_rate:>7.1f}")
+    print(f"{'speculative':<12} {spec_tokens:>7} {spec_rate:>7.1f}")
+    print(f"\nSpeed-up {spec_rate / plain_rate:.2f}x, acceptance {draft.accepted / max(draft.proposed, 1):.0%}, "
+          f"{stats['tokens_per_step']:.2f} tokens per TinyLLaMA pass (recent steps)")
+
+
+if __name__ == "__main__":
+    main()
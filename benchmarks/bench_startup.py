@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Benchmark: server start-up time of app.py and app_portable.py.
+
+Launches each app as it is normally run and polls it over HTTP. Reports how
+long the process took to serve the chat page, how long until /api/health
+reported the model ready, and the per-stage load timings from /api/health.
+
+Both apps listen on port 5000, so they are measured one after the other.
+
+Usage: python benchmarks/bench_startup.py [--apps app.py app_portable.py] [--runs 3]
+"""
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BASE_URL = "http://127.0.0.1:5000"
+
+
+def fetch(path):
+    """Return (status, body) for a GET request, or None if nothing is listening"""
+    try:
+        with urllib.request.urlopen(BASE_URL + path, timeout=2) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None
+
+
+def stop(process):
+    # The debug reloader runs the server in a child process; stop both
+    if hasattr(os, "killpg"):
+        os.killpg(process.pid, signal.SIGTERM)
+    else:
+        process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def measure(app_file, timeout):
+    if fetch("/") is not None:
+        sys.exit("Something is already listening on port 5000")
+
+    start = time.perf_counter()
+    popen_kwargs = {"start_new_session": True} if hasattr(os, "killpg") else {}
+    process = subprocess.Popen(
+        [sys.executable, app_file],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        **popen_kwargs,
+    )
+    try:
+        page_seconds = None
+        while time.perf_counter() - start < timeout:
+            if process.poll() is not None:
+                sys.exit(f"{app_file} exited with code {process.returncode}")
+            if page_seconds is None:
+                result = fetch("/")
+                if result is not None and result[0] == 200:
+                    page_seconds = time.perf_counter() - start
+            else:
+                result = fetch("/api/health")
+                if result is not None:
+                    health = json.loads(result[1])
+                    if health["status"] == "ready":
+                        return page_seconds, time.perf_counter() - start, health["progress"]
+                    if health["status"] == "error":
+                        sys.exit(f"{app_file} failed to load: {health['progress']['error']}")
+            time.sleep(0.05)
+        sys.exit(f"{app_file} was not ready after {timeout:.0f}s")
+    finally:
+        stop(process)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--apps", nargs="+", default=["app.py", "app_portable.py"])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--timeout", type=float, default=900)
+    args = parser.parse_args()
+
+    for app_file in args.apps:
+        print(f"\n{app_file}")
+        print(f"{'run':>4} {'page s':>7} {'ready s':>8}  stages")
+        for run in range(1, args.runs + 1):
+            page_seconds, ready_seconds, progress = measure(app_file, args.timeout)
+            stages = "  ".join(f"{stage['name']} {stage['seconds']:.1f}s" for stage in progress["stages"])
+            print(f"{run:>4} {page_seconds:>7.2f} {ready_seconds:>8.1f}  {stages}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Check: /metrics and /api/health answer once the model is ready.
+
+Loads the app with the stub model (nothing downloaded, no draft model unless
+SPECULATIVE_DECODING=1 is set), sends one chat through Flask's test client
+and scrapes /metrics before and after it. Fails when either endpoint does
+not return 200 or a metric is missing from the scrape.
+
+Usage:
+    python benchmarks/check_metrics.py             # app.py
+    python benchmarks/check_metrics.py --portable  # app_portable.py
+"""
+
+import argparse
+import importlib
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# Metrics every scrape must include once the model is ready, and those that
+# appear once a chat has been answered
+READY_METRICS = [
+    "chatbot_tokens_per_second",
+    "chatbot_queue_depth",
+    "chatbot_batch_size",
+    "chatbot_queue_admitted_total",
+    "chatbot_model_ready",
+    "chatbot_model_load_seconds",
+]
+CHAT_METRICS = READY_METRICS + [
+    "chatbot_stage_seconds",
+    "chatbot_tokens_generated_total",
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--portable", action="store_true", help="check app_portable.py instead of app.py")
+    args = parser.parse_args()
+
+    os.environ["MODEL_BACKEND"] = "stub"
+    os.environ.setdefault("STUB_TOKEN_DELAY_MS", "0")
+    app = importlib.import_module("app_portable" if args.portable else "app")
+    if not app.initialize_model():
+        sys.exit(1)
+    client = app.app.test_client()
+    failures = []
+
+    def scrape(when, expected):
+        response = client.get("/metrics")
+        if response.status_code != 200:
+            failures.append(f"/metrics {when}: status {response.status_code}")
+            return
+        text = response.get_data(as_text=True)
+        for name in expected:
+            if f"\n{name}" not in f"\n{text}":
+                failures.append(f"/metrics {when}: {name} missing")
+
+    scrape("before a chat", READY_METRICS)
+    response = client.post("/api/chat", json={"session_id": "check-metrics", "message": "I had a long day at work"})
+    if response.status_code != 200:
+        failures.append(f"/api/chat: status {response.status_code}")
+    scrape("after a chat", CHAT_METRICS)
+    response = client.get("/api/health")
+    if response.status_code != 200:
+        failures.append(f"/api/health: status {response.status_code}")
+
+    if failures:
+        print("FAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print(f"OK (draft model: {'yes' if app.draft_model is not None else 'no'})")
+
+
+if __name__ == "__main__":
+    main()
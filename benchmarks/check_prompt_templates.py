@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Check: prefill token counts of the prompt templates.
+
+Compiles every template in app.PROMPT_TEMPLATES with the tokenizer and
+assembles sample prompts from the pre-tokenized pieces, the way the app
+does. Fails when
+
+- an assembled prompt differs from tokenizing the whole rendered chat
+  template, or
+- a prompt's token count differs from the count recorded for this tokenizer
+  in data/prompt_token_counts.json, or no count is recorded for it
+
+so a change to a system prompt, the chat template or the assembly shows up
+as a changed prefill cost. After an intended change, record the new counts
+with --update.
+
+A model's counts are recorded per transformers major version: transformers 5
+tokenizes Llama's chat turns without the "▁" legacy versions add after each
+</s>, one token less per turn.
+
+Usage:
+    python benchmarks/check_prompt_templates.py             # TinyLLaMA tokenizer from the HF cache
+    python benchmarks/check_prompt_templates.py --portable  # tokenizer from models/
+    python benchmarks/check_prompt_templates.py --stub      # stub_model's tokenizer, nothing downloaded
+    python benchmarks/check_prompt_templates.py --update    # record the current counts
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+COUNTS_PATH = ROOT / "data" / "prompt_token_counts.json"
+
+MESSAGE = "I keep thinking I'm going to get fired even though nobody has said anything."
+HISTORY = [
+    {"role": "user", "content": "I've been really stressed about work lately."},
+    {"role": "assistant", "content": "That sounds exhausting. What part of work feels heaviest right now?"},
+]
+
+# (template, case name, history) of every sample prompt
+CASES = [
+    ("therapeutic", "message", []),
+    ("therapeutic", "history", HISTORY),
+    ("risk", "message", []),
+]
+
+
+def load_tokenizer(args):
+    """(tokenizer, the name its counts are recorded under)"""
+    if args.stub:
+        from stub_model import StubTokenizer
+
+        return StubTokenizer(), "stub"
+
+    import transformers
+    from transformers import AutoTokenizer
+
+    from model_loader import MODEL_NAME
+
+    name = f"{MODEL_NAME} (transformers {transformers.__version__.split('.')[0]})"
+    if args.portable:
+        cache_dir = ROOT / "models" / "transformers_cache"
+        os.environ["HF_HOME"] = str(cache_dir)
+        return AutoTokenizer.from_pretrained(MODEL_NAME, cache_dir=cache_dir, local_files_only=True), name
+    return AutoTokenizer.from_pretrained(MODEL_NAME), name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stub", action="store_true", help="use the stub model's byte-level tokenizer")
+    parser.add_argument("--portable", action="store_true", help="load the tokenizer from models/ like app_portable.py")
+    parser.add_argument("--update", action="store_true", help=f"record the counts in {COUNTS_PATH.relative_to(ROOT)}")
+    args = parser.parse_args()
+
+    import app
+    from prompt_templates import PromptTemplate
+
+    tokenizer, tokenizer_name = load_tokenizer(args)
+    templates = {name: PromptTemplate(tokenizer, name, system) for name, system in app.PROMPT_TEMPLATES.items()}
+
+    recorded_counts = json.loads(COUNTS_PATH.read_text()) if COUNTS_PATH.exists() else {}
+    expected = recorded_counts.get(tokenizer_name, {})
+    counts = {}
+    failures = []
+
+    print(f"Tokenizer: {tokenizer_name}\n")
+    print(f"{'template':<12} {'case':<8} {'fixed':>6} {'prefill':>8} {'recorded':>9}")
+    for name, case, history in CASES:
+        template = templates[name]
+        input_ids = template.encode(MESSAGE, history)
+        key = f"{name}/{case}"
+        counts[key] = len(input_ids)
+
+        if input_ids != template.reference_ids(MESSAGE, history):
+            failures.append(f"{key}: assembled ids differ from tokenizing the rendered prompt")
+        if key in expected and expected[key] != len(input_ids) and not args.update:
+            failures.append(f"{key}: {len(input_ids)} prefill tokens, {expected[key]} recorded")
+        recorded = expected.get(key, "-")
+        print(f"{name:<12} {case:<8} {template.fixed_tokens:>6} {len(input_ids):>8} {recorded:>9}")
+
+    if args.update:
+        recorded_counts[tokenizer_name] = counts
+        COUNTS_PATH.write_text(json.dumps(recorded_counts, indent=2, sort_keys=True) + "\n")
+        print(f"\nRecorded in {COUNTS_PATH}")
+    else:
+        missing = [key for key in counts if key not in expected]
+        if missing:
+            failures.append(f"no counts recorded for {tokenizer_name} ({', '.join(missing)}); record them with --update")
+
+    if failures:
+        print("\nFAILED:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+    print("\nOK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Load test: replay recorded conversations against a running server.
+
+Each line of the JSONL file is one conversation, in any shape
+batch_pipeline.py reads: {"messages": [{"role": "user", "content": ...}, ...]},
+{"message": ..., "history": [...]} or {"request_id": ..., "title": ..., "body": ...}.
+A conversation's user turns are sent to /api/chat one after the other with
+one session_id, as just the new message the way the web page sends them (the
+server keeps the history). With --full-history each request instead carries
+the whole conversation so far, including the replies the server gave.
+Assistant turns in the file are ignored.
+
+Conversations start at --rate per second (Poisson arrivals, seeded) or, with
+--rate 0, as soon as a client is free; at most --concurrency are in flight.
+With a rate, latency is measured from when a turn was due, so time spent
+waiting for a free client counts too. Reports p50/p95/p99 latency, throughput, error rate by status
+and the share of replies that took the crisis path.
+
+For an offline run, start the server with the stub model:
+
+    MODEL_BACKEND=stub STUB_TOKEN_DELAY_MS=20 python app.py
+    python benchmarks/replay_load.py --concurrency 16 --rate 4 --conversations 200
+
+Usage: python benchmarks/replay_load.py [--file data/replay_conversations.jsonl]
+       [--url http://127.0.0.1:5000] [--concurrency 8] [--rate 0] [--conversations 100]
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from batch_pipeline import conversation_messages  # noqa: E402
+
+
+def load_conversations(path):
+    """User turns of each conversation in a JSONL file"""
+    conversations = []
+    skipped = 0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            turns = [
+                m["content"] for m in conversation_messages(record)
+                if isinstance(m, dict) and m.get("role", "user") == "user" and isinstance(m.get("content"), str)
+            ]
+            if turns:
+                conversations.append(turns)
+            else:
+                skipped += 1
+    if skipped:
+        print(f"Skipped {skipped} lines without user messages")
+    return conversations
+
+
+def post_chat(url, payload, timeout):
+    """(status, body) of one /api/chat call; status None if it never got an answer"""
+    data = json.dumps(payload).encode("utf-8")
+    req = urllib.request.Request(url + "/api/chat", data=data, headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except (urllib.error.URLError, ConnectionError, OSError):
+        return None, None
+
+
+def wait_ready(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url + "/api/health", timeout=5) as response:
+                if json.loads(response.read())["status"] == "ready":
+                    return
+        except (urllib.error.URLError, ConnectionError, OSError):
+            # Includes HTTPError: 503 while the model loads
+            pass
+        time.sleep(0.5)
+    sys.exit(f"Server at {url} was not ready after {timeout:.0f}s")
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class Results:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.crisis = 0
+        self.lock = threading.Lock()
+
+    def add(self, status, latency, body):
+        with self.lock:
+            self.statuses[status if status is not None else "no response"] += 1
+            if status == 200:
+                self.latencies.append(latency)
+                if body.get("crisis"):
+                    self.crisis += 1
+
+
+def replay(url, turns, due, results, args, index):
+    """Send one conversation's turns in order; ``due`` is when it should start"""
+    if due is None:
+        due = time.perf_counter()
+    messages = []
+    session_id = uuid.uuid4().hex
+    for turn in turns:
+        if args.unique:
+            # Distinct text per replay so the reply cache never answers
+            turn = f"{turn} (replay {index})"
+        messages.append({"role": "user", "content": turn})
+        if args.full_history:
+            payload = {"messages": messages, "session_id": session_id}
+        else:
+            payload = {"message": turn, "session_id": session_id}
+        status, body = post_chat(url, payload, args.timeout)
+        results.add(status, time.perf_counter() - due, body)
+        if status != 200:
+            return
+        messages.append({"role": "assistant", "content": body["response"]})
+        time.sleep(args.think_time)
+        due = time.perf_counter()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default=str(ROOT / "data" / "replay_conversations.jsonl"))
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=8, help="conversations in flight at most")
+    parser.add_argument("--rate", type=float, default=0, help="conversations started per second, 0 = back to back")
+    parser.add_argument("--conversations", type=int, default=100, help="replayed in file order, repeating the file")
+    parser.add_argument("--think-time", type=float, default=0, help="seconds between a reply and the next turn")
+    parser.add_argument("--unique", action="store_true", help="make every message distinct")
+    parser.add_argument("--full-history", action="store_true", help="send the whole conversation with every turn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--ready-timeout", type=float, default=900)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.file)
+    if not conversations:
+        sys.exit(f"No conversations in {args.file}")
+    url = args.url.rstrip("/")
+    wait_ready(url, args.ready_timeout)
+
+    rng = random.Random(args.seed)
+    results = Results()
+    print(f"Replaying {args.conversations} conversations from {args.file} "
+          f"at concurrency {args.concurrency}, rate {args.rate or 'unlimited'}/s")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        due = start
+        for index in range(args.conversations):
+            if args.rate > 0:
+                due += rng.expovariate(args.rate)
+                time.sleep(max(0.0, due - time.perf_counter()))
+            else:
+                due = None
+            turns = conversations[index % len(conversations)]
+            executor.submit(replay, url, turns, due, results, args, index)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(results.latencies)
+    total = sum(results.statuses.values())
+    errors = total - results.statuses[200]
+    summary = {
+        "requests": total,
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 3),
+        "p50_seconds": round(percentile(latencies, 0.50), 4),
+        "p95_seconds": round(percentile(latencies, 0.95), 4),
+        "p99_seconds": round(percentile(latencies, 0.99), 4),
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "crisis_share": round(results.crisis / len(latencies), 4) if latencies else 0.0,
+        "statuses": {str(status): count for status, count in results.statuses.items()},
+    }
+
+    print(f"\n{'requests':>8} {'req/s':>7} {'p50 s':>7} {'p95 s':>7} {'p99 s':>7} {'errors':>7} {'crisis':>7}")
+    print(
+        f"{total:>8} {summary['throughput_rps']:>7.2f} {summary['p50_seconds']:>7.2f} "
+        f"{summary['p95_seconds']:>7.2f} {summary['p99_seconds']:>7.2f} "
+        f"{summary['error_rate']:>7.1%} {summary['crisis_share']:>7.1%}"
+    )
+    print("Statuses: " + ", ".join(f"{status} x{count}" for status, count in summary["statuses"].items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+CPU thread settings measured for this machine.
+
+PyTorch's defaults (an intra-op thread per core, no core pinning) are rarely
+the fastest way to run a 1.1B model, and the best split of the cores between
+pre-forked workers depends on the host. Running this file as a command tries
+combinations of
+
+- intra-op threads per process (torch.set_num_threads)
+- inter-op threads per process (torch.set_num_interop_threads)
+- pinning each process to its own cores (os.sched_setaffinity, Linux)
+- worker counts, when given --workers
+
+on a fixed set of prompts and measures generated tokens/s and p95 request
+latency. Each combination runs in a fresh process, loading the weights once
+and forking its workers the way prefork_server.py does. The fastest
+combination is written to cpu_tuning.json:
+
+- "single_process": the best with one worker, applied by app.py,
+  app_portable.py and batch_pipeline.py at startup
+- "prefork": the best of all, whose worker count prefork_server.py uses
+  when --workers is not given
+
+A file measured on another CPU, with another core count or with another
+model backend or precision is ignored. CPU_TUNING_PATH points the apps at
+another file; empty turns tuning off.
+
+Usage:
+    python cpu_tuning.py                            # one process, threads/pinning only
+    python cpu_tuning.py --workers 1 2 4            # also worker counts for prefork_server.py
+    python cpu_tuning.py --max-p95 8                # fastest whose p95 latency is at most 8s
+    python cpu_tuning.py --portable                 # app_portable.py's model cache
+"""
+
+import argparse
+import gc
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# Prompts every combination is measured on; each request also gets a risk
+# check, like a chat message
+PROMPTS = [
+    "I feel like everything I do is wrong",
+    "I can't sleep because I keep worrying about my exams",
+    "My friends have stopped talking to me and I don't know why",
+    "I get really anxious before meetings at work",
+    "I keep thinking I'm going to fail no matter how hard I try",
+    "Every small mistake makes me feel like a failure",
+    "I've been really stressed about work lately and it's affecting my family",
+    "Sometimes I feel like nobody would notice if I wasn't around",
+]
+
+
+def core_ids():
+    """CPU cores this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_model():
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def describe_setup(backend, precision):
+    """What a tuning result is only valid for"""
+    return {"cpu": cpu_model(), "cores": len(core_ids()), "backend": backend, "precision": precision}
+
+
+def worker_cores(settings, rank):
+    """The cores worker rank is pinned to: its share of the machine, one per thread"""
+    cores = core_ids()
+    share = max(1, len(cores) // settings["workers"])
+    # Wraps around when there are more workers than cores
+    return [cores[(rank * share + i) % len(cores)] for i in range(min(share, settings["threads"]))]
+
+
+def load_cpu_config(path, mode, backend, precision):
+    """The "single_process" or "prefork" settings tuned for this machine, or None"""
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, encoding="utf-8") as f:
+            config = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Ignoring CPU tuning in {path}: {e}")
+        return None
+
+    setup = describe_setup(backend, precision)
+    if config.get("setup") != setup:
+        print(f"Ignoring CPU tuning in {path}: measured for {config.get('setup')}, this is {setup}")
+        return None
+    return config.get(mode)
+
+
+def apply_cpu_config(settings, rank=0):
+    """Apply thread settings to this process before the model runs
+
+    Pinning applies to the calling thread and the threads it starts
+    afterwards, so call this from the thread that goes on to load the model
+    and start the inference engine.
+    """
+    import torch
+
+    pinned = ""
+    if settings.get("pin_cores") and hasattr(os, "sched_setaffinity"):
+        cores = worker_cores(settings, rank)
+        os.sched_setaffinity(0, cores)
+        pinned = f", pinned to cores {','.join(map(str, cores))}"
+    torch.set_num_threads(settings["threads"])
+    if settings.get("interop_threads"):
+        try:
+            torch.set_num_interop_threads(settings["interop_threads"])
+        except RuntimeError as e:
+            # Only possible before the inter-op pool has started
+            print(f"Inter-op threads left at {torch.get_num_interop_threads()}: {e}")
+    print(f"CPU settings: {torch.get_num_threads()} threads, {torch.get_num_interop_threads()} inter-op threads{pinned}")
+
+
+def run_request(app, message, new_tokens):
+    """Seconds and generated tokens of a risk check plus a fixed-length greedy reply"""
+    start = time.perf_counter()
+    app.score_risk(message)
+    generation = app.inference_engine.submit(
+        app.build_therapeutic_prompt(message, []),
+        new_tokens,
+        prefix=app.prefix_cache.get("therapeutic"),
+        do_sample=False,
+    )
+    generation.result()
+    return time.perf_counter() - start, len(generation.generated_ids)
+
+
+def measure_worker(app, settings, rank, args, ready_fd, go_fd):
+    """Run in a forked child: set up, wait for the others, then time the prompt set"""
+    apply_cpu_config(settings, rank)
+    if not app.initialize_model():
+        raise RuntimeError("model failed to load")
+    run_request(app, "Hello, I just wanted to talk", args.new_tokens)
+
+    # Numbered so the risk verdict cache never answers
+    messages = [f"{PROMPTS[i % len(PROMPTS)]} (request {i})" for i in range(args.requests)]
+    os.write(ready_fd, b"r")
+    if not os.read(go_fd, 1):
+        raise RuntimeError("another worker failed to start")
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        timings = list(pool.map(lambda message: run_request(app, message, args.new_tokens), messages))
+    return {
+        "start": start,
+        "end": time.monotonic(),
+        "latencies": [seconds for seconds, _ in timings],
+        "tokens": sum(tokens for _, tokens in timings),
+    }
+
+
+def measure(app, settings, args):
+    """Load the weights once, fork the workers and time them all together"""
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    import torch
+
+    # No intra-op thread pool may exist at fork time (see prefork_server.py)
+    torch.set_num_threads(1)
+    if app.MODEL_BACKEND != "onnx":
+        app.load_weights()
+        if app.SPECULATIVE_DECODING:
+            app.load_draft_weights()
+    gc.collect()
+    gc.freeze()
+
+    children = []
+    for rank in range(settings["workers"]):
+        ready_read, ready_write = os.pipe()
+        go_read, go_write = os.pipe()
+        result_read, result_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Only the parent may hold the other ends, or a failed worker
+            # would go unnoticed
+            for fd in [ready_read, go_write, result_read] + [fd for child in children for fd in child[1:]]:
+                os.close(fd)
+            code = 0
+            try:
+                result = measure_worker(app, settings, rank, args, ready_write, go_read)
+                os.write(result_write, json.dumps(result).encode("utf-8"))
+            except Exception as e:
+                print(f"Worker {rank + 1} failed: {e}", file=sys.stderr)
+                code = 1
+            finally:
+                os._exit(code)
+        for fd in (ready_write, go_read, result_write):
+            os.close(fd)
+        children.append((pid, ready_read, go_write, result_read))
+
+    # Start timing once every worker is warmed up; if one failed, closing
+    # the pipes releases the others
+    ready = [os.read(ready_read, 1) for _, ready_read, _, _ in children]
+    for _, ready_read, go_write, _ in children:
+        if all(ready):
+            os.write(go_write, b"g")
+        os.close(go_write)
+        os.close(ready_read)
+
+    results = []
+    for pid, _, _, result_read in children:
+        data = b""
+        while chunk := os.read(result_read, 65536):
+            data += chunk
+        os.close(result_read)
+        os.waitpid(pid, 0)
+        if data:
+            results.append(json.loads(data))
+    if len(results) != len(children):
+        sys.exit(f"{len(children) - len(results)} of {len(children)} workers failed")
+
+    latencies = sorted(seconds for result in results for seconds in result["latencies"])
+    elapsed = max(result["end"] for result in results) - min(result["start"] for result in results)
+    return {
+        "tokens_per_second": round(sum(result["tokens"] for result in results) / elapsed, 2),
+        "p50_seconds": round(latencies[len(latencies) // 2], 3),
+        "p95_seconds": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+    }
+
+
+def candidates(args, cores):
+    """Every combination of settings to measure"""
+    pinning = [False, True] if hasattr(os, "sched_setaffinity") and not args.no_pin else [False]
+    for workers in args.workers:
+        share = cores // workers
+        if share < 1:
+            print(f"Skipping {workers} workers: only {cores} cores")
+            continue
+        threads_options = args.threads or sorted({share, max(1, share // 2), max(1, share // 4)}, reverse=True)
+        for threads in threads_options:
+            if threads > share:
+                continue
+            for interop_threads in args.interop_threads:
+                for pin_cores in pinning:
+                    # Pinning one process to every core changes nothing
+                    if pin_cores and workers == 1 and threads == cores:
+                        continue
+                    yield {"workers": workers, "threads": threads, "interop_threads": interop_threads, "pin_cores": pin_cores}
+
+
+def run_candidate(settings, args):
+    """Measure one combination in a fresh process; None if it failed"""
+    command = [sys.executable, str(Path(__file__).resolve()), "--measure", json.dumps(settings)]
+    command += ["--requests", str(args.requests), "--concurrency", str(args.concurrency)]
+    command += ["--new-tokens", str(args.new_tokens)]
+    if args.portable:
+        command.append("--portable")
+    try:
+        completed = subprocess.run(
+            command, cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=args.timeout
+        )
+    except subprocess.TimeoutExpired:
+        print(f"  timed out after {args.timeout:.0f}s")
+        return None
+    for line in reversed(completed.stdout.splitlines()):
+        if line.startswith("RESULT "):
+            return json.loads(line[len("RESULT "):])
+    print("  failed:\n    " + "\n    ".join(completed.stdout.splitlines()[-10:]))
+    return None
+
+
+def pick_best(rows, max_p95):
+    """Highest tokens/s within the p95 limit, or the lowest p95 if none is"""
+    if not rows:
+        return None
+    within = [row for row in rows if max_p95 is None or row["p95_seconds"] <= max_p95]
+    if within:
+        return max(within, key=lambda row: (row["tokens_per_second"], -row["p95_seconds"]))
+    return min(rows, key=lambda row: row["p95_seconds"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1], help="worker counts to try (default: 1)")
+    parser.add_argument("--threads", type=int, nargs="+", help="intra-op threads per worker (default: its cores, 1/2, 1/4)")
+    parser.add_argument("--interop-threads", type=int, nargs="+", default=[1, 2], help="inter-op threads per worker")
+    parser.add_argument("--no-pin", action="store_true", help="do not try pinning workers to cores")
+    parser.add_argument("--requests", type=int, default=16, help="requests per worker for each combination")
+    parser.add_argument("--concurrency", type=int, default=4, help="requests in flight per worker")
+    parser.add_argument("--new-tokens", type=int, default=32, help="tokens generated per request")
+    parser.add_argument("--max-p95", type=float, help="p95 latency limit in seconds for the chosen combination")
+    parser.add_argument("--portable", action="store_true", help="use app_portable.py instead of app.py")
+    parser.add_argument("--output", help="file to write (default: the apps' CPU_TUNING_PATH)")
+    parser.add_argument("--timeout", type=float, default=1800, help="seconds allowed per combination")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not hasattr(os, "fork"):
+        sys.exit("cpu_tuning.py needs os.fork (Linux or macOS)")
+
+    app = importlib.import_module("app_portable" if args.portable else "app")
+    if args.measure:
+        print("RESULT " + json.dumps(measure(app, json.loads(args.measure), args)), flush=True)
+        return
+
+    output = args.output or app.CPU_TUNING_PATH
+    if not output:
+        sys.exit("CPU_TUNING_PATH is empty; pass --output")
+    setup = describe_setup(app.MODEL_BACKEND, app.MODEL_PRECISION)
+    print(f"Tuning for {setup['cpu']} ({setup['cores']} cores), backend {setup['backend']}, precision {setup['precision']}")
+
+    rows = []
+    for settings in candidates(args, setup["cores"]):
+        print(
+            f"{settings['workers']} workers x {settings['threads']} threads, "
+            f"{settings['interop_threads']} inter-op, {'pinned' if settings['pin_cores'] else 'not pinned'}...",
+            flush=True,
+        )
+        result = run_candidate(settings, args)
+        if result is not None:
+            rows.append({**settings, **result})
+
+    print(f"\n{'workers':>7} {'threads':>7} {'interop':>7} {'pinned':>6} {'tok/s':>8} {'p50 s':>6} {'p95 s':>6}")
+    for row in rows:
+        print(
+            f"{row['workers']:>7} {row['threads']:>7} {row['interop_threads']:>7} {'yes' if row['pin_cores'] else 'no':>6} "
+            f"{row['tokens_per_second']:>8.1f} {row['p50_seconds']:>6.2f} {row['p95_seconds']:>6.2f}"
+        )
+
+    single_process = pick_best([row for row in rows if row["workers"] == 1], args.max_p95)
+    prefork = pick_best(rows, args.max_p95)
+    if prefork is None:
+        sys.exit("No combination completed; nothing written")
+
+    config = {
+        "setup": setup,
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "single_process": single_process,
+        "prefork": prefork,
+        "results": rows,
+    }
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+        f.write("\n")
+
+    for mode, best in (("single_process", single_process), ("prefork", prefork)):
+        if best is not None:
+            print(
+                f"{mode}: {best['workers']} workers x {best['threads']} threads, {best['interop_threads']} inter-op, "
+                f"{'pinned' if best['pin_cores'] else 'not pinned'} ({best['tokens_per_second']:.1f} tok/s, "
+                f"p95 {best['p95_seconds']:.2f}s)"
+            )
+    print(f"Written to {output}")
+
+
+if __name__ == "__main__":
+    main()
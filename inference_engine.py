@@ -0,0 +1,547 @@
+"""
+Continuous batching inference engine for TinyLLaMA.
+
+A single background worker owns the model. Prompts submitted from concurrent
+Flask request threads are prefilled as they arrive and then join a shared
+decode batch, so every decode step advances all in-flight conversations with
+one forward pass. Finished sequences leave the batch immediately and waiting
+ones take their place without stalling the others.
+
+Waiting prompts are queued by priority. "high" requests (risk checks) are
+always admitted before "normal" ones (chat replies), even when the decode
+batch is full, so they never wait behind ordinary generations. Each priority
+has its own bounded queue. When it is full, submit() raises
+QueueFull right away instead of letting work pile up, and prompts that
+waited longer than ``max_wait_seconds`` are dropped with QueueTimeout, so
+latency stays bounded under overload. Both carry a suggested retry delay.
+
+The batch KV cache is kept left-padded: every row has the same length and a
+decode step appends one column to all rows, so the cache only has to be
+re-laid-out when a sequence joins or leaves.
+
+With a speculative.SpeculativeDecoder, a request decoding on its own is
+advanced several tokens per forward pass with a small draft model.
+"""
+
+import math
+import queue
+import re
+import threading
+import time
+from collections import deque
+
+import torch
+
+from kv_cache import from_legacy_cache, to_legacy_cache
+
+
+# Queue priorities, highest first
+PRIORITIES = ("high", "normal")
+
+
+def _left_pad(tensor, length, dim):
+    """Left-pad a tensor with zeros along ``dim`` up to ``length``"""
+    missing = length - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    padding = torch.zeros(shape, dtype=tensor.dtype, device=tensor.device)
+    return torch.cat([padding, tensor], dim=dim)
+
+
+def next_token_distribution(request, logits, context_ids):
+    """The request's sampling distribution for the token after ``context_ids``
+
+    Returns the logits after the repetition penalty and the probabilities
+    after temperature and top-p, or None instead of probabilities for greedy
+    requests.
+    """
+    logits = logits.float().clone()
+
+    if request.repetition_penalty != 1.0:
+        seen = torch.tensor(sorted(set(context_ids)), device=logits.device)
+        scores = logits[seen]
+        logits[seen] = torch.where(
+            scores < 0, scores * request.repetition_penalty, scores / request.repetition_penalty
+        )
+
+    if not request.do_sample:
+        return logits, None
+
+    logits = logits / request.temperature
+    if request.top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+        probs = torch.softmax(sorted_logits, dim=-1)
+        # Drop tokens outside the nucleus, always keeping the most likely one
+        remove = (torch.cumsum(probs, dim=-1) - probs) > request.top_p
+        sorted_logits[remove] = float("-inf")
+        logits = torch.full_like(logits, float("-inf")).scatter(0, sorted_indices, sorted_logits)
+
+    return logits, torch.softmax(logits, dim=-1)
+
+
+class GenerationCancelled(Exception):
+    """Raised by a request's result()/stream() after it was cancelled"""
+
+
+class EngineOverloaded(Exception):
+    """The engine cannot take on the request now; retry after ``retry_after`` seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFull(EngineOverloaded):
+    """Raised by submit() when the waiting queue is full"""
+
+
+class QueueTimeout(EngineOverloaded):
+    """Raised by result()/stream() when a request waited too long to be admitted"""
+
+
+class StopOnSentences:
+    """Stop criterion: the reply holds enough sentences or ends its turn
+
+    Decoding stops as soon as ``max_sentences`` sentences are complete or the
+    model starts writing one of ``end_markers`` (e.g. the next ``<|user|>``
+    turn), instead of running to the token budget and trimming afterwards.
+    """
+
+    # A run of terminators ends a sentence unless it follows a digit ("1.")
+    SENTENCE_END = re.compile(r"(?<!\d)[.!?]+(?=\s|$)")
+
+    def __init__(self, tokenizer, max_sentences, end_markers=()):
+        self.tokenizer = tokenizer
+        self.max_sentences = max_sentences
+        self.end_markers = tuple(end_markers)
+
+    def __call__(self, request):
+        text = self.tokenizer.decode(request.generated_ids, skip_special_tokens=True)
+        if any(marker in text for marker in self.end_markers):
+            return True
+        return len(self.SENTENCE_END.findall(text)) >= self.max_sentences
+
+
+class GenerationRequest:
+    """A prompt waiting for (or going through) generation in the engine"""
+
+    def __init__(self, input_ids, max_new_tokens, eos_token_ids=(), do_sample=True,
+                 temperature=0.7, top_p=0.9, repetition_penalty=1.1, prefix=None, keep_cache=False,
+                 stop_checker=None, score_token_ids=None, priority="normal"):
+        self.input_ids = list(input_ids)
+        self.priority = priority
+        self.prefix = prefix
+        self.keep_cache = keep_cache
+        self.stop_checker = stop_checker
+        self.score_token_ids = score_token_ids
+        self.scores = None  # next-token logits of score_token_ids, for scoring requests
+        self.past_key_values = None  # set on finish when keep_cache is True
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = set(eos_token_ids)
+        self.do_sample = do_sample
+        self.temperature = temperature
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+
+        self.generated_ids = []
+        self.finish_reason = None
+        self.error = None
+
+        self.submitted_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+        self.finished_at = None
+        self.cancelled = False
+        self._done = threading.Event()
+        self._tokens = queue.Queue()  # feeds stream(); None marks the end
+
+    @property
+    def context_length(self):
+        return len(self.input_ids) + len(self.generated_ids)
+
+    @property
+    def token_ids(self):
+        return self.input_ids + self.generated_ids
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Block until generation finishes and return the new token ids"""
+        if not self._done.wait(timeout):
+            raise TimeoutError("Generation did not finish in time")
+        if self.error is not None:
+            raise self.error
+        return self.generated_ids
+
+    def stream(self, timeout=None):
+        """Yield new token ids as soon as the engine produces them"""
+        while True:
+            try:
+                token_id = self._tokens.get(timeout=timeout)
+            except queue.Empty:
+                raise TimeoutError("No token produced in time")
+            if token_id is None:
+                break
+            yield token_id
+        if self.error is not None:
+            raise self.error
+
+    def cancel(self):
+        """Stop generating; the engine drops the request at its next step"""
+        self.cancelled = True
+
+    def _append(self, token_id):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.generated_ids.append(token_id)
+        self._tokens.put(token_id)
+        if token_id in self.eos_token_ids:
+            self.finish_reason = "eos"
+        elif len(self.generated_ids) >= self.max_new_tokens:
+            self.finish_reason = "length"
+        elif self.stop_checker is not None and self.stop_checker(self):
+            self.finish_reason = "stop"
+
+    def _finish(self, error=None):
+        self.error = error
+        if error is not None and self.finish_reason is None:
+            self.finish_reason = "error"
+        self.finished_at = time.perf_counter()
+        self._done.set()
+        self._tokens.put(None)
+
+
+class InferenceEngine:
+    """Background worker that decodes all in-flight requests as one batch"""
+
+    def __init__(self, model, tokenizer, max_batch_size=8, max_queue=32, max_wait_seconds=60, draft=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.draft = draft  # speculative.SpeculativeDecoder, used while one request decodes
+        self.max_batch_size = max_batch_size
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self.device = next(model.parameters()).device
+
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._waits = deque(maxlen=256)  # queue wait of recently dequeued requests, in seconds
+        self._stats_lock = threading.Lock()
+
+        self._pending = {priority: deque() for priority in PRIORITIES}
+        self._pending_ready = threading.Condition()
+        self._active = []            # requests in batch row order
+        self._past = None            # per-layer (key, value), shape [B, H, T, D]
+        self._attention_mask = None  # [B, T], zeros mark left padding
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="inference-engine", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, input_ids, max_new_tokens, prefix=None, **options):
+        """Queue a tokenized prompt and return its GenerationRequest
+
+        ``prefix`` is an optional kv_cache.PrefixEntry whose ids start
+        ``input_ids``; only the tokens after it are prefilled. With
+        ``keep_cache`` the request's key/values are handed back on
+        ``request.past_key_values`` when it finishes. ``stop_checker`` is
+        called with the request after every token and ends it early when it
+        returns True. ``priority`` is one of PRIORITIES.
+        """
+        if prefix is not None and (
+            prefix.length >= len(input_ids) or list(input_ids[:prefix.length]) != prefix.input_ids
+        ):
+            prefix = None
+        request = GenerationRequest(input_ids, max_new_tokens, prefix=prefix, **options)
+        if request.priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority '{request.priority}', expected one of {', '.join(PRIORITIES)}")
+
+        with self._pending_ready:
+            pending = self._pending[request.priority]
+            full = self.max_queue and len(pending) >= self.max_queue
+            if not full:
+                pending.append(request)
+                self._pending_ready.notify()
+        if full:
+            with self._stats_lock:
+                self.rejected += 1
+            raise QueueFull("The inference queue is full", self.retry_after())
+        return request
+
+    def generate(self, input_ids, max_new_tokens, timeout=None, prefix=None, **options):
+        """Submit a prompt and wait for its generated token ids"""
+        return self.submit(input_ids, max_new_tokens, prefix=prefix, **options).result(timeout)
+
+    def score(self, input_ids, token_ids, timeout=None, prefix=None, priority="normal"):
+        """Next-token logits of ``token_ids`` after the prompt, from one prefill"""
+        request = self.submit(input_ids, 0, prefix=prefix, score_token_ids=list(token_ids), priority=priority)
+        request.result(timeout)
+        return request.scores
+
+    @property
+    def batch_size(self):
+        return len(self._active)
+
+    @property
+    def queue_depth(self):
+        with self._pending_ready:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def retry_after(self):
+        """Suggested seconds before retrying a rejected request
+
+        Based on how long recently dequeued requests waited, which is about
+        how long the current queue takes to drain.
+        """
+        with self._stats_lock:
+            waits = sorted(self._waits)
+        median = waits[len(waits) // 2] if waits else 1.0
+        return max(1, min(int(math.ceil(median)), 60))
+
+    def stats(self):
+        """Queue and batch occupancy, plus wait times of recently dequeued requests"""
+        with self._stats_lock:
+            waits = sorted(self._waits)
+            stats = {
+                "queue_depth": self.queue_depth,
+                "queue_depth_by_priority": {priority: len(pending) for priority, pending in self._pending.items()},
+                "max_queue": self.max_queue,
+                "batch_size": self.batch_size,
+                "max_batch_size": self.max_batch_size,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+            }
+        stats["wait_seconds"] = {
+            "mean": sum(waits) / len(waits) if waits else 0.0,
+            "p50": waits[len(waits) // 2] if waits else 0.0,
+            "p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            "max": waits[-1] if waits else 0.0,
+        }
+        if self.draft is not None:
+            stats["speculative"] = self.draft.stats()
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._admit(block=not self._active)
+            if self._active:
+                try:
+                    self._decode_step()
+                except Exception as e:
+                    print(f"Error in decode step: {e}")
+                    self._fail_active(e)
+
+    def _take(self, block, include_normal):
+        """Pop the next waiting request, highest priority first, or None"""
+        with self._pending_ready:
+            if block and not any(self._pending.values()):
+                self._pending_ready.wait(timeout=0.1)
+            for priority in PRIORITIES:
+                if priority == "normal" and not include_normal:
+                    break
+                if self._pending[priority]:
+                    return self._pending[priority].popleft()
+        return None
+
+    def _admit(self, block):
+        """Prefill waiting requests
+
+        High-priority requests are admitted even when the batch is full (risk
+        checks are mostly single prefills that never join it); normal ones
+        only while there is room.
+        """
+        while True:
+            request = self._take(block, include_normal=len(self._active) < self.max_batch_size)
+            if request is None:
+                return
+            block = False
+            if request.cancelled:
+                self._cancel(request)
+                continue
+
+            request.admitted_at = time.perf_counter()
+            wait = request.admitted_at - request.submitted_at
+            with self._stats_lock:
+                self._waits.append(wait)
+            if self.max_wait_seconds and wait > self.max_wait_seconds:
+                # The caller has most likely given up; don't spend the batch on it
+                with self._stats_lock:
+                    self.expired += 1
+                request.finish_reason = "expired"
+                request._finish(error=QueueTimeout("Request waited too long in the queue", self.retry_after()))
+                continue
+            with self._stats_lock:
+                self.admitted += 1
+            try:
+                self._prefill(request)
+            except Exception as e:
+                print(f"Error in prefill: {e}")
+                request._finish(error=e)
+
+    @torch.inference_mode()
+    def _prefill(self, request):
+        if request.prefix is None:
+            input_ids = torch.tensor([request.input_ids], device=self.device)
+            outputs = self.model(input_ids=input_ids, use_cache=True)
+        else:
+            # Start from the cached prefix and only run the variable suffix
+            start = request.prefix.length
+            input_ids = torch.tensor([request.input_ids[start:]], device=self.device)
+            outputs = self.model(
+                input_ids=input_ids,
+                attention_mask=torch.ones(1, len(request.input_ids), dtype=torch.long, device=self.device),
+                position_ids=torch.arange(start, len(request.input_ids), device=self.device).unsqueeze(0),
+                past_key_values=from_legacy_cache(request.prefix.past_key_values),
+                use_cache=True,
+            )
+
+        if request.score_token_ids is not None:
+            # Scoring requests only need the prefill logits
+            request.scores = outputs.logits[0, -1, request.score_token_ids].float().tolist()
+            request._finish()
+            return
+
+        request._append(self._sample(request, outputs.logits[0, -1]))
+
+        past = to_legacy_cache(outputs.past_key_values)
+        if request.finish_reason is not None:
+            if request.keep_cache:
+                request.past_key_values = past
+            request._finish()
+            return
+        self._join(request, past)
+
+    def _join(self, request, past):
+        """Add a prefilled request to the decode batch"""
+        length = past[0][0].shape[2]
+        mask = torch.ones(1, length, dtype=torch.long, device=self.device)
+
+        if not self._active:
+            self._past = past
+            self._attention_mask = mask
+        else:
+            total = max(self._attention_mask.shape[1], length)
+            self._past = tuple(
+                (
+                    torch.cat([_left_pad(batch_key, total, 2), _left_pad(key, total, 2)]),
+                    torch.cat([_left_pad(batch_value, total, 2), _left_pad(value, total, 2)]),
+                )
+                for (batch_key, batch_value), (key, value) in zip(self._past, past)
+            )
+            self._attention_mask = torch.cat(
+                [_left_pad(self._attention_mask, total, 1), _left_pad(mask, total, 1)]
+            )
+        self._active.append(request)
+
+    @torch.inference_mode()
+    def _decode_step(self):
+        """Advance every active request by one token"""
+        cancelled = [row for row, request in enumerate(self._active) if request.cancelled]
+        if cancelled:
+            self._evict(cancelled)
+            if not self._active:
+                return
+
+        single = len(self._active) == 1 and bool(self._attention_mask.all())
+        if self.draft is not None and single and self.draft.wants(self._active[0]):
+            self._past = self.draft.step(self.model, self._active[0], self._past)
+            self._attention_mask = self._attention_mask.new_ones(1, self._past[0][0].shape[2])
+            if self._active[0].finish_reason is not None:
+                self._evict([0])
+            return
+
+        start = time.perf_counter()
+        input_ids = torch.tensor([[r.generated_ids[-1]] for r in self._active], device=self.device)
+        position_ids = torch.tensor([[r.context_length - 1] for r in self._active], device=self.device)
+        attention_mask = torch.cat(
+            [self._attention_mask, self._attention_mask.new_ones(len(self._active), 1)], dim=1
+        )
+
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=from_legacy_cache(self._past),
+            use_cache=True,
+        )
+        self._past = to_legacy_cache(outputs.past_key_values)
+        self._attention_mask = attention_mask
+
+        finished = []
+        for row, request in enumerate(self._active):
+            request._append(self._sample(request, outputs.logits[row, -1]))
+            if request.finish_reason is not None:
+                finished.append(row)
+        if self.draft is not None and single:
+            self.draft.record_plain_step(time.perf_counter() - start)
+
+        if finished:
+            self._evict(finished)
+
+    def _evict(self, rows):
+        """Remove finished rows from the batch and trim shared padding"""
+        for row in rows:
+            request = self._active[row]
+            if request.cancelled:
+                self._cancel(request)
+                continue
+            if request.keep_cache:
+                # Copy the row without its left padding so the batch can be freed
+                start = int(self._attention_mask[row].nonzero()[0])
+                request.past_key_values = tuple(
+                    (key[row:row + 1, :, start:].clone(), value[row:row + 1, :, start:].clone())
+                    for key, value in self._past
+                )
+            request._finish()
+
+        keep = [row for row in range(len(self._active)) if row not in rows]
+        self._active = [self._active[row] for row in keep]
+        if not self._active:
+            self._past = None
+            self._attention_mask = None
+            return
+
+        index = torch.tensor(keep, device=self.device)
+        mask = self._attention_mask.index_select(0, index)
+        # Columns that are padding in every remaining row can be dropped
+        offset = int(mask.any(dim=0).nonzero()[0])
+        self._attention_mask = mask[:, offset:]
+        self._past = tuple(
+            (key.index_select(0, index)[:, :, offset:], value.index_select(0, index)[:, :, offset:])
+            for key, value in self._past
+        )
+
+    def _cancel(self, request):
+        request.finish_reason = "cancelled"
+        request._finish(error=GenerationCancelled("Generation was cancelled"))
+
+    def _fail_active(self, error):
+        for request in self._active:
+            request._finish(error=error)
+        self._active = []
+        self._past = None
+        self._attention_mask = None
+
+    def _sample(self, request, logits):
+        """Pick the next token with the same settings as the HF pipeline"""
+        logits, probs = next_token_distribution(request, logits, request.input_ids + request.generated_ids)
+        if probs is None:
+            return int(torch.argmax(logits))
+        return int(torch.multinomial(probs, num_samples=1))
@@ -0,0 +1,195 @@
+"""
+Reusable attention (KV) caches for TinyLLaMA prompts.
+
+Every prompt of a template (see prompt_templates.py) starts with the same
+tokens: the chat template's opening and the long therapeutic or
+risk-assessment instructions. The past key/values for those prefixes are
+computed once at startup so each request only has to prefill what follows.
+
+Conversations also keep the attention state of their previous turn, so a new
+turn only prefills the part of the prompt that changed since then.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+from transformers import DynamicCache
+
+# Text the continuation encoder anchors on. Chat turns open with a newline,
+# so encoding "\n" + text and dropping the anchor tokens yields the ids the
+# text gets when the whole prompt is tokenized at once.
+_ANCHOR = "\n"
+
+
+def encode_continuation(tokenizer, text):
+    """Tokenize text that continues a prompt after a newline"""
+    anchor_ids = tokenizer(_ANCHOR, add_special_tokens=False)["input_ids"]
+    ids = tokenizer(_ANCHOR + text, add_special_tokens=False)["input_ids"]
+    if ids[:len(anchor_ids)] == anchor_ids:
+        return ids[len(anchor_ids):]
+    return tokenizer(text, add_special_tokens=False)["input_ids"]
+
+
+def to_legacy_cache(past_key_values):
+    """Convert a model cache object to per-layer (key, value) tuples"""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    if hasattr(past_key_values, "layers"):
+        # transformers 5 dropped the legacy converters; read the layers
+        return tuple((layer.keys, layer.values) for layer in past_key_values.layers)
+    return tuple(past_key_values)
+
+
+def from_legacy_cache(past_key_values):
+    """Wrap per-layer (key, value) tuples in the cache type the model expects"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(tuple(past_key_values))
+    # transformers 5: fill an empty cache layer by layer
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(past_key_values):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def cache_nbytes(past_key_values):
+    """Memory held by per-layer (key, value) tuples, in bytes"""
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past_key_values
+    )
+
+
+class PrefixEntry:
+    """Token ids and past key/values of one constant prompt prefix"""
+
+    def __init__(self, name, input_ids, past_key_values):
+        self.name = name
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+
+    @property
+    def length(self):
+        return len(self.input_ids)
+
+
+class PrefixCache:
+    """Precomputed KV caches for prompt templates, keyed by template name"""
+
+    def __init__(self, model):
+        self.model = model
+        self.entries = {}
+
+    @torch.inference_mode()
+    def register(self, name, input_ids):
+        """Prefill a constant prefix once and keep its key/values"""
+        device = next(self.model.parameters()).device
+        outputs = self.model(input_ids=torch.tensor([input_ids], device=device), use_cache=True)
+        entry = PrefixEntry(name, list(input_ids), to_legacy_cache(outputs.past_key_values))
+        self.entries[name] = entry
+        return entry
+
+    def get(self, name):
+        """The prefix registered for a template, or None"""
+        return self.entries.get(name)
+
+    @property
+    def nbytes(self):
+        return sum(cache_nbytes(entry.past_key_values) for entry in self.entries.values())
+
+
+def _common_prefix_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class _SessionEntry:
+    def __init__(self, input_ids, past_key_values):
+        self.input_ids = input_ids
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+        self.last_used = time.monotonic()
+
+
+class SessionKVCache:
+    """Attention state of each conversation's last turn, with LRU eviction
+
+    Entries are evicted least-recently-used first once their total size
+    exceeds ``max_mb``, and dropped after ``idle_seconds`` without a turn.
+    """
+
+    def __init__(self, max_mb=256, idle_seconds=900):
+        self.max_bytes = int(max_mb * 2**20)
+        self.idle_seconds = idle_seconds
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, session_id, input_ids):
+        """Return a PrefixEntry for the part of input_ids already cached
+
+        Only the longest common token prefix with the previous turn is
+        reused, so a prompt whose history window slid falls back to a
+        (near) full prefill. At least one token is always left to prefill.
+        """
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(session_id)
+            length = 0
+            if entry is not None:
+                self._entries.move_to_end(session_id)
+                entry.last_used = time.monotonic()
+                length = min(_common_prefix_length(entry.input_ids, input_ids), len(input_ids) - 1)
+            if length <= 0:
+                self.misses += 1
+                return None
+            self.hits += 1
+            past_key_values = tuple(
+                (key[:, :, :length], value[:, :, :length]) for key, value in entry.past_key_values
+            )
+        return PrefixEntry(f"session:{session_id}", list(input_ids[:length]), past_key_values)
+
+    def store(self, session_id, token_ids, past_key_values):
+        """Keep the attention state of a finished turn
+
+        ``token_ids`` may run past the cache (the last sampled token is never
+        fed back through the model); it is trimmed to the cached length.
+        """
+        length = past_key_values[0][0].shape[2]
+        entry = _SessionEntry(list(token_ids[:length]), past_key_values)
+        with self._lock:
+            self._discard(session_id)
+            if entry.nbytes > self.max_bytes:
+                return
+            self._entries[session_id] = entry
+            self.nbytes += entry.nbytes
+            while self.nbytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+
+    def drop(self, session_id):
+        with self._lock:
+            self._discard(session_id)
+
+    def _discard(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def _expire(self):
+        # Entries are kept in last-used order, so stop at the first fresh one
+        cutoff = time.monotonic() - self.idle_seconds
+        while self._entries:
+            session_id, entry = next(iter(self._entries.items()))
+            if entry.last_used >= cutoff:
+                break
+            self._discard(session_id)
@@ -0,0 +1,99 @@
+"""
+Progress of the background model load, reported by /api/health.
+
+The server starts answering requests before the model is loaded, so loading
+is split into named stages (imports, tokenizer, weights, ...). Each stage has
+a weight roughly proportional to its share of a typical load; the overall
+percentage is the weight of the finished stages.
+"""
+
+import threading
+import time
+
+
+class LoadProgress:
+    """Thread-safe record of which load stage is running and how long each took"""
+
+    def __init__(self, stages):
+        self._weights = dict(stages)
+        self._stages = {
+            name: {"status": "pending", "started_at": None, "finished_at": None}
+            for name in self._weights
+        }
+        self._started_at = None
+        self._finished_at = None
+        self._error = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        with self._lock:
+            return self._finished_at is not None and self._error is None
+
+    @property
+    def failed(self):
+        with self._lock:
+            return self._error is not None
+
+    def start(self, name):
+        """Mark a stage as running"""
+        now = time.monotonic()
+        with self._lock:
+            if self._started_at is None:
+                self._started_at = now
+            self._stages[name].update(status="running", started_at=now)
+
+    def finish(self, name):
+        """Mark a stage as done; the load is complete once every stage is"""
+        now = time.monotonic()
+        with self._lock:
+            stage = self._stages[name]
+            stage.update(status="done", finished_at=now)
+            seconds = now - stage["started_at"]
+            if all(s["status"] == "done" for s in self._stages.values()):
+                self._finished_at = now
+        print(f"Model load: {name} done in {seconds:.1f}s")
+
+    def fail(self, error):
+        """Mark the running stage, and so the whole load, as failed"""
+        now = time.monotonic()
+        with self._lock:
+            self._error = str(error)
+            self._finished_at = now
+            for stage in self._stages.values():
+                if stage["status"] == "running":
+                    stage.update(status="failed", finished_at=now)
+
+    def snapshot(self):
+        """Current progress as a JSON-serializable dict"""
+        now = time.monotonic()
+        with self._lock:
+            total = sum(self._weights.values())
+            done = sum(
+                self._weights[name] for name, stage in self._stages.items() if stage["status"] == "done"
+            )
+            stages = []
+            current = None
+            for name, stage in self._stages.items():
+                seconds = None
+                if stage["started_at"] is not None:
+                    seconds = round((stage["finished_at"] or now) - stage["started_at"], 3)
+                if stage["status"] in ("running", "failed"):
+                    current = name
+                stages.append({
+                    "name": name,
+                    "status": stage["status"],
+                    "weight_percent": round(100 * self._weights[name] / total, 1),
+                    "seconds": seconds,
+                })
+
+            elapsed = None
+            if self._started_at is not None:
+                elapsed = round((self._finished_at or now) - self._started_at, 3)
+            return {
+                "percent": round(100 * done / total, 1),
+                "stage": current,
+                "elapsed_seconds": elapsed,
+                "error": self._error,
+                "stages": stages,
+            }
@@ -0,0 +1,207 @@
+"""
+In-process metrics exported in the Prometheus text format at /metrics.
+
+Counters, gauges and histograms are plain Python objects guarded by one lock
+each, so recording a value costs a dictionary lookup and, for histograms, a
+bisect over the bucket bounds. That is cheap enough to leave on in
+production.
+
+Gauges and counters can also be backed by a function that is called only
+when /metrics is scraped, for values that already live elsewhere (queue
+depth, model-load timings). Such a function returns a number, or a dict that
+maps tuples of label values to numbers.
+
+Metrics are per process: with prefork_server.py each worker reports its own.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+# Latency buckets in seconds, from sub-millisecond lexicon checks to long decodes
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 25.0, 60.0,
+)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.function = function
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        """(label values, value) pairs, from the function if there is one"""
+        if self.function is None:
+            with self._lock:
+                return list(self._values.items())
+        result = self.function()
+        if isinstance(result, dict):
+            return [(tuple(str(v) for v in key), value) for key, value in result.items()]
+        return [((), result)]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, value in self._samples():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket (non-cumulative) counts, then sum and count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, **labels):
+        """Context manager that observes the seconds its block took"""
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            states = [(values, ([*counts], total, count)) for values, (counts, total, count) in self._values.items()]
+        for values, (counts, total, count) in states:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, values, [("le", _format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class ThroughputWindow:
+    """Events per second over a sliding time window"""
+
+    def __init__(self, window_seconds=60):
+        self.window_seconds = window_seconds
+        self._events = deque()  # (timestamp, amount)
+        self._lock = threading.Lock()
+
+    def add(self, amount):
+        now = time.monotonic()
+        with self._lock:
+            self._events.append((now, amount))
+            self._trim(now)
+
+    def rate(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            return sum(amount for _, amount in self._events) / self.window_seconds
+
+    def _trim(self, now):
+        cutoff = now - self.window_seconds
+        while self._events and self._events[0][0] < cutoff:
+            self._events.popleft()
+
+
+class MetricsRegistry:
+    """A set of metrics rendered together"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=(), function=None):
+        return self._register(Counter(name, documentation, labelnames, function))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
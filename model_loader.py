@@ -0,0 +1,196 @@
+"""
+Model loading shared by app.py and app_portable.py.
+
+On CPU the weights can be loaded in one of several precisions, chosen with
+MODEL_PRECISION in .env:
+
+- float32: the original full-precision weights (~4.4 GB resident)
+- bfloat16: weights converted to bfloat16 at load time (about half the memory)
+- int8: float32 weights with every linear layer dynamically quantized to int8
+
+On GPU the model is always loaded in float16, as before.
+
+portable_setup.py can also write a snapshot: tokenizer files plus the weights
+already converted to the dtype a precision needs, as a single safetensors
+file. from_pretrained memory-maps it without any conversion, so loading it is
+fast and peak memory stays close to the size of the model.
+
+The model is one of several backends, chosen with MODEL_BACKEND:
+
+- pytorch: the transformers model loaded here
+- onnx: an ONNX Runtime export written by portable_setup.py (onnx_backend.py)
+- stub: a deterministic stand-in for offline load tests (stub_model.py)
+
+Whatever the backend, the inference engine and the KV caches only use the
+transformers causal-LM forward call on it:
+
+    outputs = model(input_ids=..., attention_mask=..., position_ids=...,
+                    past_key_values=..., use_cache=True)
+
+which returns ``outputs.logits`` [batch, tokens, vocab] and
+``outputs.past_key_values`` ([batch, heads, tokens, head size] key/value
+tensors per layer), plus ``model.config.max_position_embeddings`` and
+``model.parameters()`` for the device.
+
+torch and transformers are imported on first use so importing this module
+stays cheap for the web server.
+"""
+
+import json
+import os
+from pathlib import Path
+
+MODEL_NAME = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+
+# Draft model for speculative decoding: a 68M-parameter Llama with the same
+# tokenizer as TinyLLaMA
+DRAFT_MODEL_NAME = "JackFram/llama-68m"
+
+PRECISIONS = ("float32", "bfloat16", "int8")
+
+BACKENDS = ("pytorch", "onnx", "stub")
+
+# Written last by save_snapshot, so a snapshot without it is incomplete
+SNAPSHOT_INFO = "snapshot.json"
+
+
+def snapshot_dtype(precision):
+    """Dtype a precision's weights are stored in (int8 is quantized at load)"""
+    return "bfloat16" if precision == "bfloat16" else "float32"
+
+
+def load_model(model_name=MODEL_NAME, precision="float32", **from_pretrained_kwargs):
+    """Load TinyLLaMA in the requested precision
+
+    Extra keyword arguments (cache_dir, local_files_only, ...) are passed to
+    ``from_pretrained``.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+
+    import torch
+    from transformers import AutoModelForCausalLM
+
+    if torch.cuda.is_available():
+        return AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float16,
+            device_map="auto",
+            **from_pretrained_kwargs,
+        )
+
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=torch.bfloat16 if precision == "bfloat16" else torch.float32,
+        low_cpu_mem_usage=True,
+        **from_pretrained_kwargs,
+    )
+    model.eval()
+
+    if precision == "int8":
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def save_snapshot(snapshot_dir, model_name=MODEL_NAME, precision="float32", **from_pretrained_kwargs):
+    """Write tokenizer and preconverted weights for load_snapshot
+
+    Extra keyword arguments (cache_dir, local_files_only, ...) are passed to
+    ``from_pretrained`` when reading the original model.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', expected one of {', '.join(PRECISIONS)}")
+
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer
+
+    snapshot_dir = Path(snapshot_dir)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    info_path = snapshot_dir / SNAPSHOT_INFO
+    if info_path.exists():
+        info_path.unlink()
+
+    dtype = snapshot_dtype(precision)
+    tokenizer = AutoTokenizer.from_pretrained(model_name, **from_pretrained_kwargs)
+    model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        torch_dtype=getattr(torch, dtype),
+        low_cpu_mem_usage=True,
+        **from_pretrained_kwargs,
+    )
+    tokenizer.save_pretrained(snapshot_dir)
+    # One unsharded file, so loading is a single memory map
+    model.save_pretrained(snapshot_dir, safe_serialization=True, max_shard_size="100GB")
+
+    with open(info_path, "w") as f:
+        json.dump({"model_name": model_name, "precision": precision, "dtype": dtype}, f, indent=2)
+
+
+def read_snapshot_info(snapshot_dir):
+    """Metadata of a complete snapshot, or None if there is none"""
+    try:
+        with open(Path(snapshot_dir) / SNAPSHOT_INFO) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def load_snapshot(snapshot_dir, precision="float32"):
+    """Load TinyLLaMA from a snapshot written by save_snapshot"""
+    info = read_snapshot_info(snapshot_dir)
+    if info is None:
+        raise FileNotFoundError(f"No complete model snapshot in {snapshot_dir}")
+    if info["dtype"] != snapshot_dtype(precision):
+        print(
+            f"Snapshot holds {info['dtype']} weights; converting them for {precision}. "
+            f"Re-run portable_setup.py with MODEL_PRECISION={precision} for a faster start."
+        )
+    return load_model(str(snapshot_dir), precision=precision, local_files_only=True)
+
+
+def resident_memory_mb():
+    """Resident set size of this process in MB, or None if unavailable"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:  # Windows without psutil
+        return None
+    # Peak rather than current RSS; kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 1024
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process in MB, or None if unavailable"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    try:
+        import resource
+    except ImportError:  # Windows
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2**20
+        except (ImportError, AttributeError):
+            return None
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if os.uname().sysname == "Darwin" else peak / 1024
@@ -0,0 +1,154 @@
+"""
+ONNX Runtime backend for TinyLLaMA on CPU (MODEL_BACKEND=onnx).
+
+portable_setup.py exports the model once with its KV cache as graph inputs
+and outputs (optimum's "text-generation-with-past" export), optionally
+quantized to int8. OnnxCausalLM then runs it with ONNX Runtime behind the
+same forward call as the transformers model, so the inference engine and the
+prefix and session caches use it unchanged. Key/values are handed back and
+forth as torch tensors that share memory with ONNX Runtime's arrays.
+
+Exporting needs ``pip install optimum[exporters] onnxruntime``; serving only
+needs onnxruntime (plus torch and transformers for the tokenizer).
+"""
+
+import json
+import os
+from pathlib import Path
+
+import torch
+
+from kv_cache import to_legacy_cache
+
+# Written last by export_onnx, so an export without it is incomplete
+ONNX_INFO = "onnx.json"
+
+ONNX_PRECISIONS = ("float32", "int8")
+
+
+def export_onnx(output_dir, model_name, precision="float32", **from_pretrained_kwargs):
+    """Export TinyLLaMA with its KV cache to ONNX, plus tokenizer and config
+
+    Extra keyword arguments (cache_dir, local_files_only) are passed on when
+    reading the original model.
+    """
+    if precision not in ONNX_PRECISIONS:
+        raise ValueError(
+            f"ONNX Runtime runs {precision} poorly on CPU; use one of {', '.join(ONNX_PRECISIONS)}"
+        )
+
+    from optimum.exporters.onnx import main_export
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    info_path = output_dir / ONNX_INFO
+    if info_path.exists():
+        info_path.unlink()
+
+    main_export(
+        model_name,
+        output=output_dir,
+        task="text-generation-with-past",
+        device="cpu",
+        **from_pretrained_kwargs,
+    )
+
+    model_file = "model.onnx"
+    if precision == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        model_file = "model_int8.onnx"
+        quantize_dynamic(
+            output_dir / "model.onnx",
+            output_dir / model_file,
+            weight_type=QuantType.QInt8,
+            use_external_data_format=True,
+        )
+
+    with open(info_path, "w") as f:
+        json.dump({"model_name": model_name, "precision": precision, "model_file": model_file}, f, indent=2)
+
+
+def read_onnx_info(onnx_dir):
+    """Metadata of a complete export, or None if there is none"""
+    try:
+        with open(Path(onnx_dir) / ONNX_INFO) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class CausalLMOutput:
+    def __init__(self, logits, past_key_values):
+        self.logits = logits
+        self.past_key_values = past_key_values
+
+
+class OnnxCausalLM(torch.nn.Module):
+    """An exported model behind the transformers causal-LM forward call
+
+    The session's thread pool is created here, so pre-forked workers each
+    build their own instead of inheriting one from the parent.
+    """
+
+    def __init__(self, onnx_dir, num_threads=None):
+        super().__init__()
+        import onnxruntime
+        from transformers import AutoConfig
+
+        info = read_onnx_info(onnx_dir)
+        if info is None:
+            raise FileNotFoundError(f"No complete ONNX export in {onnx_dir}; run portable_setup.py with MODEL_BACKEND=onnx")
+        self.precision = info["precision"]
+        self.config = AutoConfig.from_pretrained(onnx_dir, local_files_only=True)
+        self.num_kv_heads = getattr(self.config, "num_key_value_heads", self.config.num_attention_heads)
+        self.head_dim = self.config.hidden_size // self.config.num_attention_heads
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads or torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(onnx_dir, info["model_file"]),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.output_names = [node.name for node in self.session.get_outputs()]
+        self.num_layers = sum(1 for name in self.input_names if name.endswith(".key"))
+
+        # Only there so next(model.parameters()) finds the device and dtype
+        self.anchor = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+
+    @property
+    def dtype(self):
+        return self.anchor.dtype
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True, **kwargs):
+        batch, length = input_ids.shape
+        past = to_legacy_cache(past_key_values) if past_key_values is not None else None
+        past_length = past[0][0].shape[2] if past else 0
+
+        if attention_mask is None:
+            attention_mask = torch.ones(batch, past_length + length, dtype=torch.long)
+        if position_ids is None:
+            # Left padding does not advance the position
+            position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)[:, -length:]
+
+        feeds = {
+            "input_ids": input_ids.to(torch.long).numpy(),
+            "attention_mask": attention_mask.to(torch.long).numpy(),
+        }
+        if "position_ids" in self.input_names:
+            feeds["position_ids"] = position_ids.to(torch.long).contiguous().numpy()
+        empty = torch.zeros(batch, self.num_kv_heads, 0, self.head_dim)
+        for layer in range(self.num_layers):
+            key, value = past[layer] if past else (empty, empty)
+            feeds[f"past_key_values.{layer}.key"] = key.to(torch.float32).contiguous().numpy()
+            feeds[f"past_key_values.{layer}.value"] = value.to(torch.float32).contiguous().numpy()
+
+        outputs = dict(zip(self.output_names, self.session.run(None, feeds)))
+        present = tuple(
+            (torch.from_numpy(outputs[f"present.{layer}.key"]), torch.from_numpy(outputs[f"present.{layer}.value"]))
+            for layer in range(self.num_layers)
+        )
+        return CausalLMOutput(torch.from_numpy(outputs["logits"]), present)
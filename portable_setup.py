@@ -26,8 +26,8 @@ def create_portable_structure():
     
     return models_dir, cache_dir
 
-def download_and_cache_model(cache_dir):
-    """Download model to local cache directory"""
+def download_and_cache_model(cache_dir, draft_model_name):
+    """Download model (and the speculative-decoding draft model) to local cache directory"""
     print("Downloading TinyLLaMA model to local cache...")
 
     # Use raw strings for Windows paths
@@ -54,6 +54,15 @@ model = AutoModelForCausalLM.from_pretrained(
 )
 
 print("Model downloaded successfully!")
+
+# Small enough to always cache, so SPECULATIVE_DECODING=1 works offline later
+print("Downloading draft model for speculative decoding...")
+try:
+    AutoTokenizer.from_pretrained("{draft_model_name}")
+    AutoModelForCausalLM.from_pretrained("{draft_model_name}", cache_dir=r"{cache_path}")
+    print("Draft model downloaded successfully!")
+except Exception as e:
+    print(f"Draft model not downloaded ({{e}}); speculative decoding will be unavailable")
 '''
     
     # Write and run download script
@@ -67,19 +76,96 @@ print("Model downloaded successfully!")
     except subprocess.CalledProcessError as e:
         print(f"Error downloading model: {e}")
         return False
+
+def create_model_snapshot(cache_dir, snapshot_dir, precision):
+    """Write the preconverted safetensors snapshot app_portable.py starts from"""
+    print(f"Writing {precision} model snapshot for fast start-up...")
+    
+    cache_path = str(cache_dir.absolute())
+    snapshot_path = str(snapshot_dir.absolute())
+    
+    snapshot_script = f'''
+import os
+os.environ["HF_HOME"] = r"{cache_path}"
+
+from model_loader import save_snapshot
+
+save_snapshot(
+    r"{snapshot_path}",
+    precision="{precision}",
+    cache_dir=r"{cache_path}",
+    local_files_only=True
+)
+
+print("Snapshot written successfully!")
+'''
+    
+    try:
+        subprocess.run([sys.executable, "-c", snapshot_script], check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error writing model snapshot: {e}")
+        return False
+
+def create_onnx_export(cache_dir, onnx_dir, precision):
+    """Export the model with its KV cache for the ONNX Runtime backend"""
+    print(f"Exporting {precision} ONNX model for MODEL_BACKEND=onnx...")
+    
+    cache_path = str(cache_dir.absolute())
+    onnx_path = str(onnx_dir.absolute())
+    
+    export_script = f'''
+import os
+os.environ["HF_HOME"] = r"{cache_path}"
+
+from model_loader import MODEL_NAME
+from onnx_backend import export_onnx
+
+export_onnx(
+    r"{onnx_path}",
+    MODEL_NAME,
+    precision="{precision}",
+    cache_dir=r"{cache_path}",
+    local_files_only=True
+)
+
+print("ONNX export written successfully!")
+'''
+    
+    try:
+        subprocess.run([sys.executable, "-c", export_script], check=True)
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"Error exporting ONNX model: {e}")
+        print("The export needs: pip install optimum[exporters] onnxruntime")
+        return False
         
 def create_portable_app():
     """Create modified app.py that uses local cache"""
     print("Creating portable app.py...")
     
     portable_app_content = '''import os
+import sys
 import json
-import re
+import math
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from flask import Flask, render_template, request, jsonify
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
+from flask import Flask, Response, render_template, request, jsonify
 from dotenv import load_dotenv
+from risk_matcher import PhraseMatcher, normalize_text
+from response_cache import ResponseCache
+from session_store import open_session_store
+from prompt_budget import TokenCache, pack_history
+from model_loader import BACKENDS, DRAFT_MODEL_NAME, MODEL_NAME, load_model, load_snapshot, peak_memory_mb, read_snapshot_info
+from load_progress import LoadProgress
+from metrics import MetricsRegistry, ThroughputWindow
+from cpu_tuning import apply_cpu_config, load_cpu_config
+# torch, transformers and the modules built on them are imported by
+# initialize_model, so the server is up before they have loaded
 
 load_dotenv()
 
@@ -88,97 +174,744 @@ MODELS_DIR = Path(__file__).parent / "models" / "transformers_cache"
 os.environ["TRANSFORMERS_CACHE"] = str(MODELS_DIR.absolute())
 os.environ["HF_HOME"] = str(MODELS_DIR.absolute())
 
+# Preconverted safetensors snapshot written by portable_setup.py, loaded
+# instead of the cache above when present
+SNAPSHOT_DIR = Path(__file__).parent / "models" / "snapshot"
+
 app = Flask(__name__)
 
+# CPU weight precision: float32, bfloat16 or int8 (dynamic quantization)
+MODEL_PRECISION = os.getenv("MODEL_PRECISION", "float32")
+
+# What runs the model (see model_loader.py): pytorch, onnx (the ONNX Runtime
+# export written by portable_setup.py) or stub (the deterministic stand-in
+# from stub_model.py, for load tests without the model)
+MODEL_BACKEND = os.getenv("MODEL_BACKEND", "pytorch")
+ONNX_DIR = Path(os.getenv("ONNX_DIR", Path(__file__).parent / "models" / "onnx"))
+
+# Cost of the stub model per decode step and per prompt token of a prefill
+STUB_TOKEN_DELAY_MS = float(os.getenv("STUB_TOKEN_DELAY_MS", "20"))
+STUB_PREFILL_DELAY_MS = float(os.getenv("STUB_PREFILL_DELAY_MS", "0.2"))
+
+# Speculative decoding (see speculative.py): while one conversation is
+# decoding, a small draft model with TinyLLaMA's tokenizer proposes
+# SPECULATIVE_TOKENS tokens and TinyLLaMA checks them in one pass. It turns
+# itself off for a while when fewer than SPECULATIVE_MIN_ACCEPTANCE of the
+# proposals are accepted or it is not faster.
+SPECULATIVE_DECODING = os.getenv("SPECULATIVE_DECODING", "0") == "1"
+DRAFT_MODEL = os.getenv("DRAFT_MODEL", DRAFT_MODEL_NAME)
+SPECULATIVE_TOKENS = int(os.getenv("SPECULATIVE_TOKENS", "4"))
+SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", "0.4"))
+
+# Compile the model's forward pass with torch.compile (pytorch backend only).
+# Compilation runs at startup on the warmup prompts, before /api/health
+# reports ready, and Inductor keeps the compiled kernels in
+# TORCH_COMPILE_CACHE_DIR so later starts load them instead of compiling.
+# TORCH_COMPILE_MODE is torch.compile's mode: default or max-autotune.
+TORCH_COMPILE = os.getenv("TORCH_COMPILE", "0") == "1"
+TORCH_COMPILE_MODE = os.getenv("TORCH_COMPILE_MODE", "default")
+TORCH_COMPILE_CACHE_DIR = os.getenv("TORCH_COMPILE_CACHE_DIR", str(Path(__file__).parent / "models" / "torch_compile_cache"))
+
+# Largest number of conversations decoded together in one batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "8"))
+
+# Prompts allowed to wait for a batch slot, and how long one may wait. Beyond
+# that requests are turned away with Retry-After instead of piling up.
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", "32"))
+MAX_QUEUE_WAIT_SECONDS = float(os.getenv("MAX_QUEUE_WAIT_SECONDS", "60"))
+
+# Memory budget and idle expiry for attention state kept between chat turns
+SESSION_CACHE_MB = float(os.getenv("SESSION_CACHE_MB", "256"))
+SESSION_CACHE_IDLE_SECONDS = int(os.getenv("SESSION_CACHE_IDLE_SECONDS", "900"))
+
+# Crisis phrases checked before any model call, compiled once at startup
+CRISIS_LEXICON_PATH = os.getenv(
+    "CRISIS_LEXICON_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "crisis_lexicon.tsv"),
+)
+crisis_matcher = PhraseMatcher.from_file(CRISIS_LEXICON_PATH)
+
+# LLM risk check: "score" compares the HIGH_RISK/LOW_RISK label logits in one
+# forward pass, "generate" samples a short reply and searches it for HIGH_RISK
+RISK_ASSESSMENT_MODE = os.getenv("RISK_ASSESSMENT_MODE", "score")
+RISK_THRESHOLD = float(os.getenv("RISK_THRESHOLD", "0.5"))
+# Calibration applied to the label logit difference before the sigmoid
+RISK_CALIBRATION_TEMPERATURE = float(os.getenv("RISK_CALIBRATION_TEMPERATURE", "1.0"))
+RISK_CALIBRATION_BIAS = float(os.getenv("RISK_CALIBRATION_BIAS", "0.0"))
+RISK_CACHE_SIZE = int(os.getenv("RISK_CACHE_SIZE", "4096"))
+
+# Reply cache for repeated low-risk messages
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_MB = float(os.getenv("RESPONSE_CACHE_MB", "16"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+
+# Chat histories kept server-side for clients that send only their new
+# message (see session_store.py). In memory by default; with SESSION_DB_PATH
+# they go to a SQLite database instead, which survives restarts and is shared
+# by pre-forked workers.
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "")
+SESSION_STORE_SIZE = int(os.getenv("SESSION_STORE_SIZE", "10000"))
+SESSION_HISTORY_MESSAGES = int(os.getenv("SESSION_HISTORY_MESSAGES", "20"))
+SESSION_TTL_HOURS = float(os.getenv("SESSION_TTL_HOURS", "168"))
+
+# Request size limits: characters in one message, and kilobytes in a request
+# body (larger bodies get 413 before they are parsed)
+MAX_MESSAGE_CHARS = int(os.getenv("MAX_MESSAGE_CHARS", "4000"))
+MAX_REQUEST_KB = int(os.getenv("MAX_REQUEST_KB", "64"))
+MAX_SESSION_ID_CHARS = 128
+app.config["MAX_CONTENT_LENGTH"] = MAX_REQUEST_KB * 1024
+
+# Token budget of the therapeutic prompt (see prompt_budget.py). It holds as
+# many recent messages as fit in what the template and the current message
+# leave, so prefill cost stays bounded however long the messages are.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "1024"))
+# Messages whose token ids are kept, so each is tokenized only once
+MESSAGE_TOKEN_CACHE_SIZE = int(os.getenv("MESSAGE_TOKEN_CACHE_SIZE", "16384"))
+
+# Thread settings measured for this machine by cpu_tuning.py, applied at
+# startup when the file exists and was measured here. Empty keeps PyTorch's
+# defaults.
+CPU_TUNING_PATH = os.getenv("CPU_TUNING_PATH", str(Path(__file__).parent / "cpu_tuning.json"))
+
 # Global variables to store the model and tokenizer
 model = None
 tokenizer = None
-text_generator = None
+draft_model = None
+model_compiled = False  # forward pass compiled with torch.compile
+inference_engine = None
+prefix_cache = None
+prompt_templates = None  # template name -> prompt_templates.PromptTemplate
+risk_label_ids = None  # first token of HIGH_RISK and LOW_RISK
+risk_verdicts = OrderedDict()  # normalized message hash -> HIGH_RISK probability
+risk_verdicts_lock = threading.Lock()
+session_cache = None
+message_tokens = None  # prompt_budget.TokenCache of message text
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    max_mb=RESPONSE_CACHE_MB,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+)
+session_store = open_session_store(
+    SESSION_DB_PATH,
+    max_sessions=SESSION_STORE_SIZE,
+    max_messages=SESSION_HISTORY_MESSAGES,
+    ttl_seconds=SESSION_TTL_HOURS * 3600,
+)
 
-def initialize_model():
-    """Initialize TinyLLaMA model and tokenizer from local cache"""
-    global model, tokenizer, text_generator
+# System instructions of the prompt templates. Prompts are built with the
+# model's chat template from pieces tokenized once at startup, and the key/values
+# of each template's leading tokens are computed then too (see
+# prompt_templates.py and kv_cache.PrefixCache).
+THERAPEUTIC_SYSTEM_PROMPT = """You are a mental health support assistant specializing in Cognitive Behavioral Therapy (CBT). Your goal is to help users identify and challenge negative thought patterns.
+
+Provide a response that is:
+1. Empathetic and validating - acknowledge their feelings
+2. CBT-focused - help identify thinking patterns or cognitive distortions
+3. Ask gentle questions to promote self-reflection
+4. Suggest a small, manageable step or reframing technique
+5. Keep it concise and supportive (2-3 sentences max)"""
+
+RISK_SYSTEM_PROMPT = """Analyze the user's message for signs of immediate self-harm risk. Respond with only 'HIGH_RISK' or 'LOW_RISK'.
+
+Look for explicit statements about:
+- Plans to hurt oneself
+- Immediate intent to self-harm
+- Active suicidal ideation with method or timeline"""
+
+# Text the model writes when it starts a new turn instead of finishing its own
+END_OF_TURN_MARKERS = ["<|user|>", "<|system|>", "<|end|>", "<|endoftext|>", "</s>"]
+
+# Longest reply, in sentences, shown to the user
+MAX_RESPONSE_SENTENCES = 3
+
+# Reply to messages assessed as high risk
+CRISIS_RESPONSE = "It sounds like you are going through a very difficult time, and I want you to know that your safety is the most important thing. Please connect with someone who can support you right now. You can call the Nigerian emergency hotline at 112, or reach out to the Suicide Research and Prevention Initiative (SURPIN) at 08092106463. You don't have to go through this alone."
+
+# Reply used when generation fails
+FALLBACK_RESPONSE = "I'm here to listen and support you. Can you share what's on your mind today?"
+
+# Messages run through the risk and therapeutic prompts at startup, one alone
+# and then all at once, so the prefill and decode shapes a chat uses are set
+# up (and compiled, with TORCH_COMPILE) before the first user's message
+WARMUP_MESSAGES = [
+    "Hello, I just wanted to talk to someone",
+    "I've been feeling anxious about work and I can't sleep",
+    "My friends don't seem to care about me anymore",
+    "I keep thinking I'm going to fail my exams",
+]
+
+PROMPT_TEMPLATES = {
+    "therapeutic": THERAPEUTIC_SYSTEM_PROMPT,
+    "risk": RISK_SYSTEM_PROMPT,
+}
+
+# Stages of the background model load and their rough share of its time
+LOAD_STAGES = [
+    ("import", 15),
+    ("tokenizer", 5),
+    ("weights", 55),
+    ("warmup", 20),
+]
+if SPECULATIVE_DECODING:
+    LOAD_STAGES.insert(3, ("draft", 10))
+if TORCH_COMPILE:
+    LOAD_STAGES.append(("compile", 60))
+load_progress = LoadProgress(LOAD_STAGES)
+
+# Prometheus metrics served at /metrics. Values owned by other objects are
+# read only when scraped; see metrics.py.
+metrics_registry = MetricsRegistry()
+stage_seconds = metrics_registry.histogram(
+    "chatbot_stage_seconds",
+    "Seconds spent in each stage of answering a message",
+    ["stage"],
+)
+tokens_generated = metrics_registry.counter("chatbot_tokens_generated_total", "Tokens generated by the model")
+token_throughput = ThroughputWindow(window_seconds=60)
+prompt_token_counts = metrics_registry.histogram(
+    "chatbot_prompt_tokens",
+    "Tokens in each therapeutic prompt, by part",
+    ["part"],
+    buckets=(16, 32, 64, 128, 256, 384, 512, 768, 1024, 1536, 2048),
+)
+crisis_responses = metrics_registry.counter(
+    "chatbot_crisis_responses_total",
+    "Crisis replies, by the risk stage that flagged the message",
+    ["stage"],
+)
+
+def engine_stat(name):
+    """A field of inference_engine.stats() for /metrics, or 0 before the engine exists or without the field"""
+    return inference_engine.stats().get(name, 0) if inference_engine is not None else 0
+
+def load_stage_seconds():
+    return {(stage["name"],): stage["seconds"] for stage in load_progress.snapshot()["stages"] if stage["seconds"] is not None}
+
+metrics_registry.gauge("chatbot_tokens_per_second", "Tokens generated per second over the last minute", function=token_throughput.rate)
+metrics_registry.gauge(
+    "chatbot_queue_depth",
+    "Prompts waiting for a batch slot, by priority",
+    ["priority"],
+    function=lambda: {(priority,): depth for priority, depth in (engine_stat("queue_depth_by_priority") or {}).items()},
+)
+metrics_registry.gauge("chatbot_batch_size", "Requests in the current decode batch", function=lambda: engine_stat("batch_size"))
+
+def speculative_stat(name):
+    stats = engine_stat("speculative") or {}
+    return {(): stats[name]} if stats.get(name) is not None else {}
+
+metrics_registry.gauge(
+    "chatbot_speculative_acceptance_rate",
+    "Share of draft tokens accepted over recent speculative steps",
+    function=lambda: speculative_stat("acceptance_rate"),
+)
+metrics_registry.gauge(
+    "chatbot_speculative_speedup",
+    "Decode speed with the draft model relative to plain decoding",
+    function=lambda: speculative_stat("speedup"),
+)
+metrics_registry.counter("chatbot_queue_admitted_total", "Requests admitted to the decode batch", function=lambda: engine_stat("admitted"))
+metrics_registry.counter("chatbot_queue_rejected_total", "Requests turned away because the queue was full", function=lambda: engine_stat("rejected"))
+metrics_registry.counter("chatbot_queue_expired_total", "Requests that waited too long for a batch slot", function=lambda: engine_stat("expired"))
+metrics_registry.gauge("chatbot_model_ready", "1 once the model is loaded and warmed up", function=lambda: int(load_progress.ready))
+metrics_registry.gauge(
+    "chatbot_model_load_seconds",
+    "Duration of the model load so far, or in total once it finished",
+    function=lambda: load_progress.snapshot()["elapsed_seconds"] or 0,
+)
+metrics_registry.gauge("chatbot_model_load_stage_seconds", "Duration of each model load stage", ["stage"], function=load_stage_seconds)
+metrics_registry.counter(
+    "chatbot_response_cache_total",
+    "Reply cache lookups, by result",
+    ["result"],
+    function=lambda: {(result,): response_cache.stats()[result] for result in ("hits", "misses", "coalesced")},
+)
+
+def load_stub_weights():
+    """Load the deterministic stand-in model instead of TinyLLaMA (MODEL_BACKEND=stub)"""
+    global model, tokenizer
+    
+    print(f"Loading the stub model ({STUB_TOKEN_DELAY_MS:g} ms per token)...")
+    
+    load_progress.start("import")
+    from stub_model import StubModel, StubTokenizer
+    load_progress.finish("import")
+    
+    load_progress.start("tokenizer")
+    tokenizer = StubTokenizer()
+    load_progress.finish("tokenizer")
+    
+    load_progress.start("weights")
+    model = StubModel(token_delay=STUB_TOKEN_DELAY_MS / 1000, prefill_delay=STUB_PREFILL_DELAY_MS / 1000)
+    load_progress.finish("weights")
+
+def load_onnx_weights():
+    """Load the ONNX Runtime export written by portable_setup.py (MODEL_BACKEND=onnx)"""
+    global model, tokenizer
+    
+    print(f"Loading TinyLLaMA ONNX export from {ONNX_DIR}...")
+    
+    load_progress.start("import")
+    import torch  # noqa: F401
+    from transformers import AutoTokenizer
+    from onnx_backend import OnnxCausalLM
+    load_progress.finish("import")
+    
+    load_progress.start("tokenizer")
+    tokenizer = AutoTokenizer.from_pretrained(ONNX_DIR, local_files_only=True)
+    load_progress.finish("tokenizer")
+    
+    load_progress.start("weights")
+    model = OnnxCausalLM(ONNX_DIR)
+    load_progress.finish("weights")
+
+def load_weights():
+    """Import torch/transformers and load the tokenizer and model weights
+
+    Starts no threads that outlive it and runs no forward pass, so
+    prefork_server.py can call it once before forking and share the weights
+    with every worker.
+    """
+    global model, tokenizer
+    
+    if MODEL_BACKEND not in BACKENDS:
+        raise ValueError(f"Unknown MODEL_BACKEND '{MODEL_BACKEND}', expected one of {', '.join(BACKENDS)}")
+    if MODEL_BACKEND == "stub":
+        load_stub_weights()
+        return
+    if MODEL_BACKEND == "onnx":
+        load_onnx_weights()
+        return
+    
+    print("Loading TinyLLaMA model from local cache...")
+    
+    # Model name for TinyLLaMA 1.1B
+    model_name = MODEL_NAME
     
+    # Heavy imports happen here so /api/health can report them
+    load_progress.start("import")
+    import torch  # noqa: F401
+    from transformers import AutoTokenizer
+    load_progress.finish("import")
+    
+    use_snapshot = read_snapshot_info(SNAPSHOT_DIR) is not None
+    
+    def load_tokenizer():
+        load_progress.start("tokenizer")
+        if use_snapshot:
+            loaded = AutoTokenizer.from_pretrained(SNAPSHOT_DIR, local_files_only=True)
+        else:
+            loaded = AutoTokenizer.from_pretrained(
+                model_name,
+                cache_dir=MODELS_DIR,
+                local_files_only=True  # Only use cached files
+            )
+        load_progress.finish("tokenizer")
+        return loaded
+    
+    # Load tokenizer and weights in parallel, from the snapshot when there
+    # is one and from the cache otherwise
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        tokenizer_future = executor.submit(load_tokenizer)
+        
+        load_progress.start("weights")
+        if use_snapshot:
+            model = load_snapshot(SNAPSHOT_DIR, precision=MODEL_PRECISION)
+        else:
+            model = load_model(
+                model_name,
+                precision=MODEL_PRECISION,
+                cache_dir=MODELS_DIR,
+                local_files_only=True  # Only use cached files
+            )
+        load_progress.finish("weights")
+        
+        tokenizer = tokenizer_future.result()
+    
+    peak_mb = peak_memory_mb()
+    print(
+        f"Weights loaded from {'snapshot' if use_snapshot else 'cache'}"
+        + (f" (peak memory {peak_mb:.0f} MB)" if peak_mb is not None else "")
+    )
+
+def load_draft_weights():
+    """Load the draft model for speculative decoding next to TinyLLaMA"""
+    global draft_model
+    
+    load_progress.start("draft")
     try:
-        print("Loading TinyLLaMA model from local cache...")
+        if MODEL_BACKEND == "stub":
+            raise ValueError("the stub model has no tokenizer to share with a draft model")
+        from transformers import AutoTokenizer
         
-        # Model name for TinyLLaMA 1.1B
-        model_name = "TinyLlama/TinyLlama-1.1B-Chat-v1.0"
+        draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL, cache_dir=MODELS_DIR, local_files_only=True)
+        if draft_tokenizer.get_vocab() != tokenizer.get_vocab():
+            raise ValueError(f"{DRAFT_MODEL} does not share TinyLLaMA's tokenizer")
+        draft_model = load_model(DRAFT_MODEL, precision="float32", cache_dir=MODELS_DIR, local_files_only=True)
+        print(f"Draft model {DRAFT_MODEL} loaded for speculative decoding")
+    except Exception as e:
+        # Serving without speculation beats not serving
+        print(f"Speculative decoding disabled: {e}")
+    load_progress.finish("draft")
+
+def prepare_inference():
+    """Compile the prompt templates, prefill their prefixes and start the engine
+
+    Everything here holds per-process state (threads, caches), so a
+    pre-forked worker runs it after the fork.
+    """
+    global inference_engine, prefix_cache, risk_label_ids, session_cache
+    global prompt_templates, message_tokens
+    
+    from inference_engine import InferenceEngine
+    from kv_cache import PrefixCache, SessionKVCache, encode_continuation
+    from prompt_templates import PromptTemplate
+    
+    # Tokenize the templates' fixed pieces and prefill their leading tokens once
+    load_progress.start("warmup")
+    prompt_templates = {name: PromptTemplate(tokenizer, name, system) for name, system in PROMPT_TEMPLATES.items()}
+    message_tokens = TokenCache(lambda text: encode_continuation(tokenizer, text), max_entries=MESSAGE_TOKEN_CACHE_SIZE)
+    prefix_cache = PrefixCache(model)
+    for name, template in prompt_templates.items():
+        prefix_cache.register(name, template.head_ids)
+    
+    # The assistant reply starts on a new line after the generation prompt,
+    # so score the labels' first tokens as they are encoded there
+    risk_label_ids = [encode_continuation(tokenizer, label)[0] for label in ("HIGH_RISK", "LOW_RISK")]
+    if risk_label_ids[0] == risk_label_ids[1]:
+        raise ValueError("HIGH_RISK and LOW_RISK share their first token")
+    
+    session_cache = SessionKVCache(max_mb=SESSION_CACHE_MB, idle_seconds=SESSION_CACHE_IDLE_SECONDS)
+    
+    draft = None
+    if draft_model is not None:
+        from speculative import SpeculativeDecoder
         
-        # Load tokenizer and model from cache
-        tokenizer = AutoTokenizer.from_pretrained(
-            model_name,
-            cache_dir=MODELS_DIR,
-            local_files_only=True  # Only use cached files
-        )
-        model = AutoModelForCausalLM.from_pretrained(
-            model_name,
-            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-            device_map="auto" if torch.cuda.is_available() else None,
-            cache_dir=MODELS_DIR,
-            local_files_only=True  # Only use cached files
+        draft = SpeculativeDecoder(
+            draft_model,
+            num_tokens=SPECULATIVE_TOKENS,
+            min_acceptance=SPECULATIVE_MIN_ACCEPTANCE,
         )
+    
+    # Start the batching engine that serves generate_response, and run the
+    # warmup prompts so the first chat does not pay for lazy setup
+    inference_engine = InferenceEngine(
+        model,
+        tokenizer,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_queue=MAX_QUEUE_SIZE,
+        max_wait_seconds=MAX_QUEUE_WAIT_SECONDS,
+        draft=draft,
+    ).start()
+    try:
+        warm_up_engine()
+    except Exception as e:
+        # Only costs the first chats some speed
+        print(f"Warmup failed: {e}")
+    load_progress.finish("warmup")
+    
+    if TORCH_COMPILE:
+        compile_model()
+
+def warm_up_engine(max_new_tokens=8):
+    """Run WARMUP_MESSAGES through the risk and therapeutic prompts, one alone and then batched
+    
+    No more are in flight than the queue and a batch hold, and a request
+    turned away is submitted again once there is room.
+    """
+    from inference_engine import EngineOverloaded
+    
+    history = [{"role": "user", "content": WARMUP_MESSAGES[0]}, {"role": "assistant", "content": FALLBACK_RESPONSE}]
+    
+    def submit(start_request):
+        while True:
+            try:
+                return start_request().result()
+            except EngineOverloaded:
+                time.sleep(0.1)
+    
+    def run(message):
+        submit(lambda: inference_engine.submit(
+            build_risk_prompt(message), 0, prefix=prefix_cache.get("risk"), score_token_ids=risk_label_ids, priority="high"
+        ))
+        submit(lambda: submit_prompt("therapeutic", build_therapeutic_prompt(message, history), max_new_tokens))
+    
+    run(WARMUP_MESSAGES[0])
+    concurrency = max(1, min(len(WARMUP_MESSAGES), MAX_QUEUE_SIZE, MAX_BATCH_SIZE))
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run, WARMUP_MESSAGES))
+
+def compile_model():
+    """Compile the model's forward pass with torch.compile (TORCH_COMPILE=1)
+    
+    torch.compile compiles on the first forward pass of each kind of input,
+    so the warmup prompts run again here and the time shows up as the
+    "compile" load stage. Compiled kernels are cached in
+    TORCH_COMPILE_CACHE_DIR, which pre-forked workers share.
+    """
+    global model_compiled
+    
+    load_progress.start("compile")
+    start = time.perf_counter()
+    try:
+        if MODEL_BACKEND != "pytorch":
+            raise ValueError(f"MODEL_BACKEND={MODEL_BACKEND} has no PyTorch forward pass to compile")
+        os.environ["TORCHINDUCTOR_CACHE_DIR"] = TORCH_COMPILE_CACHE_DIR
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+        import torch
+        import torch._inductor.config as inductor_config
         
-        # Create text generation pipeline
-        text_generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            torch_dtype=torch.float16 if torch.cuda.is_available() else torch.float32,
-            device=0 if torch.cuda.is_available() else -1,
-            do_sample=True,
-            temperature=0.7,
-            top_p=0.9,
-            repetition_penalty=1.1
-        )
+        inductor_config.fx_graph_cache = True
         
-        print("Model loaded successfully from local cache!")
+        # Dynamic shapes, so prompt, history and batch lengths share graphs
+        model.forward = torch.compile(model.forward, mode=TORCH_COMPILE_MODE, dynamic=True)
+        warm_up_engine()
+        model_compiled = True
+        print(f"Model compiled in {time.perf_counter() - start:.1f}s (mode {TORCH_COMPILE_MODE}, cache {TORCH_COMPILE_CACHE_DIR})")
+    except Exception as e:
+        # Serving eager beats not serving
+        vars(model).pop("forward", None)
+        print(f"torch.compile disabled: {e}")
+    load_progress.finish("compile")
+
+def initialize_model():
+    """Initialize TinyLLaMA model and tokenizer from local cache"""
+    try:
+        # Skipped in pre-forked workers, which inherit the weights
+        if model is None:
+            load_weights()
+        if SPECULATIVE_DECODING and draft_model is None:
+            load_draft_weights()
+        prepare_inference()
+        
+        print(f"Model loaded successfully from local cache! (backend: {MODEL_BACKEND}, precision: {MODEL_PRECISION})")
         return True
         
     except Exception as e:
+        load_progress.fail(e)
         print(f"Error loading model: {e}")
         print("Make sure the model files are in the models/transformers_cache directory")
         return False
 
-def generate_response(prompt, max_length=200):
-    """Generate response using TinyLLaMA"""
-    global text_generator
+def encode_prompt(template, message, history=()):
+    """Input ids of a template's prompt for message after history
+    
+    The template's pieces are tokenized already, and message text is
+    tokenized once and cached.
+    """
+    return prompt_templates[template].encode(message, history, message_tokens.encode)
+
+def submit_prompt(template, input_ids, max_new_tokens=200, session_id=None, max_sentences=MAX_RESPONSE_SENTENCES,
+                  priority="normal", prompt_tokens=None):
+    """Queue a prompt built from a template in the inference engine and return its request
+
+    prompt_tokens is the token breakdown from fit_history, reported here.
+    """
+    from inference_engine import StopOnSentences
+    
+    # The template's leading tokens are prefilled already. Continue from the
+    # conversation's previous turn instead when that covers more of the prompt.
+    prefix = prefix_cache.get(template)
+    if session_id:
+        previous_turn = session_cache.lookup(session_id, input_ids)
+        if previous_turn is not None and (prefix is None or previous_turn.length > prefix.length):
+            prefix = previous_turn
+    
+    if prompt_tokens is not None:
+        report_prompt_tokens(prompt_tokens, len(input_ids))
+    
+    # Never run past the model's context window
+    max_new_tokens = max(1, min(max_new_tokens, model.config.max_position_embeddings - len(input_ids)))
+    
+    return inference_engine.submit(
+        input_ids,
+        max_new_tokens=max_new_tokens,
+        eos_token_ids=[tokenizer.eos_token_id],
+        prefix=prefix,
+        keep_cache=bool(session_id),
+        stop_checker=StopOnSentences(tokenizer, max_sentences, END_OF_TURN_MARKERS),
+        priority=priority,
+    )
+
+def report_prompt_tokens(prompt_tokens, total):
+    """Log a prompt's token breakdown and record it in /metrics"""
+    prompt_tokens["total"] = total
+    for part in ("template", "history", "message", "total"):
+        prompt_token_counts.observe(prompt_tokens[part], part=part)
+    print(
+        f"Prompt: {total} tokens (template {prompt_tokens['template']}, history {prompt_tokens['history']} "
+        f"in {prompt_tokens['history_turns']} turns with {prompt_tokens['dropped_turns']} left out, "
+        f"message {prompt_tokens['message']})"
+    )
+
+def remember_turn(session_id, generation):
+    """Keep a finished turn's attention state for the session's next turn"""
+    if session_id and generation.past_key_values is not None:
+        session_cache.store(session_id, generation.token_ids, generation.past_key_values)
+
+def clean_response(response, max_sentences=MAX_RESPONSE_SENTENCES):
+    """Turn raw generated text into the reply shown to the user"""
+    # Extract only the assistant's response
+    if "<|assistant|>" in response:
+        response = response.split("<|assistant|>")[-1]
     
+    # Clean up the response
+    for marker in END_OF_TURN_MARKERS:
+        response = response.split(marker)[0]
+    response = response.strip()
+    
+    # Limit response length
+    sentences = response.split('. ')
+    if len(sentences) > max_sentences:
+        response = '. '.join(sentences[:max_sentences]) + '.'
+    
+    return response if response else "I understand you're going through something difficult. Can you tell me more about how you're feeling?"
+
+def record_generation_timings(generation):
+    """Record a finished request's queue wait, prefill and decode times in /metrics"""
+    if generation.admitted_at is None or generation.finished_at is None:
+        return
+    stage_seconds.observe(generation.admitted_at - generation.submitted_at, stage="queue_wait")
+    if generation.first_token_at is None:
+        # Scoring requests end after the prefill
+        stage_seconds.observe(generation.finished_at - generation.admitted_at, stage="prefill")
+        return
+    stage_seconds.observe(generation.first_token_at - generation.admitted_at, stage="prefill")
+    stage_seconds.observe(generation.finished_at - generation.first_token_at, stage="decode")
+    tokens_generated.inc(len(generation.generated_ids))
+    token_throughput.add(len(generation.generated_ids))
+
+def log_generation(generation, response):
+    """Print how many generated tokens made it into the reply"""
+    record_generation_timings(generation)
+    kept = len(tokenizer(response, add_special_tokens=False)["input_ids"])
+    elapsed_ms = (generation.finished_at - generation.submitted_at) * 1000
+    print(
+        f"Generation: {len(generation.generated_ids)} tokens generated, {kept} kept "
+        f"(stopped on {generation.finish_reason}, {elapsed_ms:.0f} ms)"
+    )
+
+def collect_response(generation, session_id=None):
+    """Wait for a submitted generation and return the cleaned reply"""
+    output_ids = generation.result()
+    remember_turn(session_id, generation)
+    with stage_seconds.time(stage="postprocess"):
+        response = clean_response(tokenizer.decode(output_ids, skip_special_tokens=True))
+    log_generation(generation, response)
+    return response
+
+def finish_response(generation, session_id=None):
+    """Like collect_response, but falls back to a generic reply on errors"""
     try:
-        # Format prompt for chat model
-        formatted_prompt = f"<|system|>\\nYou are a helpful mental health support assistant trained in Cognitive Behavioral Therapy (CBT). Provide empathetic, supportive responses.\\n<|user|>\\n{prompt}\\n<|assistant|>\\n"
-        
-        # Generate response
-        outputs = text_generator(
-            formatted_prompt,
-            max_length=len(formatted_prompt.split()) + max_length,
-            num_return_sequences=1,
-            pad_token_id=tokenizer.eos_token_id,
-            eos_token_id=tokenizer.eos_token_id,
-        )
-        
-        # Extract the generated text
-        generated_text = outputs[0]['generated_text']
-        
-        # Extract only the assistant's response
-        if "<|assistant|>" in generated_text:
-            response = generated_text.split("<|assistant|>")[-1].strip()
-        else:
-            response = generated_text[len(formatted_prompt):].strip()
-        
-        # Clean up the response
-        response = response.replace("<|end|>", "").replace("<|endoftext|>", "").strip()
-        
-        # Limit response length
-        sentences = response.split('. ')
-        if len(sentences) > 3:
-            response = '. '.join(sentences[:3]) + '.'
-        
-        return response if response else "I understand you're going through something difficult. Can you tell me more about how you're feeling?"
-        
+        return collect_response(generation, session_id)
+    except Exception as e:
+        print(f"Error generating response: {e}")
+        return FALLBACK_RESPONSE
+
+def generate_response(template, input_ids, max_new_tokens=200, session_id=None):
+    """Generate response using TinyLLaMA"""
+    try:
+        # Generate response in the shared decode batch
+        generation = submit_prompt(template, input_ids, max_new_tokens, session_id)
     except Exception as e:
         print(f"Error generating response: {e}")
-        return "I'm here to listen and support you. Can you share what's on your mind today?"
+        return FALLBACK_RESPONSE
+    
+    return finish_response(generation, session_id)
+
+def stream_response(generation, session_id=None):
+    """Yield pieces of a submitted generation's text as its tokens are decoded"""
+    output_ids = []
+    sent = ""
+    for token_id in generation.stream():
+        output_ids.append(token_id)
+        text = tokenizer.decode(output_ids, skip_special_tokens=True)
+        
+        # Hold back incomplete multi-byte characters until the next token
+        if text.endswith("\\ufffd") or len(text) <= len(sent):
+            continue
+        yield text[len(sent):]
+        sent = text
+    
+    remember_turn(session_id, generation)
+    log_generation(generation, clean_response(sent))
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\\ndata: {json.dumps(data)}\\n\\n"
+
+BUSY_MESSAGE = 'The assistant is busy right now. Please try again shortly.'
+
+def overloaded_response(error):
+    """429 (queue full) or 503 (waited too long) with Retry-After"""
+    from inference_engine import QueueFull
+    
+    response = jsonify({'error': BUSY_MESSAGE, 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429 if isinstance(error, QueueFull) else 503
+
+class BadChatRequest(Exception):
+    """A chat request body that cannot be answered, with its HTTP status"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def check_chat_message(message):
+    """Raise BadChatRequest unless message is a {"role", "content"} chat turn"""
+    if not isinstance(message, dict) or message.get('role') not in ('user', 'assistant'):
+        raise BadChatRequest('Each message needs a role of user or assistant.')
+    content = message.get('content')
+    if not isinstance(content, str):
+        raise BadChatRequest('Each message needs a text content.')
+    if len(content) > MAX_MESSAGE_CHARS:
+        raise BadChatRequest(f'A message is too long (at most {MAX_MESSAGE_CHARS} characters).', 413)
+
+def read_chat_request(data):
+    """(user_input, chat_history, session_id, stored) from a chat request body
+
+    Clients send either {"session_id", "message"}, with the history coming
+    from session_store (stored is True), or the whole conversation as
+    {"messages": [...]} with an optional session_id.
+    """
+    if not isinstance(data, dict):
+        raise BadChatRequest('Expected a JSON object.')
+
+    session_id = data.get('session_id')
+    if session_id is not None and (not isinstance(session_id, str) or not 0 < len(session_id) <= MAX_SESSION_ID_CHARS):
+        raise BadChatRequest('Invalid session_id.')
+
+    if 'message' in data:
+        if session_id is None:
+            raise BadChatRequest('A session_id is required with message.')
+        user_input = data['message']
+        chat_history = session_store.history(session_id)
+        stored = True
+    else:
+        messages = data.get('messages', [])
+        if not isinstance(messages, list):
+            raise BadChatRequest('messages must be a list.')
+        if not messages:
+            raise BadChatRequest('No messages found.')
+        for message in messages:
+            check_chat_message(message)
+        user_input = messages[-1]['content']
+        chat_history = messages[:-1]
+        stored = False
+
+    if not isinstance(user_input, str) or not user_input.strip():
+        raise BadChatRequest('The message is empty.')
+    if len(user_input) > MAX_MESSAGE_CHARS:
+        raise BadChatRequest(f'The message is too long (at most {MAX_MESSAGE_CHARS} characters).', 413)
+    return user_input, chat_history, session_id, stored
+
+def remember_exchange(session_id, stored, user_input, response):
+    """Add a message and its reply to a server-side session history"""
+    if stored:
+        session_store.append(
+            session_id,
+            {'role': 'user', 'content': user_input},
+            {'role': 'assistant', 'content': response},
+        )
 
 @app.route('/')
 def index():
@@ -186,139 +919,392 @@ def index():
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
-    global text_generator
-    
-    if text_generator is None:
+    try:
+        user_input, chat_history, session_id, stored = read_chat_request(request.get_json())
+    except BadChatRequest as e:
+        return jsonify({'error': str(e)}), e.status
+
+    # Crisis phrases are answered before anything is queued, so this reply
+    # never waits for the model, not even while it loads or is saturated
+    crisis = check_crisis_phrases(user_input)
+    if crisis:
+        remember_exchange(session_id, stored, user_input, crisis['response'])
+        return jsonify({'response': crisis['response'], 'crisis': True})
+
+    if not load_progress.ready:
         return jsonify({'error': 'Model is still loading. Please wait a moment and try again.'}), 503
-    
-    data = request.get_json()
-    messages = data.get('messages', [])
 
-    if not messages:
-        return jsonify({'error': 'No messages found.'}), 400
+    from inference_engine import EngineOverloaded
 
     try:
-        user_input = messages[-1]['content']
-        chat_history = messages[:-1]
+        chat_history, prompt_tokens = fit_history(user_input, chat_history)
+        cache_key = ResponseCache.make_key(user_input, chat_history)
 
-        # Assess risk
-        risk_assessment = assess_risk(user_input)
+        # Start the therapeutic response right away so it decodes while the
+        # risk assessment runs, unless a reply is already cached or in flight
+        generation = None
+        try:
+            if not response_cache.pending(cache_key):
+                generation = start_therapeutic_response(user_input, chat_history, session_id, prompt_tokens)
+
+            # Assess risk
+            risk_assessment = assess_model_risk(user_input)
+        except EngineOverloaded as e:
+            if generation is not None:
+                generation.cancel()
+            return overloaded_response(e)
 
         if risk_assessment.get('is_high_risk'):
+            if generation is not None:
+                generation.cancel()
+            remember_exchange(session_id, stored, user_input, risk_assessment.get('response'))
             return jsonify({'response': risk_assessment.get('response'), 'crisis': True})
 
-        # Generate therapeutic response
-        therapeutic_response = generate_therapeutic_response(user_input, chat_history)
+        # Release the therapeutic response only once the risk verdict is in.
+        # Crisis messages never get here, so they are never cached.
+        def compute():
+            pending = generation or start_therapeutic_response(user_input, chat_history, session_id, prompt_tokens)
+            return collect_response(pending, session_id)
+
+        try:
+            therapeutic_response, source = response_cache.get_or_compute(cache_key, compute)
+        except EngineOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            therapeutic_response, source = FALLBACK_RESPONSE, "error"
+
+        if source in ("hit", "coalesced") and generation is not None:
+            # An identical request produced the reply first
+            generation.cancel()
+        remember_exchange(session_id, stored, user_input, therapeutic_response)
         return jsonify({'response': therapeutic_response, 'crisis': False})
 
     except Exception as e:
         print(f"Error: {e}")
         return jsonify({'error': 'An error occurred while processing your request.'}), 500
 
-def assess_risk(user_input):
-    """Assess if user input indicates high-risk situation"""
-    
-    # High-risk keywords and phrases
-    high_risk_patterns = [
-        r'\\b(kill myself|end my life|suicide|want to die)\\b',
-        r'\\b(going to hurt myself|plan to hurt|self harm)\\b',
-        r'\\b(can\\'t go on|nothing to live for|better off dead)\\b',
-        r'\\b(going to end it|ready to die|want to disappear forever)\\b'
-    ]
-    
-    # Check for high-risk patterns
-    user_lower = user_input.lower()
-    for pattern in high_risk_patterns:
-        if re.search(pattern, user_lower):
-            return {
-                "is_high_risk": True,
-                "response": "It sounds like you are going through a very difficult time, and I want you to know that your safety is the most important thing. Please connect with someone who can support you right now. You can call the Nigerian emergency hotline at 112, or reach out to the Suicide Research and Prevention Initiative (SURPIN) at 08092106463. You don't have to go through this alone."
-            }
-    
-    # Use AI for more nuanced assessment
-    assessment_prompt = f"""Analyze this message for signs of immediate self-harm risk. Respond with only 'HIGH_RISK' or 'LOW_RISK'.
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    """Stream the therapeutic response as server-sent events"""
+    try:
+        user_input, chat_history, session_id, stored = read_chat_request(request.get_json())
+    except BadChatRequest as e:
+        return jsonify({'error': str(e)}), e.status
 
-Look for explicit statements about:
-- Plans to hurt oneself
-- Immediate intent to self-harm
-- Active suicidal ideation with method or timeline
+    # Crisis phrases are answered before anything is queued
+    crisis = check_crisis_phrases(user_input)
+    if crisis:
+        remember_exchange(session_id, stored, user_input, crisis['response'])
+        return Response(
+            sse_event('done', {'response': crisis['response'], 'crisis': True}),
+            mimetype='text/event-stream',
+        )
+
+    if not load_progress.ready:
+        return jsonify({'error': 'Model is still loading. Please wait a moment and try again.'}), 503
+
+    from inference_engine import EngineOverloaded
+
+    # Tokens decode while the risk assessment runs, but they stay queued in
+    # the request until the verdict is in
+    generation = None
+    try:
+        chat_history, prompt_tokens = fit_history(user_input, chat_history)
+        cache_key = ResponseCache.make_key(user_input, chat_history)
+        if not response_cache.pending(cache_key):
+            generation = start_therapeutic_response(user_input, chat_history, session_id, prompt_tokens)
+        risk_assessment = assess_model_risk(user_input)
 
-Message: "{user_input}"
+        cached = None
+        if risk_assessment.get('is_high_risk'):
+            if generation is not None:
+                generation.cancel()
+        else:
+            cached = response_cache.get(cache_key)
+            if cached is not None and generation is not None:
+                generation.cancel()
+            elif cached is None and generation is None:
+                generation = start_therapeutic_response(user_input, chat_history, session_id, prompt_tokens)
+    except EngineOverloaded as e:
+        if generation is not None:
+            generation.cancel()
+        return overloaded_response(e)
+    except Exception as e:
+        if generation is not None:
+            generation.cancel()
+        print(f"Error: {e}")
+        return Response(
+            sse_event('error', {'error': 'An error occurred while processing your request.'}),
+            mimetype='text/event-stream',
+        )
+
+    def events():
+        if risk_assessment.get('is_high_risk'):
+            remember_exchange(session_id, stored, user_input, risk_assessment.get('response'))
+            yield sse_event('done', {'response': risk_assessment.get('response'), 'crisis': True})
+            return
+
+        if cached is not None:
+            remember_exchange(session_id, stored, user_input, cached)
+            yield sse_event('done', {'response': cached, 'crisis': False})
+            return
+
+        try:
+            text = ""
+            for piece in stream_response(generation, session_id):
+                text += piece
+                yield sse_event('token', {'text': piece})
+            with stage_seconds.time(stage="postprocess"):
+                response = clean_response(text)
+            response_cache.put(cache_key, response)
+            remember_exchange(session_id, stored, user_input, response)
+            yield sse_event('done', {'response': response, 'crisis': False})
+        except EngineOverloaded as e:
+            # Waited too long for a batch slot
+            yield sse_event('error', {'error': BUSY_MESSAGE, 'retry_after': e.retry_after})
+        except Exception as e:
+            print(f"Error: {e}")
+            yield sse_event('error', {'error': 'An error occurred while processing your request.'})
+        finally:
+            # Stop decoding if the client went away mid-stream
+            generation.cancel()
 
-Assessment:"""
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+def build_risk_prompt(user_input):
+    """Token ids of the prompt asking the model to classify self-harm risk"""
+    return encode_prompt("risk", user_input)
+
+def score_risk(user_input):
+    """Probability that a message is HIGH_RISK, from one forward pass
+    
+    Verdicts are cached by the hash of the normalized message, so repeated
+    messages skip the model entirely.
+    """
+    key = hashlib.sha256(normalize_text(user_input).encode("utf-8")).hexdigest()
+    with risk_verdicts_lock:
+        if key in risk_verdicts:
+            risk_verdicts.move_to_end(key)
+            return risk_verdicts[key]
+    
+    with stage_seconds.time(stage="tokenize"):
+        input_ids = build_risk_prompt(user_input)
+    request = inference_engine.submit(
+        input_ids, 0, prefix=prefix_cache.get("risk"), score_token_ids=risk_label_ids, priority="high"
+    )
+    request.result()
+    record_generation_timings(request)
+    high_logit, low_logit = request.scores
+    
+    # Calibrated sigmoid of the label logit difference
+    margin = (high_logit - low_logit) / RISK_CALIBRATION_TEMPERATURE + RISK_CALIBRATION_BIAS
+    probability = 1.0 / (1.0 + math.exp(-max(min(margin, 60.0), -60.0)))
+    
+    with risk_verdicts_lock:
+        risk_verdicts[key] = probability
+        while len(risk_verdicts) > RISK_CACHE_SIZE:
+            risk_verdicts.popitem(last=False)
+    return probability
+
+def check_crisis_phrases(user_input):
+    """Lexical stage of the risk assessment: a crisis verdict, or None
+    
+    Needs no model, so the routes run it before anything is queued.
+    """
+    with stage_seconds.time(stage="regex_risk"):
+        matches = crisis_matcher.find_all(user_input)
+    if matches:
+        crisis_responses.inc(stage="lexicon")
+        return {
+            "is_high_risk": True,
+            "matches": [match._asdict() for match in matches],
+            "response": CRISIS_RESPONSE
+        }
+    return None
 
+def assess_model_risk(user_input, strict=False):
+    """Model stage of the risk assessment, for messages without crisis phrases
+    
+    Runs at high priority in the inference engine, ahead of every queued
+    therapeutic generation. Raises inference_engine.EngineOverloaded when the
+    check cannot run now, so callers turn the request away instead of
+    treating it as low risk. Any other failure counts as low risk so the chat
+    still answers, unless strict is set: then it raises too, and
+    batch_pipeline.py records the item as an error.
+    """
+    from inference_engine import EngineOverloaded
+    
+    # Use AI for more nuanced assessment
+    start = time.perf_counter()
     try:
-        assessment_response = generate_response(assessment_prompt, max_length=10)
+        if RISK_ASSESSMENT_MODE == "score":
+            probability = score_risk(user_input)
+            is_high_risk = probability >= RISK_THRESHOLD
+        else:
+            probability = None
+            generation = submit_prompt("risk", build_risk_prompt(user_input), max_new_tokens=10, priority="high")
+            assessment_response = collect_response(generation)
+            is_high_risk = "HIGH_RISK" in assessment_response.upper()
         
-        if "HIGH_RISK" in assessment_response.upper():
+        if is_high_risk:
+            crisis_responses.inc(stage="model")
             return {
                 "is_high_risk": True,
-                "response": "It sounds like you are going through a very difficult time, and I want you to know that your safety is the most important thing. Please connect with someone who can support you right now. You can call the Nigerian emergency hotline at 112, or reach out to the Suicide Research and Prevention Initiative (SURPIN) at 08092106463. You don't have to go through this alone."
+                "risk_probability": probability,
+                "response": CRISIS_RESPONSE
             }
-    except:
-        pass
+    except EngineOverloaded:
+        raise
+    except Exception as e:
+        if strict:
+            raise
+        print(f"Risk assessment failed: {e}")
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage="llm_risk")
     
     return {"is_high_risk": False, "response": ""}
 
-def generate_therapeutic_response(user_input, chat_history):
-    """Generate CBT-focused therapeutic response"""
-    
-    # Build conversation context
-    history_context = ""
-    if chat_history:
-        recent_messages = chat_history[-4:]  # Last 4 messages for context
-        for msg in recent_messages:
-            role = "User" if msg['role'] == 'user' else "Assistant"
-            history_context += f"{role}: {msg['content']}\\n"
-    
-    # Create CBT-focused prompt
-    prompt = f"""You are a mental health support chatbot specializing in Cognitive Behavioral Therapy (CBT). Your goal is to help users identify and challenge negative thought patterns.
+def assess_risk(user_input):
+    """Assess if user input indicates high-risk situation"""
+    return check_crisis_phrases(user_input) or assess_model_risk(user_input)
 
-Conversation history:
-{history_context}
+def fit_history(user_input, chat_history):
+    """The most recent history turns that fit in the prompt's token budget
 
-User's current message: "{user_input}"
+    The history is packed as the turns the prompt is built from
+    (PromptTemplate.turns): consecutive messages of one role are one turn,
+    and user messages after the last reply join the current message's turn.
+    Returns the kept turns as messages, so the prompt built from them is the
+    one costed, with its token breakdown: template, history and message
+    tokens, and how many history turns were kept and left out.
+    """
+    template = prompt_templates["therapeutic"]
+    *history_turns, (_, message_text) = template.turns(user_input, chat_history)
+    with stage_seconds.time(stage="tokenize"):
+        message_count = message_tokens.count(message_text)
+    budget = PROMPT_TOKEN_BUDGET - template.fixed_tokens - message_count
 
-Provide a response that is:
-1. Empathetic and validating - acknowledge their feelings
-2. CBT-focused - help identify thinking patterns or cognitive distortions
-3. Ask gentle questions to promote self-reflection
-4. Suggest a small, manageable step or reframing technique
-5. Keep it concise and supportive (2-3 sentences max)
+    def cost(turn):
+        role, text = turn
+        return message_tokens.count(text) + template.turn_tokens(role)
+
+    kept, history_tokens = pack_history(history_turns, budget, cost)
+    if kept and kept[0][0] != "user":
+        # The prompt's history opens with a user turn; turns() drops the rest
+        history_tokens -= cost(kept.pop(0))
 
-Response:"""
+    # The user messages after the last reply go back in as they were, to
+    # join the current message again
+    trailing = len(chat_history)
+    while trailing and chat_history[trailing - 1]['role'] == 'user':
+        trailing -= 1
+    history = [{"role": role, "content": text} for role, text in kept] + list(chat_history[trailing:])
+    return history, {
+        "template": template.fixed_tokens,
+        "history": history_tokens,
+        "message": message_count,
+        "history_turns": len(kept),
+        "dropped_turns": len(history_turns) - len(kept),
+    }
 
-    return generate_response(prompt, max_length=100)
+def build_therapeutic_prompt(user_input, chat_history):
+    """Token ids of the CBT-focused prompt for the current conversation
+
+    Every message in chat_history goes in as a chat turn; fit_history picks
+    them. Each turn's prompt extends the previous one, so the conversation's
+    cached attention state covers all of it.
+    """
+    return encode_prompt("therapeutic", user_input, chat_history)
+
+def start_therapeutic_response(user_input, chat_history, session_id=None, prompt_tokens=None):
+    """Queue the CBT-focused response and return its generation request
+
+    chat_history is used as given when prompt_tokens (its breakdown from
+    fit_history) is passed, and fitted to the token budget otherwise.
+    """
+    with stage_seconds.time(stage="prompt_build"):
+        if prompt_tokens is None:
+            chat_history, prompt_tokens = fit_history(user_input, chat_history)
+        input_ids = build_therapeutic_prompt(user_input, chat_history)
+    return submit_prompt("therapeutic", input_ids, max_new_tokens=100, session_id=session_id, prompt_tokens=prompt_tokens)
+
+def generate_therapeutic_response(user_input, chat_history, session_id=None):
+    """Generate CBT-focused therapeutic response"""
+    chat_history, _ = fit_history(user_input, chat_history)
+    return generate_response(
+        "therapeutic", build_therapeutic_prompt(user_input, chat_history), max_new_tokens=100, session_id=session_id
+    )
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Check if the model is loaded and ready"""
-    global text_generator
+    """Check if the model is loaded and ready, with per-stage load progress"""
+    progress = load_progress.snapshot()
     
-    if text_generator is None:
-        return jsonify({'status': 'loading', 'message': 'Model is still loading...'}), 503
+    if load_progress.failed:
+        return jsonify({'status': 'error', 'message': 'Model failed to load.', 'progress': progress}), 503
+    elif not load_progress.ready:
+        return jsonify({'status': 'loading', 'message': 'Model is still loading...', 'progress': progress}), 503
     else:
-        return jsonify({'status': 'ready', 'message': 'Model is ready to chat!'})
+        return jsonify({
+            'status': 'ready',
+            'message': 'Model is ready to chat!',
+            'progress': progress,
+            'worker': os.getpid(),
+            'backend': MODEL_BACKEND,
+            'compiled': model_compiled,
+            'queue': inference_engine.stats(),
+            'response_cache': response_cache.stats(),
+            'sessions': session_store.stats(),
+            'message_tokens': message_tokens.stats(),
+        })
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Latency, throughput, queue and model-load metrics for Prometheus"""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+def start_model_loading(cpu_settings=None):
+    """Load the model in a background thread while the server answers requests
+    
+    cpu_settings from cpu_tuning.py are applied in that thread, before torch
+    is imported, so the page is served without waiting for torch and the
+    model's threads inherit the core pinning.
+    """
+    def load():
+        if cpu_settings:
+            apply_cpu_config(cpu_settings)
+        if initialize_model():
+            print("Model loaded successfully!")
+        else:
+            print("Failed to load model from cache.")
+            print("You may need to re-download the model or check the cache integrity.")
+    
+    threading.Thread(target=load, name="model-loader", daemon=True).start()
 
 if __name__ == '__main__':
     print("Starting AI Mental Health Chatbot (Portable Version)...")
     
     # Check if model cache exists
-    if not MODELS_DIR.exists() or not any(MODELS_DIR.iterdir()):
+    has_cache = MODELS_DIR.exists() and any(MODELS_DIR.iterdir())
+    if not has_cache and read_snapshot_info(SNAPSHOT_DIR) is None:
         print("Model cache not found!")
         print("Please run the portable setup script first to download the model.")
         print("Or copy the 'models' folder from a computer that has already downloaded it.")
         sys.exit(1)
     
-    print("Model cache found, initializing...")
+    # With debug=True the reloader serves from a child process, so only that
+    # process loads the model
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        cpu_settings = load_cpu_config(CPU_TUNING_PATH, "single_process", MODEL_BACKEND, MODEL_PRECISION)
+        print("Model cache found, initializing in the background...")
+        start_model_loading(cpu_settings)
     
-    if initialize_model():
-        print("Model loaded successfully!")
-        print("Starting Flask server...")
-        app.run(debug=True, host='127.0.0.1', port=5000)
-    else:
-        print("Failed to load model from cache.")
-        print("You may need to re-download the model or check the cache integrity.")
+    print("Starting Flask server...")
+    app.run(debug=True, host='127.0.0.1', port=5000)
 '''
     
     with open("app_portable.py", "w") as f:
@@ -413,21 +1399,49 @@ def main():
     print_step(1, "Creating Portable Structure")
     models_dir, cache_dir = create_portable_structure()
     
+    # Settings that decide what is downloaded and exported are read from
+    # .env like the app does
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    from model_loader import DRAFT_MODEL_NAME
+    
     print_step(2, "Downloading Model to Local Cache")
-    if not download_and_cache_model(cache_dir):
+    if not download_and_cache_model(cache_dir, os.getenv("DRAFT_MODEL", DRAFT_MODEL_NAME)):
         print("Failed to download model")
         return False
     
-    print_step(3, "Creating Portable App")
+    print_step(3, "Writing Fast-Start Model Snapshot")
+    # Weights are stored in the dtype and for the backend app_portable.py
+    # will run them with
+    precision = os.getenv("MODEL_PRECISION", "float32")
+    backend = os.getenv("MODEL_BACKEND", "pytorch")
+    if not create_model_snapshot(cache_dir, models_dir / "snapshot", precision):
+        print("Snapshot not written; app_portable.py will load from the cache instead")
+    
+    print_step(4, "Exporting ONNX Model")
+    if backend == "onnx":
+        # Where app_portable.py looks for it (ONNX_DIR, as in the app)
+        if not create_onnx_export(cache_dir, Path(os.getenv("ONNX_DIR", models_dir / "onnx")), precision):
+            print("ONNX export failed; set MODEL_BACKEND=pytorch to run without it")
+    else:
+        print("Skipped: set MODEL_BACKEND=onnx in .env to export the model for ONNX Runtime")
+    
+    print_step(5, "Creating Portable App")
     create_portable_app()
     
-    print_step(4, "Creating Run Scripts")
+    print_step(6, "Creating Run Scripts")
     create_run_scripts()
     
-    print_step(5, "Setup Complete!")
+    print_step(7, "Setup Complete!")
     print("Portable setup complete!")
     print("\nYour project is now portable! Here's what was created:")
     print("- models/ - Contains the TinyLLaMA model files")
+    print("- models/snapshot/ - Preconverted weights for fast start-up")
+    if backend == "onnx":
+        print(f"- {os.getenv('ONNX_DIR', 'models/onnx/')} - ONNX Runtime export of the model")
     print("- app_portable.py - Modified app that uses local cache")
     print("- run_portable.bat/.sh - Easy run scripts")
     
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Pre-forked multi-worker server for the chatbot (Linux/macOS).
+
+The model weights are loaded once in the parent process, which then forks the
+workers. Each worker serves the Flask app on the shared listening socket and
+reads the weights through copy-on-write pages, so N workers cost little more
+memory than one. Everything that holds threads or model state (the
+inference engine, prompt-prefix and conversation KV caches) is created in
+each worker after the fork. The reply cache and session store are created
+when the app is imported, in the parent, which never uses them: each worker
+starts from its own empty copy, and the SQLite session store opens its
+connections in the worker.
+
+Each worker gets its own slice of the CPU cores for PyTorch's thread pool so
+the workers do not oversubscribe the machine. When cpu_tuning.py has measured
+this machine, its "prefork" settings give the worker count (unless --workers
+is passed), the threads per worker and whether workers are pinned to their
+cores.
+
+Chat histories of clients that send only their new message live in each
+worker's memory unless SESSION_DB_PATH points them at a SQLite database all
+workers share; with more than one worker, set it.
+
+With TORCH_COMPILE=1 each worker compiles the forward pass for itself. The
+compiled kernels land in one on-disk cache, so only the first start compiles
+them from scratch.
+
+With MODEL_BACKEND=onnx nothing is shared: ONNX Runtime sessions cannot
+cross a fork, so every worker loads the export itself.
+
+Usage:
+    python prefork_server.py --workers 4
+    python prefork_server.py --workers 4 --portable
+"""
+
+import argparse
+import gc
+import importlib
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from cpu_tuning import apply_cpu_config, load_cpu_config
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def serve_worker(app_module, listener, host, port, settings, rank):
+    """Run in a forked child: finish initialization and serve requests"""
+    from werkzeug.serving import make_server
+
+    # Before any thread starts, so they all inherit the pinning
+    apply_cpu_config(settings, rank)
+
+    # Like the single-process app, answer /api/health while warming up
+    app_module.start_model_loading()
+
+    server = make_server(host, port, app_module.app, threaded=True, fd=listener.fileno())
+    print(f"Worker {os.getpid()} serving with {settings['threads']} threads")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def spawn(app_module, listener, host, port, settings, rank):
+    pid = os.fork()
+    if pid == 0:
+        # The parent's shutdown handler must not run in the child
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        code = 0
+        try:
+            serve_worker(app_module, listener, host, port, settings, rank)
+        except Exception as e:
+            print(f"Worker {os.getpid()} failed: {e}")
+            code = 1
+        finally:
+            # Skip the parent's atexit handlers and buffered state
+            os._exit(code)
+    return pid
+
+
+def main():
+    if not hasattr(os, "fork"):
+        sys.exit("prefork_server.py needs os.fork (Linux or macOS); use app.py on Windows")
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, help="default: the count cpu_tuning.py measured as fastest, else 2")
+    parser.add_argument("--threads-per-worker", type=int, help="default: from cpu_tuning.py, else available cores / workers")
+    parser.add_argument("--portable", action="store_true", help="serve app_portable.py instead of app.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+
+    # The Rust tokenizer's thread pool does not survive fork either
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    import torch
+
+    # No intra-op thread pool may exist in the parent at fork time: OpenMP
+    # pools do not survive fork and can deadlock the workers
+    torch.set_num_threads(1)
+
+    app_module = importlib.import_module("app_portable" if args.portable else "app")
+
+    settings = load_cpu_config(app_module.CPU_TUNING_PATH, "prefork", app_module.MODEL_BACKEND, app_module.MODEL_PRECISION)
+    if settings is not None and args.workers not in (None, settings["workers"]):
+        print(f"CPU tuning is for {settings['workers']} workers, not {args.workers}; dividing the cores evenly instead")
+        settings = None
+    if settings is None:
+        workers = args.workers or 2
+        settings = {"workers": workers, "threads": max(1, available_cores() // workers), "pin_cores": False}
+    if args.threads_per_worker:
+        settings["threads"] = args.threads_per_worker
+    args.workers = settings["workers"]
+    threads = settings["threads"]
+    if app_module.MODEL_BACKEND == "onnx":
+        # An ONNX Runtime session owns a thread pool from the moment it is
+        # created, so each worker loads its own
+        print(f"MODEL_BACKEND=onnx: each of the {args.workers} workers loads its own ONNX Runtime session")
+    else:
+        print(f"Loading weights once for {args.workers} workers...")
+        app_module.load_weights()
+        if app_module.SPECULATIVE_DECODING:
+            app_module.load_draft_weights()
+
+    if args.workers > 1 and not app_module.SESSION_DB_PATH:
+        print("Warning: SESSION_DB_PATH is not set, so each worker keeps its own chat histories "
+              "and a conversation loses its history when it reaches another worker")
+
+    # Objects that exist now are never collected, so the garbage collector
+    # does not touch (and copy) their pages in the workers
+    gc.collect()
+    gc.freeze()
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(128)
+    listener.set_inheritable(True)
+
+    workers = {}  # pid -> rank, which picks the worker's cores
+    for rank in range(args.workers):
+        workers[spawn(app_module, listener, args.host, args.port, settings, rank)] = rank
+    print(f"Serving on http://{args.host}:{args.port} with {args.workers} workers x {threads} threads")
+
+    stopping = threading.Event()
+
+    def shutdown(signum, frame):
+        stopping.set()
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # Replace workers that die, until asked to stop
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        rank = workers.pop(pid, None)
+        if not stopping.is_set() and rank is not None:
+            print(f"Worker {pid} exited with status {status}; starting a replacement")
+            time.sleep(1)
+            workers[spawn(app_module, listener, args.host, args.port, settings, rank)] = rank
+
+
+if __name__ == "__main__":
+    main()
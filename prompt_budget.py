@@ -0,0 +1,86 @@
+"""
+Token budget for the conversation history in the therapeutic prompt.
+
+The prompt holds as many of the most recent messages as fit in the tokens its
+template and the current message leave of the budget, instead of a fixed
+number of messages: one pasted wall of text cannot blow up the prefill, and a
+run of short messages keeps more context.
+
+Token ids are cached by message text. A message is tokenized once, when it
+is the current message, and its ids are reused for the risk prompt and on
+every later turn that carries it in the history, both to count it against
+the budget and to assemble the prompt (see prompt_templates.py). Messages
+the chat template joins into one turn are cached as the joined text.
+"""
+
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+
+
+class TokenCache:
+    """Token ids of texts, least recently used evicted first
+
+    ``encode(text)`` does the tokenizing on a miss.
+    """
+
+    def __init__(self, encode, max_entries=16384):
+        self._encode = encode
+        self.max_entries = max_entries
+        self._ids = OrderedDict()  # text digest -> array of token ids
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, text):
+        """The token ids of text"""
+        # Keyed by digest so long messages are not kept alive by the cache
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            ids = self._ids.get(key)
+            if ids is not None:
+                self._ids.move_to_end(key)
+                self.hits += 1
+                return ids.tolist()
+
+        ids = self._encode(text)
+        with self._lock:
+            self.misses += 1
+            self._ids[key] = array("i", ids)
+            while len(self._ids) > self.max_entries:
+                self._ids.popitem(last=False)
+        return list(ids)
+
+    def count(self, text):
+        """The number of tokens in text"""
+        return len(self.encode(text))
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._ids),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def pack_history(turns, budget, cost):
+    """The newest turns whose total cost fits in ``budget``, oldest first
+
+    ``cost(turn)`` gives a turn's tokens in the prompt. Packing stops at the
+    first turn that does not fit, so the history kept has no gaps. Returns
+    the turns and their total cost.
+    """
+    kept = []
+    used = 0
+    for turn in reversed(turns):
+        tokens = cost(turn)
+        if used + tokens > budget:
+            break
+        kept.append(turn)
+        used += tokens
+    kept.reverse()
+    return kept, used
@@ -0,0 +1,127 @@
+"""
+Chat prompts assembled from pre-tokenized pieces.
+
+Prompts are built with the tokenizer's own chat template, so the model sees
+the format it was trained on and the system instructions appear once. At
+startup a PromptTemplate renders the chat template around placeholder
+messages, cuts the text into the fixed pieces between them and tokenizes
+each piece once:
+
+- head: start of the prompt, the system instructions and the opening of the
+  first user turn
+- after_user: end of a user turn and opening of an assistant turn
+- after_assistant: end of an assistant turn and opening of a user turn
+- tail: end of the last user turn and the assistant's generation prompt
+
+A prompt's input ids are these pieces concatenated with the token ids of the
+messages, so a request only tokenizes its message text (and that once, with
+prompt_budget.TokenCache). Message text is tokenized as it reads after a
+newline (kv_cache.encode_continuation), which is how TinyLLaMA's template
+opens a turn; benchmarks/check_prompt_templates.py checks the result against
+tokenizing the whole rendered prompt.
+
+Every prompt of a template starts with its head, so the head's key/values
+are computed once (kv_cache.PrefixCache).
+"""
+
+from kv_cache import encode_continuation
+
+# Placeholder message contents the chat template is rendered around
+_MARKS = ("@@SYSTEM@@", "@@USER@@", "@@ASSISTANT@@", "@@LAST_USER@@")
+
+
+def _split(text, marks):
+    """Cut text at each mark in turn; every mark must appear exactly once"""
+    pieces = []
+    for mark in marks:
+        if text.count(mark) != 1:
+            raise ValueError(f"Chat template does not render each message once ({mark!r})")
+        before, text = text.split(mark)
+        pieces.append(before)
+    pieces.append(text)
+    return pieces
+
+
+class PromptTemplate:
+    """System instructions in the tokenizer's chat template, fixed pieces tokenized once"""
+
+    def __init__(self, tokenizer, name, system):
+        self.tokenizer = tokenizer
+        self.name = name
+        self.system = system
+
+        system_mark, user_mark, assistant_mark, last_user_mark = _MARKS
+        text = tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": system_mark},
+                {"role": "user", "content": user_mark},
+                {"role": "assistant", "content": assistant_mark},
+                {"role": "user", "content": last_user_mark},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+        start, system_to_user, after_user, after_assistant, tail = _split(text, _MARKS)
+
+        self.head_ids = self._tokenize_start(start + system + system_to_user)
+        self.after_user_ids = encode_continuation(tokenizer, after_user)
+        self.after_assistant_ids = encode_continuation(tokenizer, after_assistant)
+        self.tail_ids = encode_continuation(tokenizer, tail)
+
+    def _tokenize_start(self, text):
+        """Tokenize text that starts a prompt, adding BOS unless the template wrote it"""
+        bos_token = getattr(self.tokenizer, "bos_token", None)
+        add_bos = not (bos_token and text.startswith(bos_token))
+        return self.tokenizer(text, add_special_tokens=add_bos)["input_ids"]
+
+    @property
+    def fixed_tokens(self):
+        """Tokens of a prompt with no history, besides the message itself"""
+        return len(self.head_ids) + len(self.tail_ids)
+
+    def turn_tokens(self, role):
+        """Tokens a history message adds besides its own text"""
+        return len(self.after_user_ids if role == "user" else self.after_assistant_ids)
+
+    @staticmethod
+    def turns(message, history=()):
+        """History plus the message as alternating (role, text) turns
+
+        Chat templates expect user and assistant turns to alternate starting
+        with the user, so history that opens with assistant messages loses
+        them, and consecutive messages of one role are joined.
+        """
+        turns = []
+        for msg in list(history) + [{"role": "user", "content": message}]:
+            role = "user" if msg["role"] == "user" else "assistant"
+            if turns and turns[-1][0] == role:
+                turns[-1] = (role, f"{turns[-1][1]}\n{msg['content']}")
+            elif turns or role == "user":
+                turns.append((role, msg["content"]))
+        return turns
+
+    def encode(self, message, history=(), encode_text=None):
+        """Input ids of the prompt answering message after history
+
+        encode_text tokenizes message text (a cache's encode, typically);
+        it defaults to tokenizing afresh.
+        """
+        encode_text = encode_text or (lambda text: encode_continuation(self.tokenizer, text))
+        input_ids = list(self.head_ids)
+        turns = self.turns(message, history)
+        for role, text in turns[:-1]:
+            input_ids += encode_text(text)
+            input_ids += self.after_user_ids if role == "user" else self.after_assistant_ids
+        input_ids += encode_text(turns[-1][1])
+        input_ids += self.tail_ids
+        return input_ids
+
+    def render(self, message, history=()):
+        """The prompt as text, straight from the chat template"""
+        messages = [{"role": "system", "content": self.system}]
+        messages += [{"role": role, "content": text} for role, text in self.turns(message, history)]
+        return self.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+    def reference_ids(self, message, history=()):
+        """Input ids from tokenizing the whole rendered prompt, for checking encode"""
+        return self._tokenize_start(self.render(message, history))
@@ -0,0 +1,148 @@
+"""
+Cache of finished therapeutic replies for /api/chat.
+
+Much of the traffic is near-identical openers ("hi", "I feel anxious") with
+little or no history, so replies are cached by the normalized message plus
+the history window the prompt is built from. Entries expire after a TTL and
+are evicted least-recently-used first when the entry count or memory budget
+is exceeded. Identical requests that arrive while a reply is being generated
+wait for that generation instead of starting their own.
+
+Callers must only consult the cache for messages that passed the risk check:
+crisis replies are never cached or served from here.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from risk_matcher import normalize_text
+
+
+class _Flight:
+    """A reply being generated that identical requests can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    """LRU + TTL reply cache with request coalescing"""
+
+    def __init__(self, max_entries=1024, max_mb=16, ttl_seconds=3600):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 2**20)
+        self.ttl_seconds = ttl_seconds
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()  # key -> (reply, size, stored_at)
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(user_input, history):
+        """Cache key for a message and the history window its prompt uses"""
+        normalized = {
+            "message": normalize_text(user_input),
+            "history": [[msg["role"], normalize_text(msg["content"])] for msg in history],
+        }
+        return hashlib.sha256(json.dumps(normalized, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """Return a fresh cached reply, or None"""
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+            return value
+
+    def pending(self, key):
+        """Whether a reply for key is cached or currently being generated"""
+        with self._lock:
+            return key in self._flights or self._lookup(key) is not None
+
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    def get_or_compute(self, key, compute):
+        """Return (reply, source) where source is "hit", "coalesced" or "miss"
+
+        Only the first caller for a key runs ``compute``; concurrent callers
+        with the same key wait for its result. Failures are not cached and
+        are raised to every waiter.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not None:
+                self.hits += 1
+                return value, "hit"
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, "coalesced"
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                if flight.error is None and flight.value is not None:
+                    self._store(key, flight.value)
+                del self._flights[key]
+            flight.done.set()
+        return flight.value, "miss"
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, size, stored_at = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self._entries[key]
+            self.nbytes -= size
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        size = len(key) + len(value.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        self._entries[key] = (value, size, time.monotonic())
+        self.nbytes += size
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_size
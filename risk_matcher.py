@@ -0,0 +1,163 @@
+"""
+Compiled crisis-phrase matcher for the first stage of assess_risk.
+
+Phrases come from an external lexicon file maintained by the clinical team
+(see data/crisis_lexicon.tsv) and are compiled once into an Aho-Corasick
+automaton, so matching a message costs one pass over its characters no
+matter how many phrases the lexicon holds.
+
+Both the lexicon and incoming messages go through the same normalization:
+Unicode compatibility folding, case folding, removal of diacritics (so
+Yoruba tone marks and Igbo dotted vowels are optional), unified apostrophes,
+and hyphens/whitespace collapsed to single spaces.
+"""
+
+import unicodedata
+from collections import deque, namedtuple
+from functools import lru_cache
+from pathlib import Path
+
+# A matched lexicon phrase and where it occurs in the original message
+PhraseMatch = namedtuple("PhraseMatch", ["phrase", "language", "category", "start", "end"])
+
+LexiconEntry = namedtuple("LexiconEntry", ["phrase", "language", "category"])
+
+_APOSTROPHES = {"‘", "’", "ʼ", "`", "´"}
+_SEPARATORS = {"-", "‐", "‑", "‒", "–", "—", "_"}
+
+
+@lru_cache(maxsize=4096)
+def _normalize_char(char):
+    """Normalized form of one character (may be empty or several characters)"""
+    if char in _APOSTROPHES:
+        return "'"
+    if char in _SEPARATORS or char.isspace():
+        return " "
+    folded = unicodedata.normalize("NFKD", unicodedata.normalize("NFKC", char).casefold())
+    return "".join(c for c in folded if not unicodedata.combining(c))
+
+
+def normalize_with_offsets(text):
+    """Normalize text and map each normalized character to its source index"""
+    chars = []
+    offsets = []
+    for index, char in enumerate(text):
+        for normalized in _normalize_char(char):
+            # Collapse runs of whitespace into a single space
+            if normalized == " " and (not chars or chars[-1] == " "):
+                continue
+            chars.append(normalized)
+            offsets.append(index)
+    if chars and chars[-1] == " ":
+        chars.pop()
+        offsets.pop()
+    return "".join(chars), offsets
+
+
+def normalize_text(text):
+    """Normalize text the same way lexicon phrases are normalized"""
+    return normalize_with_offsets(text)[0]
+
+
+def load_lexicon(path):
+    """Read a lexicon file: one ``phrase<TAB>language<TAB>category`` per line
+
+    Blank lines and lines starting with ``#`` are ignored; language and
+    category are optional.
+    """
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.lstrip().startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split("\t")]
+            fields += [""] * (3 - len(fields))
+            entries.append(LexiconEntry(fields[0], fields[1] or "und", fields[2] or "crisis"))
+    return entries
+
+
+class PhraseMatcher:
+    """Aho-Corasick automaton over normalized lexicon phrases"""
+
+    def __init__(self, entries):
+        self.entries = []
+        self._goto = [{}]      # state -> {char: next state}
+        self._fail = [0]       # state -> longest proper suffix state
+        self._outputs = [[]]   # state -> indexes of entries ending here
+
+        seen = set()
+        for entry in entries:
+            phrase = normalize_text(entry.phrase)
+            if not phrase or phrase in seen:
+                continue
+            seen.add(phrase)
+            self._add(phrase, len(self.entries))
+            self.entries.append(LexiconEntry(phrase, entry.language, entry.category))
+        self._build_failure_links()
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load_lexicon(Path(path)))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, phrase, index):
+        state = 0
+        for char in phrase:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append([])
+            state = next_state
+        self._outputs[state].append(index)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = target if target != next_state else 0
+                self._outputs[next_state] = self._outputs[next_state] + self._outputs[self._fail[next_state]]
+
+    def find_all(self, text):
+        """Return every lexicon phrase found in text as whole words"""
+        normalized, offsets = normalize_with_offsets(text)
+        matches = []
+        state = 0
+        for position, char in enumerate(normalized):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+
+            for index in self._outputs[state]:
+                entry = self.entries[index]
+                start = position - len(entry.phrase) + 1
+                end = position + 1
+                # Only whole words count, like \b in the old regexes
+                if start > 0 and normalized[start - 1].isalnum() and entry.phrase[0].isalnum():
+                    continue
+                if end < len(normalized) and normalized[end].isalnum() and entry.phrase[-1].isalnum():
+                    continue
+                matches.append(PhraseMatch(
+                    entry.phrase,
+                    entry.language,
+                    entry.category,
+                    offsets[start],
+                    offsets[end - 1] + 1,
+                ))
+        return matches
+
+    def search(self, text):
+        """Return the first matching phrase in text, or None"""
+        matches = self.find_all(text)
+        return matches[0] if matches else None
@@ -0,0 +1,159 @@
+"""
+Server-side chat histories for the delta chat protocol.
+
+The web page sends only its new message and a session id; the history the
+prompt is built from is kept here, so request size and parsing cost stay
+constant however long the conversation gets. Each session keeps its newest
+``max_messages`` messages.
+
+- MemorySessionStore: an LRU of up to ``max_sessions`` sessions in this
+  process. Histories are lost on restart and not shared between pre-forked
+  workers.
+- SQLiteSessionStore: one SQLite database in WAL mode, shared by every
+  worker and kept across restarts. Messages older than ``ttl_seconds`` are
+  deleted.
+
+Both are safe to use from several threads.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemorySessionStore:
+    """Chat histories in process memory, least recently used evicted first"""
+
+    def __init__(self, max_sessions=10000, max_messages=20):
+        self.max_sessions = max_sessions
+        self.max_messages = max_messages
+        self._sessions = OrderedDict()  # session id -> list of {"role", "content"}
+        self._lock = threading.Lock()
+
+    def history(self, session_id):
+        """The session's stored messages, oldest first"""
+        with self._lock:
+            messages = self._sessions.get(session_id)
+            if messages is None:
+                return []
+            self._sessions.move_to_end(session_id)
+            return list(messages)
+
+    def append(self, session_id, *messages):
+        with self._lock:
+            stored = self._sessions.setdefault(session_id, [])
+            self._sessions.move_to_end(session_id)
+            stored.extend({"role": m["role"], "content": m["content"]} for m in messages)
+            del stored[:-self.max_messages]
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def clear(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "sessions": len(self._sessions), "max_sessions": self.max_sessions}
+
+
+class SQLiteSessionStore:
+    """Chat histories in a SQLite database (WAL mode) shared across processes"""
+
+    # Old messages are deleted every this many appends
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path, max_messages=20, ttl_seconds=7 * 24 * 3600):
+        self.path = path
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+        self._appends = 0
+
+        # Set up with a short-lived connection so a pre-forking parent holds
+        # no open database when it forks
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL,"
+                " content TEXT NOT NULL, created_at REAL NOT NULL,"
+                " PRIMARY KEY (session_id, seq)) WITHOUT ROWID"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_created_at ON messages (created_at)")
+            self._prune(conn)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        # Transactions are opened explicitly (BEGIN IMMEDIATE)
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self):
+        """This thread's connection, opened on first use in this process"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = self._local.conn = self._connect()
+            self._local.pid = os.getpid()
+        return conn
+
+    def history(self, session_id):
+        """The session's stored messages, oldest first"""
+        rows = self._connection().execute(
+            "SELECT role, content FROM ("
+            " SELECT seq, role, content FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?"
+            ") ORDER BY seq",
+            (session_id, self.max_messages),
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append(self, session_id, *messages):
+        conn = self._connection()
+        now = time.time()
+        # IMMEDIATE takes the write lock up front, so workers appending to
+        # the same session cannot pick the same sequence numbers
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            (last,) = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            conn.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                [(session_id, last + i + 1, m["role"], m["content"], now) for i, m in enumerate(messages)],
+            )
+            conn.execute(
+                "DELETE FROM messages WHERE session_id = ? AND seq <= ?",
+                (session_id, last + len(messages) - self.max_messages),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._appends += 1
+        if self._appends % self.PRUNE_EVERY == 0:
+            self._prune(conn)
+
+    def clear(self, session_id):
+        self._connection().execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+
+    def _prune(self, conn):
+        conn.execute("DELETE FROM messages WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+
+    def stats(self):
+        (sessions,) = self._connection().execute("SELECT COUNT(DISTINCT session_id) FROM messages").fetchone()
+        return {"backend": "sqlite", "path": self.path, "sessions": sessions}
+
+
+def open_session_store(db_path=None, max_sessions=10000, max_messages=20, ttl_seconds=7 * 24 * 3600):
+    """SQLiteSessionStore when a database path is given, MemorySessionStore otherwise"""
+    if db_path:
+        return SQLiteSessionStore(db_path, max_messages=max_messages, ttl_seconds=ttl_seconds)
+    return MemorySessionStore(max_sessions=max_sessions, max_messages=max_messages)
@@ -0,0 +1,216 @@
+"""
+Speculative decoding with a small draft model for the inference engine.
+
+While a single conversation is decoding, the draft model (same tokenizer,
+a fraction of TinyLLaMA's size) proposes a few tokens one at a time and
+TinyLLaMA checks all of them in one forward pass. Each proposed token is
+accepted with probability min(1, p/q), where p and q are TinyLLaMA's and the
+draft's probabilities for it under the request's sampling settings; at the
+first rejection a token is drawn from the normalized max(0, p - q) instead,
+and when every proposal is accepted TinyLLaMA's last position yields one
+more. The output therefore follows TinyLLaMA's own distribution (greedy
+requests get exactly its greedy output), but each TinyLLaMA pass can produce
+several tokens.
+
+With more than one conversation in the batch the engine decodes normally:
+verifying several tokens for every row costs more than it saves on CPU.
+
+Speculation only pays off when enough proposals are accepted. Every so often
+a plain decode step is taken to measure what a token costs without the
+draft. Over the last ``window`` speculative steps, if the acceptance rate is
+below ``min_acceptance`` or tokens came no faster than plain decoding,
+speculation is switched off for ``retry_seconds`` and then tried again.
+"""
+
+import threading
+import time
+from collections import deque
+
+import torch
+
+from inference_engine import next_token_distribution
+from kv_cache import from_legacy_cache, to_legacy_cache
+
+
+class SpeculativeDecoder:
+    """Draft model plus its KV cache and acceptance statistics"""
+
+    def __init__(self, draft_model, num_tokens=4, min_acceptance=0.4, window=64,
+                 retry_seconds=600, baseline_every=16):
+        self.draft_model = draft_model
+        self.num_tokens = num_tokens
+        self.min_acceptance = min_acceptance
+        self.window = window
+        self.retry_seconds = retry_seconds
+        self.baseline_every = baseline_every
+        self.device = next(draft_model.parameters()).device
+
+        self.proposed = 0
+        self.accepted = 0
+        self.switched_off = 0
+        self._disabled_until = None
+        self._steps = deque(maxlen=window)         # (proposed, accepted, tokens, seconds)
+        self._plain_steps = deque(maxlen=window)   # seconds of single-row plain decode steps
+        self._calls = 0
+        self._lock = threading.Lock()
+
+        self._request = None      # request the draft cache belongs to
+        self._draft_past = None
+        self._draft_length = 0    # leading token ids of the request covered by the draft cache
+
+    def wants(self, request):
+        """Whether the engine should take a speculative step for this request"""
+        if self._disabled_until is not None:
+            if time.monotonic() < self._disabled_until:
+                return False
+            print("Speculative decoding: trying again")
+            self._disabled_until = None
+            with self._lock:
+                self._steps.clear()
+
+        if request is not self._request:
+            self._request = request
+            self._draft_past = None
+            self._draft_length = 0
+
+        if request.max_new_tokens - len(request.generated_ids) < 2:
+            return False
+        # Regular plain steps keep the speed-up measured against the real thing
+        self._calls += 1
+        return self._calls % self.baseline_every != 0
+
+    def record_plain_step(self, seconds):
+        """Time of a plain decode step with one row, the cost of one token"""
+        with self._lock:
+            self._plain_steps.append(seconds)
+
+    @torch.inference_mode()
+    def step(self, model, request, past):
+        """Advance the only row of the batch by one or more tokens
+
+        ``past`` is the batch KV cache, covering every token of the request
+        but the last. Returns the cache for the tokens that were kept.
+        """
+        start = time.perf_counter()
+        context = request.token_ids
+        count = min(self.num_tokens, request.max_new_tokens - len(request.generated_ids) - 1)
+        drafts, draft_probs = self._propose(request, context, count)
+
+        # Verify: the last token plus every proposal in one TinyLLaMA pass
+        length = len(context) + count
+        outputs = model(
+            input_ids=torch.tensor([[context[-1]] + drafts], device=past[0][0].device),
+            attention_mask=torch.ones(1, length, dtype=torch.long, device=past[0][0].device),
+            position_ids=torch.arange(len(context) - 1, length, device=past[0][0].device).unsqueeze(0),
+            past_key_values=from_legacy_cache(past),
+            use_cache=True,
+        )
+        logits = outputs.logits[0]
+
+        tokens = []
+        seen = list(context)
+        for i, token in enumerate(drafts):
+            target_logits, p = next_token_distribution(request, logits[i], seen)
+            if p is None:
+                choice = int(torch.argmax(target_logits))
+                if choice != token:
+                    tokens.append(choice)
+                    break
+            else:
+                q = draft_probs[i]
+                if float(torch.rand(())) * float(q[token]) >= float(p[token]):
+                    residual = torch.clamp(p - q, min=0)
+                    if float(residual.sum()) <= 0:
+                        residual = p
+                    tokens.append(int(torch.multinomial(residual / residual.sum(), num_samples=1)))
+                    break
+            tokens.append(token)
+            seen.append(token)
+        else:
+            target_logits, p = next_token_distribution(request, logits[count], seen)
+            tokens.append(int(torch.argmax(target_logits)) if p is None else int(torch.multinomial(p, num_samples=1)))
+        accepted = len(tokens) - 1
+
+        appended = 0
+        for token in tokens:
+            request._append(token)
+            appended += 1
+            if request.finish_reason is not None:
+                break
+
+        # Keep key/values of every token now in the sequence but the last
+        keep = len(request.token_ids) - 1
+        past = tuple((key[:, :, :keep], value[:, :, :keep]) for key, value in to_legacy_cache(outputs.past_key_values))
+        if self._draft_length > keep:
+            self._draft_past = tuple((key[:, :, :keep], value[:, :, :keep]) for key, value in self._draft_past)
+            self._draft_length = keep
+
+        with self._lock:
+            self.proposed += count
+            self.accepted += accepted
+            self._steps.append((count, accepted, appended, time.perf_counter() - start))
+        self._check()
+        return past
+
+    def _propose(self, request, context, count):
+        """Sample ``count`` tokens from the draft model, with their distributions"""
+        new_ids = context[self._draft_length:]
+        drafts = []
+        probs = []
+        seen = list(context)
+        for _ in range(count):
+            outputs = self.draft_model(
+                input_ids=torch.tensor([new_ids], device=self.device),
+                attention_mask=torch.ones(1, self._draft_length + len(new_ids), dtype=torch.long, device=self.device),
+                position_ids=torch.arange(
+                    self._draft_length, self._draft_length + len(new_ids), device=self.device
+                ).unsqueeze(0),
+                past_key_values=from_legacy_cache(self._draft_past) if self._draft_past is not None else None,
+                use_cache=True,
+            )
+            self._draft_past = to_legacy_cache(outputs.past_key_values)
+            self._draft_length += len(new_ids)
+
+            logits, q = next_token_distribution(request, outputs.logits[0, -1], seen)
+            token = int(torch.argmax(logits)) if q is None else int(torch.multinomial(q, num_samples=1))
+            drafts.append(token)
+            probs.append(q)
+            seen.append(token)
+            new_ids = [token]
+        return drafts, probs
+
+    def _check(self):
+        """Switch speculation off for a while when it does not help"""
+        stats = self.stats()
+        if len(self._steps) < self.window:
+            return
+        slow = stats["speedup"] is not None and stats["speedup"] < 1.0
+        if stats["acceptance_rate"] < self.min_acceptance or slow:
+            print(
+                f"Speculative decoding: off for {self.retry_seconds}s "
+                f"(acceptance {stats['acceptance_rate']:.0%}, speed-up {stats['speedup'] or 0:.2f}x)"
+            )
+            self.switched_off += 1
+            self._disabled_until = time.monotonic() + self.retry_seconds
+
+    def stats(self):
+        """Acceptance rate and speed-up over the recent speculative steps"""
+        with self._lock:
+            steps = list(self._steps)
+            plain = list(self._plain_steps)
+            totals = {"proposed": self.proposed, "accepted": self.accepted}
+        proposed = sum(step[0] for step in steps)
+        tokens = sum(step[2] for step in steps)
+        seconds = sum(step[3] for step in steps)
+        speedup = None
+        if plain and tokens and seconds:
+            speedup = (sum(plain) / len(plain)) / (seconds / tokens)
+        return {
+            "active": self._disabled_until is None,
+            "draft_tokens": self.num_tokens,
+            "acceptance_rate": sum(step[1] for step in steps) / proposed if proposed else 0.0,
+            "tokens_per_step": tokens / len(steps) if steps else 0.0,
+            "speedup": speedup,
+            "switched_off": self.switched_off,
+            **totals,
+        }
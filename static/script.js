@@ -8,6 +8,13 @@ document.addEventListener("DOMContentLoaded", () => {
   let messages = [];
   let modelReady = false;
 
+  // Lets the server keep this conversation's model state between turns
+  const newSessionId = () =>
+    window.crypto && crypto.randomUUID
+      ? crypto.randomUUID()
+      : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+  let sessionId = newSessionId();
+
   const addMessage = (role, content) => {
     const message = { role, content };
     messages.push(message);
@@ -61,13 +68,24 @@ document.addEventListener("DOMContentLoaded", () => {
         updateStatusIndicator("ready", "🟢 AI Model Ready");
         chatInput.disabled = false;
         chatInput.placeholder = "Type your message here...";
+      } else if (data.status === "error") {
+        modelReady = false;
+        updateStatusIndicator("error", "🔴 AI Model Error");
+        chatInput.disabled = true;
+        chatInput.placeholder = "AI model failed to load. Please restart the app.";
       } else {
         modelReady = false;
-        updateStatusIndicator("loading", "🟡 AI Model Loading...");
+        const progress = data.progress;
+        updateStatusIndicator(
+          "loading",
+          progress && progress.stage
+            ? `🟡 AI Model Loading... ${Math.round(progress.percent)}% (${progress.stage})`
+            : "🟡 AI Model Loading..."
+        );
         chatInput.disabled = true;
         chatInput.placeholder = "Please wait, AI model is loading...";
-        // Check again in 5 seconds
-        setTimeout(checkModelStatus, 5000);
+        // Check again in 2 seconds
+        setTimeout(checkModelStatus, 2000);
       }
     } catch (error) {
       modelReady = false;
@@ -77,6 +95,59 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   };
 
+  const showCrisisAlert = () => {
+    const crisisAlert = document.createElement("div");
+    crisisAlert.classList.add("alert", "alert-danger", "mt-3");
+    crisisAlert.innerHTML = `
+                        <h4 class="alert-heading">Immediate Support Available</h4>
+                        <p>It sounds like you are going through a very difficult time. Your safety is the most important thing. Please reach out for help.</p>
+                        <hr>
+                        <p class="mb-0">You can call the Nigerian emergency hotline at 112, or reach out to the Suicide Research and Prevention Initiative (SURPIN) at 08092106463.</p>
+                    `;
+    chatMessages.appendChild(crisisAlert);
+  };
+
+  // Parse a server-sent event stream from a fetch() response
+  const readEventStream = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = "";
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const rawEvent = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let eventName = "message";
+        let data = "";
+        rawEvent.split("\n").forEach((line) => {
+          if (line.startsWith("event:")) {
+            eventName = line.slice(6).trim();
+          } else if (line.startsWith("data:")) {
+            data += line.slice(5).trim();
+          }
+        });
+        if (data) onEvent(eventName, JSON.parse(data));
+      }
+    }
+  };
+
+  // How many times a message is re-sent when the server says it is busy
+  const MAX_BUSY_RETRIES = 3;
+
+  const sleep = (ms) => new Promise((resolve) => setTimeout(resolve, ms));
+
+  // Seconds from a Retry-After header, or null when there is none
+  const retryAfterSeconds = (response) => {
+    const seconds = parseInt(response.headers.get("Retry-After"), 10);
+    return Number.isNaN(seconds) ? null : seconds;
+  };
+
   chatForm.addEventListener("submit", async (e) => {
     e.preventDefault();
     const userInput = chatInput.value.trim();
@@ -86,47 +157,111 @@ document.addEventListener("DOMContentLoaded", () => {
     chatInput.value = "";
     showLoadingIndicator();
 
+    // Assistant bubble that streamed tokens are appended to
+    let reply = null;
+    let replyElement = null;
+    const appendToReply = (text) => {
+      if (!reply) {
+        removeLoadingIndicator();
+        addMessage("assistant", "");
+        reply = messages[messages.length - 1];
+        replyElement = chatMessages.lastElementChild;
+      }
+      reply.content += text;
+      replyElement.textContent = reply.content;
+      chatMessages.scrollTop = chatMessages.scrollHeight;
+    };
+
+    // Drop a partly streamed reply before retrying or reporting an error
+    const discardReply = () => {
+      if (reply) {
+        messages.pop();
+        renderMessages();
+        reply = null;
+        replyElement = null;
+      }
+    };
+
     try {
-      const response = await fetch("/api/chat", {
-        method: "POST",
-        headers: {
-          "Content-Type": "application/json",
-        },
-        body: JSON.stringify({ messages }),
-      });
+      for (let busyRetries = 0; ; busyRetries++) {
+        const response = await fetch("/api/chat/stream", {
+          method: "POST",
+          headers: {
+            "Content-Type": "application/json",
+          },
+          // The server keeps the conversation history, so only the new message is sent
+          body: JSON.stringify({ message: userInput, session_id: sessionId }),
+        });
+        let retryAfter = retryAfterSeconds(response);
 
-      const data = await response.json();
-      removeLoadingIndicator();
+        if (response.status === 503 && retryAfter === null) {
+          // Model still loading
+          removeLoadingIndicator();
+          addMessage(
+            "assistant",
+            "The AI model is still loading. Please wait a moment and try again."
+          );
+          modelReady = false;
+          checkModelStatus();
+          return;
+        }
 
-      if (response.status === 503) {
-        // Model still loading
-        addMessage(
-          "assistant",
-          "The AI model is still loading. Please wait a moment and try again."
-        );
-        modelReady = false;
-        checkModelStatus();
-      } else if (data.error) {
-        addMessage(
-          "assistant",
-          "I apologize, but I encountered an error. Please try again or start a new conversation."
-        );
-      } else {
-        addMessage("assistant", data.response);
-        if (data.crisis) {
-          const crisisAlert = document.createElement("div");
-          crisisAlert.classList.add("alert", "alert-danger", "mt-3");
-          crisisAlert.innerHTML = `
-                        <h4 class="alert-heading">Immediate Support Available</h4>
-                        <p>It sounds like you are going through a very difficult time. Your safety is the most important thing. Please reach out for help.</p>
-                        <hr>
-                        <p class="mb-0">You can call the Nigerian emergency hotline at 112, or reach out to the Suicide Research and Prevention Initiative (SURPIN) at 08092106463.</p>
-                    `;
-          chatMessages.appendChild(crisisAlert);
+        if (response.status === 413) {
+          removeLoadingIndicator();
+          addMessage("assistant", "That message is too long for me to read. Could you shorten it and send it again?");
+          return;
+        }
+
+        let failed = !response.ok;
+        let finished = false;
+        let crisis = false;
+        if (!failed) {
+          await readEventStream(response, (event, data) => {
+            if (event === "token") {
+              appendToReply(data.text);
+            } else if (event === "done") {
+              // The final reply is trimmed server-side, so it replaces the draft
+              appendToReply("");
+              reply.content = data.response;
+              replyElement.textContent = data.response;
+              crisis = data.crisis;
+              finished = true;
+            } else if (event === "error") {
+              failed = true;
+              if (data.retry_after) retryAfter = data.retry_after;
+            }
+          });
+        }
+
+        if (failed && retryAfter !== null && busyRetries < MAX_BUSY_RETRIES) {
+          // Server is busy: wait as long as it asked (plus jitter so waiting
+          // clients don't all come back at once) and send the message again
+          discardReply();
+          removeLoadingIndicator();
+          showLoadingIndicator();
+          updateStatusIndicator("loading", `🟡 Busy, retrying in ${retryAfter}s...`);
+          await sleep(retryAfter * 1000 + Math.random() * 1000);
+          updateStatusIndicator("ready", "🟢 AI Model Ready");
+          continue;
+        }
+
+        removeLoadingIndicator();
+        if (failed || !finished) {
+          discardReply();
+          addMessage(
+            "assistant",
+            retryAfter !== null
+              ? "I'm getting a lot of messages right now. Please wait a minute and send yours again."
+              : "I apologize, but I encountered an error. Please try again or start a new conversation."
+          );
+        } else if (crisis) {
+          showCrisisAlert();
         }
+        return;
       }
     } catch (error) {
       removeLoadingIndicator();
+      discardReply();
       addMessage(
         "assistant",
         "I apologize, but I encountered a connection error. Please check your connection and try again."
@@ -136,6 +271,7 @@ document.addEventListener("DOMContentLoaded", () => {
 
   newChatBtn.addEventListener("click", () => {
     messages = [];
+    sessionId = newSessionId();
     chatMessages.innerHTML =
       '<div class="assistant-message">Hello. How are you feeling today?</div>';
   });
@@ -0,0 +1,154 @@
+"""
+Deterministic stand-in for TinyLLaMA, for benchmarking the server offline.
+
+With MODEL_BACKEND=stub the apps load StubModel and StubTokenizer instead of
+TinyLLaMA. Nothing is downloaded and transformers is not needed, but the
+rest of the serving stack runs unchanged: the inference engine with its
+batching and queues, the prefix and session KV caches, the risk checks and
+the reply cache. Latencies then measure the server's own overhead plus a
+configurable model cost:
+
+- every forward pass sleeps ``token_delay`` seconds, like a decode step whose
+  cost barely depends on the batch size
+- a prefill sleeps another ``prefill_delay`` seconds per prompt token
+
+The same prompt always gets the same reply: one of REPLIES, picked by a hash
+of the prompt. Risk prompts are always answered LOW_RISK, so only the crisis
+lexicon flags messages.
+"""
+
+import time
+import zlib
+
+import torch
+
+from kv_cache import to_legacy_cache
+
+# Token ids: specials, then the 256 byte values as they appear in prompts,
+# then the same bytes again as generated by the model. The model tells its
+# own reply apart from the prompt by the id range.
+PAD_TOKEN_ID = 0
+BOS_TOKEN_ID = 1
+EOS_TOKEN_ID = 2
+SPECIAL_TOKENS = ("<unk>", "<s>", "</s>")
+PROMPT_BYTE_OFFSET = len(SPECIAL_TOKENS)
+REPLY_BYTE_OFFSET = PROMPT_BYTE_OFFSET + 256
+VOCAB_SIZE = REPLY_BYTE_OFFSET + 256
+
+REPLIES = [
+    "It sounds like you are carrying a lot right now, and that is hard. What thought goes through your mind when this happens? Could we look at the evidence for and against it together?",
+    "Thank you for sharing that with me. It can help to notice when a thought jumps to the worst case. What is one small thing you could try this week to test it?",
+    "That feeling makes sense given what you are going through. Sometimes our minds treat one setback as proof of failure. How might you talk to a friend who felt this way?",
+    "I hear how tiring this has been. Let's try to separate what happened from the story we tell ourselves about it. What would a more balanced thought sound like?",
+]
+
+RISK_REPLY = "LOW_RISK"
+
+
+class StubTokenizer:
+    """Byte-level tokenizer with the parts of the HF interface the apps use"""
+
+    bos_token_id = BOS_TOKEN_ID
+    eos_token_id = EOS_TOKEN_ID
+    pad_token_id = PAD_TOKEN_ID
+
+    def encode(self, text, add_special_tokens=True):
+        ids = [PROMPT_BYTE_OFFSET + byte for byte in text.encode("utf-8")]
+        return [BOS_TOKEN_ID] + ids if add_special_tokens else ids
+
+    def __call__(self, text, add_special_tokens=True):
+        return {"input_ids": self.encode(text, add_special_tokens)}
+
+    def apply_chat_template(self, messages, tokenize=True, add_generation_prompt=False):
+        """TinyLLaMA's chat format, with "</s>" written out as bytes"""
+        text = "".join(f"<|{message['role']}|>\n{message['content']}</s>\n" for message in messages)
+        if add_generation_prompt:
+            text += "<|assistant|>\n"
+        return self.encode(text, add_special_tokens=False) if tokenize else text
+
+    def decode(self, token_ids, skip_special_tokens=False):
+        data = bytearray()
+        for token_id in token_ids:
+            token_id = int(token_id)
+            if token_id >= REPLY_BYTE_OFFSET:
+                data.append(token_id - REPLY_BYTE_OFFSET)
+            elif token_id >= PROMPT_BYTE_OFFSET:
+                data.append(token_id - PROMPT_BYTE_OFFSET)
+            elif not skip_special_tokens:
+                data.extend(SPECIAL_TOKENS[token_id].encode("utf-8"))
+        return data.decode("utf-8", errors="replace")
+
+
+def reply_for(prompt_ids, replies=REPLIES):
+    """Bytes of the reply to a prompt, the same on every call"""
+    prompt = bytes(i - PROMPT_BYTE_OFFSET for i in prompt_ids if PROMPT_BYTE_OFFSET <= i < REPLY_BYTE_OFFSET)
+    if b"LOW_RISK" in prompt:
+        return RISK_REPLY.encode("utf-8")
+    return replies[zlib.crc32(prompt) % len(replies)].encode("utf-8")
+
+
+def next_token(sequence, replies=REPLIES):
+    """The token that follows a prompt plus the reply tokens generated so far"""
+    prompt_end = len(sequence)
+    while prompt_end and sequence[prompt_end - 1] >= REPLY_BYTE_OFFSET:
+        prompt_end -= 1
+    reply = reply_for(sequence[:prompt_end], replies)
+    position = len(sequence) - prompt_end
+    return REPLY_BYTE_OFFSET + reply[position] if position < len(reply) else EOS_TOKEN_ID
+
+
+class StubConfig:
+    def __init__(self, max_position_embeddings=2048):
+        self.max_position_embeddings = max_position_embeddings
+        self.vocab_size = VOCAB_SIZE
+
+
+class StubOutput:
+    def __init__(self, logits, past_key_values):
+        self.logits = logits
+        self.past_key_values = past_key_values
+
+
+class StubModel(torch.nn.Module):
+    """Causal LM look-alike whose KV cache holds the token ids themselves
+
+    Each forward pass sees every row's whole sequence through its cache, so
+    it can continue the deterministic reply wherever the row left off.
+    """
+
+    def __init__(self, token_delay=0.02, prefill_delay=0.0002, replies=REPLIES):
+        super().__init__()
+        self.config = StubConfig()
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+        self.replies = list(replies)
+        # Only there so next(model.parameters()) finds the device and dtype
+        self.anchor = torch.nn.Parameter(torch.zeros(1), requires_grad=False)
+
+    @property
+    def dtype(self):
+        return self.anchor.dtype
+
+    def forward(self, input_ids, attention_mask=None, position_ids=None, past_key_values=None, use_cache=True, **kwargs):
+        batch, length = input_ids.shape
+        delay = self.token_delay + (self.prefill_delay * length if length > 1 else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+        # One layer, one head, head size one: the "keys" are the token ids
+        ids = input_ids.to(torch.float32)[:, None, :, None]
+        if past_key_values is not None:
+            ids = torch.cat([to_legacy_cache(past_key_values)[0][0], ids], dim=2)
+
+        logits = torch.zeros(batch, length, VOCAB_SIZE)
+        for row in range(batch):
+            sequence = ids[row, 0, :, 0]
+            if attention_mask is not None:
+                # Drop the left padding of batched rows
+                sequence = sequence[attention_mask[row, -sequence.shape[0]:].bool()]
+            token_id = next_token(sequence.long().tolist(), self.replies)
+            logits[row, -1, token_id] = 30.0
+            if token_id >= REPLY_BYTE_OFFSET:
+                # Scoring requests compare prompt-range label tokens
+                logits[row, -1, token_id - 256] = 20.0
+        return StubOutput(logits, ((ids, ids),))